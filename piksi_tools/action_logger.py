@@ -255,7 +255,7 @@ def main():
           link.add_callback(sl.printer, SBP_MSG_PRINT_DEP)
           link.add_callback(sl.log_printer, SBP_MSG_LOG)
           # add logger callback
-          Forwarder(link, logger).start()
+          link.add_callback(logger)
           # ad append logger callback
           Forwarder(link, append_logger).start()
           try:
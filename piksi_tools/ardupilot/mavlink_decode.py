@@ -16,6 +16,7 @@ Requirements:
 from pymavlink.DFReader import DFReader_binary
 from sbp.table import dispatch, _SBP_TABLE
 from sbp.msg import SBP
+from piksi_tools.json_log_index import build_index
 
 import json
 
@@ -127,6 +128,7 @@ def rewrite(records, outfile):
       print traceback.format_exc()
       i += 1
       continue
+  new_datafile.close()
   print "Of %d records, skipped %i." % (len(records), i)
   return items
 
@@ -142,6 +144,9 @@ def get_args():
   parser.add_argument('-o', '--outfile',
                       default=["serial_link_datflash_convert.log.json"], nargs=1,
                       help='specify the name of the file output.')
+  parser.add_argument('-i', '--index', action='store_true',
+                      help='index the output by time and message type, see '
+                           'piksi_tools.json_log_index.')
   args = parser.parse_args()
   return args
 
@@ -151,6 +156,8 @@ def main():
   outfile = args.outfile[0]
   f = extractSBP(filename)
   g = rewrite(f, outfile)
+  if args.index:
+    build_index(outfile)
   print "JSON SBP log succesfully written to {0}.".format(outfile)
   return 0
 if __name__ == "__main__":
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+The :mod:`piksi_tools.binary_log` module writes and reads compact binary logs
+of SBP messages, holding each message's framed bytes as received plus the
+host time it was logged at, and a sparse index of the log by time and
+message type so readers can seek straight to what they need.
+
+File layout, all integers little-endian:
+
+- Header: FILE_MAGIC and the format version (uint16).
+- Records: host time in microseconds since the epoch (uint64), followed by
+  the framed SBP message (preamble, header, payload and CRC).
+- Index, written when the log is closed: INDEX_MAGIC, the number of entries
+  (uint32), and per entry the time of its first record (uint64), its byte
+  offset (uint64), the number of message types in it (uint16) and those
+  message types (uint16 each). An entry is started every INDEX_PERIOD
+  seconds or INDEX_BLOCK_SIZE bytes of records.
+- Trailer: the byte offset of the index (uint64) and INDEX_MAGIC.
+
+A log that wasn't closed, e.g. one still being written, has no index; it is
+rebuilt by scanning the records when the log is opened.
+"""
+
+import bisect
+import os
+import struct
+import time
+
+from sbp.msg import SBP, SBP_PREAMBLE
+from sbp.table import dispatch
+from sbp.client.loggers.base_logger import BaseLogger, LogIterator
+
+FILE_MAGIC = 'SBPLOG\x00\x00'
+INDEX_MAGIC = 'SBPINDEX'
+FORMAT_VERSION = 1
+
+# Seconds and bytes of records covered by each index entry at most.
+INDEX_PERIOD = 1.0
+INDEX_BLOCK_SIZE = 0x10000
+
+_HEADER = struct.Struct('<8sH')
+# Record time and SBP frame header (preamble, type, sender, length).
+_RECORD = struct.Struct('<QBHHB')
+_INDEX_ENTRY = struct.Struct('<QQH')
+_TRAILER = struct.Struct('<Q8s')
+# Bytes of a record other than the payload.
+_RECORD_OVERHEAD = _RECORD.size + 2
+
+def is_binary_log(filename):
+  """ Whether a file starts like a binary log. """
+  with open(filename, 'rb') as f:
+    return f.read(len(FILE_MAGIC)) == FILE_MAGIC
+
+class BinaryLogger(BaseLogger):
+  """
+  Logs the framed bytes of SBP messages and the host time they were logged
+  at, see the module documentation for the format.
+
+  Parameters
+  ----------
+  filename : string
+    File to log to.
+  fileobj : file
+    Open file to log to instead of filename, e.g. a compressed one.
+  """
+
+  def __init__(self, filename, tags={}, dispatcher=None, fileobj=None):
+    super(BinaryLogger, self).__init__(filename, 'wb', tags, dispatcher)
+    if fileobj is not None:
+      self.handle = fileobj
+    self.handle.write(_HEADER.pack(FILE_MAGIC, FORMAT_VERSION))
+    self.offset = _HEADER.size
+    # Index entries as [time_us, offset, set of message types].
+    self.index = []
+    self.closed = False
+
+  def __call__(self, msg, **metadata):
+    # Messages queued before being logged carry the time they were received.
+    t = int(metadata.get('time', time.time()) * 1e6)
+    entry = self.index[-1] if self.index else None
+    if entry is None or t - entry[0] >= INDEX_PERIOD * 1e6 or \
+        self.offset - entry[1] >= INDEX_BLOCK_SIZE:
+      entry = [t, self.offset, set()]
+      self.index.append(entry)
+    entry[2].add(msg.msg_type)
+    record = struct.pack('<Q', t) + msg.to_binary()
+    self.handle.write(record)
+    self.offset += len(record)
+
+  def flush(self):
+    if not self.closed:
+      self.handle.flush()
+
+  def close(self):
+    """ Write the index and close the log. """
+    if self.closed:
+      return
+    self.closed = True
+    index = [INDEX_MAGIC, struct.pack('<I', len(self.index))]
+    for t, offset, msg_types in self.index:
+      index.append(_INDEX_ENTRY.pack(t, offset, len(msg_types)))
+      index.append(struct.pack('<%dH' % len(msg_types), *sorted(msg_types)))
+    index.append(_TRAILER.pack(self.offset, INDEX_MAGIC))
+    self.handle.write(''.join(index))
+    self.handle.close()
+
+class BinaryLogIterator(LogIterator):
+  """
+  Reads binary logs of SBP messages, see the module documentation for the
+  format.
+
+  The index is loaded when the log is opened, or rebuilt by scanning the log
+  if it has none. Messages are yielded with metadata holding the host time
+  they were logged at, in seconds ('time', and 'timestamp' truncated to
+  whole seconds as in JSON logs) and in milliseconds since the first record
+  ('delta').
+
+  Parameters
+  ----------
+  filename : string
+    Path to file to read SBP messages from.
+  fileobj : file
+    Open, seekable file to read instead of filename.
+  """
+
+  def __init__(self, filename, dispatcher=dispatch, fileobj=None):
+    self.handle = fileobj if fileobj is not None else open(filename, 'rb')
+    self.dispatcher = dispatcher
+    magic, version = _HEADER.unpack(self.handle.read(_HEADER.size))
+    if magic != FILE_MAGIC:
+      raise ValueError("%s is not a binary SBP log" % filename)
+    if version != FORMAT_VERSION:
+      raise ValueError("%s has unsupported format version %d" %
+                       (filename, version))
+    self.index = self._load_index()
+    if self.index is None:
+      self.index = self._scan_index()
+    self._times = [entry[0] for entry in self.index]
+    self.t0 = self.index[0][0] if self.index else 0
+
+  def _load_index(self):
+    """ Index written when the log was closed, None if it has none. """
+    self.handle.seek(0, os.SEEK_END)
+    size = self.handle.tell()
+    if size < _HEADER.size + _TRAILER.size:
+      return None
+    self.handle.seek(size - _TRAILER.size)
+    index_offset, magic = _TRAILER.unpack(self.handle.read(_TRAILER.size))
+    if magic != INDEX_MAGIC:
+      return None
+    self.handle.seek(index_offset)
+    data = self.handle.read(size - _TRAILER.size - index_offset)
+    n_entries = struct.unpack_from('<I', data, len(INDEX_MAGIC))[0]
+    pos = len(INDEX_MAGIC) + 4
+    index = []
+    for i in range(n_entries):
+      t, offset, n_types = _INDEX_ENTRY.unpack_from(data, pos)
+      pos += _INDEX_ENTRY.size
+      msg_types = set(struct.unpack_from('<%dH' % n_types, data, pos))
+      pos += 2 * n_types
+      index.append((t, offset, msg_types))
+    self.data_end = index_offset
+    return index
+
+  def _scan_index(self):
+    """ Build an index by reading all the records of the log. """
+    self.handle.seek(0, os.SEEK_END)
+    self.data_end = self.handle.tell()
+    index = []
+    entry = None
+    for t, offset, frame_offset, msg_type, data in \
+        self._records(_HEADER.size, self.data_end):
+      if entry is None or t - entry[0] >= INDEX_PERIOD * 1e6 or \
+          offset - entry[1] >= INDEX_BLOCK_SIZE:
+        entry = (t, offset, set())
+        index.append(entry)
+      entry[2].add(msg_type)
+    # Leave out a partially written last record.
+    self.data_end = self._end
+    return index
+
+  def _records(self, start, end, block_size=INDEX_BLOCK_SIZE):
+    """
+    Generate (time_us, offset, frame offset in data, message type, data) for
+    each complete record between two offsets, reading a block at a time.
+    """
+    offset = start
+    self._end = start
+    while offset < end:
+      self.handle.seek(offset)
+      data = self.handle.read(min(block_size, end - offset))
+      pos = 0
+      while pos + _RECORD.size <= len(data):
+        t, preamble, msg_type, sender, length = \
+            _RECORD.unpack_from(data, pos)
+        if preamble != SBP_PREAMBLE:
+          raise ValueError("Corrupt record at offset %d" % (offset + pos))
+        n = _RECORD_OVERHEAD + length
+        if pos + n > len(data):
+          break
+        yield t, offset + pos, pos, msg_type, data
+        pos += n
+        self._end = offset + pos
+      if pos == 0:
+        if len(data) < end - offset:
+          # A record larger than the block, read it whole.
+          block_size *= 2
+          continue
+        break
+      offset += pos
+
+  def blocks(self, start=None, end=None, msg_types=None):
+    """
+    Byte ranges of the log holding records in a time range and of some
+    message types, found from the index.
+
+    Parameters
+    ----------
+    start : float
+      Earliest host time, in seconds, or None.
+    end : float
+      Latest host time, in seconds, or None.
+    msg_types : set[int]
+      Message types, or None for all.
+
+    Returns
+    -------
+    out : [(int, int)]
+      First and end (exclusive) byte offsets of each range.
+    """
+    first = 0
+    if start is not None:
+      first = max(0, bisect.bisect_left(self._times, int(start * 1e6)) - 1)
+    last = len(self.index)
+    if end is not None:
+      last = bisect.bisect_right(self._times, int(end * 1e6))
+    ranges = []
+    for i in range(first, last):
+      if msg_types is not None and not (self.index[i][2] & msg_types):
+        continue
+      block_end = self.index[i + 1][1] if i + 1 < len(self.index) \
+                  else self.data_end
+      if ranges and ranges[-1][1] == self.index[i][1]:
+        ranges[-1] = (ranges[-1][0], block_end)
+      else:
+        ranges.append((self.index[i][1], block_end))
+    return ranges
+
+  def next(self, start=None, end=None, msg_types=None):
+    """
+    Return the records of the log, optionally only those in a time range
+    and of some message types, seeking past the others with the index.
+
+    Parameters
+    ----------
+    start : float
+      Earliest host time, in seconds, or None.
+    end : float
+      Latest host time, in seconds, or None.
+    msg_types : iterable of int
+      Message types, or None for all.
+
+    Returns
+    -------
+    out : generator
+      (msg, metadata) tuples.
+    """
+    if msg_types is not None:
+      msg_types = set(msg_types)
+    start_us = int(start * 1e6) if start is not None else None
+    end_us = int(end * 1e6) if end is not None else None
+    for first, last in self.blocks(start, end, msg_types):
+      for t, offset, pos, msg_type, data in self._records(first, last):
+        if start_us is not None and t < start_us:
+          continue
+        if end_us is not None and t > end_us:
+          return
+        if msg_types is not None and msg_type not in msg_types:
+          continue
+        sender, length = struct.unpack_from('<HB', data, pos + 11)
+        payload = data[pos + 14:pos + 14 + length]
+        crc = struct.unpack_from('<H', data, pos + 14 + length)[0]
+        msg = self.dispatch(SBP(msg_type, sender, length, payload, crc))
+        yield (msg, {'time': t / 1e6,
+                     'timestamp': t // 1000000,
+                     'delta': (t - self.t0) // 1000})
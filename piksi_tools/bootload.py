@@ -32,8 +32,14 @@ from sbp.bootload import *
 from sbp.logging import *
 from sbp.piksi import *
 from sbp.client import Handler, Framer
+from timeout import Event, backoff, TIMEOUT_GET_UNIQUE_ID
 
-class Bootloader():
+# Seconds to wait for a handshake after resetting the device before resetting
+# it again, and the factor by which the wait grows with every reset.
+RESET_PERIOD = 15.0
+RESET_BACKOFF = 1.0
+
+class Bootloader(object):
   """
   Bootloader
 
@@ -41,7 +47,8 @@ class Bootloader():
   """
   def __init__(self, link):
     self.stopped = False
-    self.handshake_received = False
+    # Set once a handshake is received.
+    self.handshake_event = Event()
     self.version = None
     # SBP version is unset in older devices.
     self.sbp_version = (0, 0)
@@ -56,6 +63,10 @@ class Bootloader():
     if not self.stopped:
       self.stop()
 
+  @property
+  def handshake_received(self):
+    return self.handshake_event.is_set()
+
   def stop(self):
     """ Remove Bootloader instance callbacks from serial link. """
     self.stopped = True
@@ -73,24 +84,32 @@ class Bootloader():
       self.version = ''.join([chr(i) for i in hs_device.handshake])
       if self.version == '':
         self.version = "Unknown"
-    self.handshake_received = True
+    self.handshake_event.set()
 
   def _handshake_callback(self, sbp_msg, **metadata):
     """ Bootloader handshake callback. """
     hs_device = MsgBootloaderHandshakeResp(sbp_msg)
     self.version = hs_device.version
     self.sbp_version = ((hs_device.flags >> 8) & 0xFF, hs_device.flags & 0xFF)
-    self.handshake_received = True
+    self.handshake_event.set()
 
-  def handshake(self, timeout=None):
+  def handshake(self, timeout=None, reset_period=RESET_PERIOD,
+                reset_backoff=RESET_BACKOFF, max_reset_period=None):
     """
     Handshake device into bootloader mode. If handshake is not received from device, attempt
-    to reset it.
+    to reset it. Returns as soon as the handshake is received.
 
     Parameters
     ==========
     timeout: int
       Time to wait before returning False.
+    reset_period : float
+      Time to wait for the handshake after the first reset before resetting
+      the device again.
+    reset_backoff : float
+      Factor by which the time waited grows with every further reset.
+    max_reset_period : float
+      Longest time to wait between resets, None for no limit.
 
     Returns
     =======
@@ -99,18 +118,16 @@ class Bootloader():
       was received.
     """
     if timeout is not None:
-      t0 = time.time()
-    self.handshake_received = False
-    expire = time.time() + 15.0
-    self.link(MsgReset())
-    while not self.handshake_received:
-      time.sleep(0.1)
+      deadline = time.time() + timeout
+    self.handshake_event.clear()
+    for period in backoff(reset_period, reset_backoff, max_reset_period):
+      self.link(MsgReset())
       if timeout is not None:
-        if time.time()-timeout > t0:
-          return False
-      if time.time() > expire:
-        expire = time.time() + 15.0
-        self.link(MsgReset())
+        period = min(period, deadline - time.time())
+      if self.handshake_event.wait(period):
+        break
+      if timeout is not None and time.time() >= deadline:
+        return False
     # < 0.45 of SBP protocol, reuse single handshake message.
     if self.sbp_version < (0, 45):
       self.link(MsgBootloaderHandshakeDepA(handshake=''))
@@ -139,6 +156,23 @@ def get_args():
   parser.add_argument('-e', '--erase',
                       help='erase sectors 1-11 of the STM flash.',
                       action="store_true")
+  parser.add_argument('-d', '--delta',
+                      help='only erase and program sectors that differ from '
+                           'the current flash contents.',
+                      action="store_true")
+  parser.add_argument('-c', '--cached-baseline',
+                      help='with -d, compare against the image last written '
+                           'to this device instead of reading back the flash.',
+                      action="store_true")
+  parser.add_argument('--no-resume',
+                      help='start over instead of resuming an interrupted '
+                           'write of the same file to this device.',
+                      action="store_true")
+  parser.add_argument('--blank-chunks',
+                      choices=['program', 'read', 'skip'], default='read',
+                      help='how to handle chunks of the file holding only '
+                           'erased bytes (0xFF): program and verify them, '
+                           'only read them back to verify, or skip them.')
   parser.add_argument('-p', '--port',
                       default=[serial_link.SERIAL_PORT], nargs=1,
                       help='specify the serial port to use.')
@@ -146,8 +180,9 @@ def get_args():
                       default=[serial_link.SERIAL_BAUD], nargs=1,
                       help="specify the baud rate to use.")
   parser.add_argument("-q", "--max-queued-ops",
-                      default=[1], nargs=1,
-                      help="Maximum number of queued operations.")
+                      default=[None], nargs=1, type=int,
+                      help="Maximum number of queued operations. Tuned "
+                           "automatically if not given.")
   parser.add_argument("-f", "--ftdi",
                       help="use pylibftdi instead of pyserial.",
                       action="store_true")
@@ -165,6 +200,12 @@ def get_args():
   elif args.erase and not args.stm:
     parser.error("The -e option requires the -s option to also be chosen")
     sys.exit(2)
+  elif args.erase and args.delta:
+    parser.error("The -e and -d options are mutually exclusive")
+    sys.exit(2)
+  elif args.cached_baseline and not args.delta:
+    parser.error("The -c option requires the -d option to also be chosen")
+    sys.exit(2)
   return args
 
 def main():
@@ -178,6 +219,8 @@ def main():
   use_m25 = args.m25
   use_stm = args.stm
   erase = args.erase
+  delta = args.delta
+  flash_type = "STM" if use_stm else "M25"
   # Driver with context
   with serial_link.get_driver(use_ftdi, port, baud) as driver:
     # Handler with context
@@ -204,18 +247,57 @@ def main():
         # Catch all other errors and exit cleanly.
         try:
           import flash
-          with flash.Flash(link, flash_type=("STM" if use_stm else "M25"),
-                           sbp_version=piksi_bootloader.sbp_version, max_queued_ops=int(args.max_queued_ops[0])) as piksi_flash:
+          with flash.Flash(link, flash_type=flash_type,
+                           sbp_version=piksi_bootloader.sbp_version, max_queued_ops=args.max_queued_ops[0]) as piksi_flash:
             if erase:
-              for s in range(1,12):
-                print "\rErasing STM Sector", s,
+              def erased_cb(n):
+                print "\rErased %d of 11 STM Sectors" % n,
                 sys.stdout.flush()
-                piksi_flash.erase_sector(s)
+              timings = piksi_flash.erase_sectors(range(1,12),
+                                                  erased_cb=erased_cb)
               print
+              print "Sector erase times (s):", \
+                    ', '.join(["%d: %.3f" % t for t in timings])
+
+            import flash_cache
+            ihx = flash_cache.load_hex_file(args.file)
+
+            # The cached image of the device's flash and the journal of
+            # interrupted writes are keyed by its STM unique ID. The cached
+            # image is dropped while the flash is being modified and only
+            # restored once the write is verified.
+            device_id = None
+            baseline = None
+            journal = None
+            if delta or not args.no_resume:
+              from stm_unique_id import STMUniqueID
+              with STMUniqueID(link) as stm_unique_id:
+                unique_id = stm_unique_id.get_id(piksi_bootloader.sbp_version,
+                                                 TIMEOUT_GET_UNIQUE_ID)
+              if unique_id is None:
+                print "No STM unique ID received, writing without cached " \
+                      "image or journal"
+              else:
+                device_id = flash_cache.device_id_str(unique_id)
+            if device_id is not None:
+              if args.cached_baseline:
+                baseline = flash_cache.load_device_image(device_id, flash_type)
+                if baseline is None:
+                  print "No cached image for device %s, reading flash" % device_id
+              flash_cache.forget_device_image(device_id, flash_type)
+            if device_id is not None and not args.no_resume:
+              journal = flash_cache.load_journal(device_id, flash_type)
+              # A full erase voids any recorded progress.
+              if erase:
+                journal.reset()
+
+            piksi_flash.write_ihx(ihx, sys.stdout, mod_print=0x10,
+                                  delta=delta, baseline=baseline,
+                                  blank_policy=args.blank_chunks,
+                                  journal=journal)
 
-            from intelhex import IntelHex
-            ihx = IntelHex(args.file)
-            piksi_flash.write_ihx(ihx, sys.stdout, mod_print=0x10)
+            if device_id is not None:
+              flash_cache.save_device_image(device_id, flash_type, ihx)
 
             print "Bootloader jumping to application"
             piksi_bootloader.jump_to_app()
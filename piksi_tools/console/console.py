@@ -47,6 +47,19 @@ def get_args():
                       default=[s.LOG_FILENAME], nargs=1,
                       help="file to log output to. If a directory is provided the "
                            "filename is autogenerated.")
+  parser.add_argument("--rotate-size", type=float,
+                      help="start a new log file every ROTATE_SIZE MB of "
+                           "messages, before compression.")
+  parser.add_argument("--rotate-time", type=float,
+                      help="start a new log file every ROTATE_TIME seconds.")
+  parser.add_argument("--compress", choices=s.COMPRESSIONS,
+                      help="compress the log file(s) as they are written.")
+  parser.add_argument("--replay",
+                      help="replay a JSON or binary log file instead of "
+                           "reading a serial port.")
+  parser.add_argument("--replay-speed", type=float, default=1.0,
+                      help="speed factor of the replay relative to the "
+                           "logged timing, 0 for as fast as possible.")
   parser.add_argument("-i", "--initloglevel",
                       default=[None], nargs=1,
                       help="Set log level filter.")
@@ -361,7 +374,7 @@ class PortChooser(HasTraits):
     except TypeError:
       pass
 
-if not port:
+if not port and not args.replay:
   port_chooser = PortChooser()
   is_ok = port_chooser.configure_traits()
   port = port_chooser.port
@@ -371,18 +384,24 @@ if not port:
   else:
     print "Using serial device '%s'" % port
 
-with s.get_driver(args.ftdi, port, baud) as driver:
+with s.get_driver(args.ftdi, port, baud, args.replay,
+                  args.replay_speed) as driver:
   with sbpc.Handler(sbpc.Framer(driver.read, driver.write, args.verbose)) as link:
     if os.path.isdir(log_filename):
       log_filename = os.path.join(log_filename, s.LOG_FILENAME)
-    with s.get_logger(args.log, log_filename) as logger:
+    with s.get_logger(args.log, log_filename,
+                      rotate_size=args.rotate_size,
+                      rotate_time=args.rotate_time,
+                      compression=args.compress) as logger:
       if args.reset:
         link(MsgReset())
-      sbpc.Forwarder(link, logger).start()
+      link.add_callback(logger)
       log_filter = DEFAULT_LOG_LEVEL_FILTER
       if args.initloglevel[0]:
         log_filter = args.initloglevel[0]
       SwiftConsole(link, args.update, log_filter).configure_traits()
+    if args.replay:
+      print driver.rate_report()
 
 # Force exit, even if threads haven't joined
 try:
@@ -11,7 +11,7 @@
 
 from urllib2 import URLError
 from time import sleep
-from intelhex import IntelHex, HexRecordError
+from intelhex import HexRecordError
 from pkg_resources import parse_version
 
 from sbp.bootload import MsgBootloaderJumpToApp
@@ -26,6 +26,9 @@ from pyface.api import GUI, FileDialog, OK, ProgressDialog
 from piksi_tools.version import VERSION as CONSOLE_VERSION
 from piksi_tools import bootload
 from piksi_tools import flash
+from piksi_tools import flash_cache
+from piksi_tools.stm_unique_id import STMUniqueID
+from piksi_tools.timeout import TIMEOUT_GET_UNIQUE_ID
 import piksi_tools.console.callback_prompt as prompt
 from piksi_tools.console.utils import determine_path
 
@@ -89,7 +92,8 @@ class IntelHexFileDialog(HasTraits):
   def load_ihx(self, filepath):
     """
     Load IntelHex file and set status to indicate if file was
-    successfully loaded.
+    successfully loaded. Files are compiled into a flash image once and
+    cached, see piksi_tools.flash_cache.load_hex_file.
 
     Parameters
     ----------
@@ -97,7 +101,7 @@ class IntelHexFileDialog(HasTraits):
       Path to IntelHex file.
     """
     try:
-      self.ihx = IntelHex(filepath)
+      self.ihx = flash_cache.load_hex_file(filepath)
       self.status = os.path.split(filepath)[1]
     except HexRecordError:
       self.clear('Error: File is not a valid Intel HEX File')
@@ -182,6 +186,7 @@ class UpdateView(HasTraits):
 
   erase_stm = Bool(True)
   erase_en = Bool(True)
+  delta_update = Bool(False)
 
   update_stm_firmware = Button(label='Update STM')
   update_nap_firmware = Button(label='Update NAP')
@@ -233,7 +238,12 @@ class UpdateView(HasTraits):
           label="Piksi Console Version", show_border=True),
           ),
       UItem('download_firmware', enabled_when='download_fw_en'),
-      UItem('update_full_firmware', enabled_when='update_en'),
+      HGroup(UItem('update_full_firmware', enabled_when='update_en', springy=True),
+             Item('delta_update', label='Only update changed sectors',
+                  enabled_when='erase_en', show_label=True,
+                  tooltip='Compare firmware with the current flash contents '
+                          'and only erase and program sectors that differ.\n'
+                          'The STM flash is not fully erased in this mode.')),
       Item(
         'stream',
         style='custom',
@@ -262,6 +272,8 @@ class UpdateView(HasTraits):
 
     }
     self.update_dl = None
+    # Bootloader session shared by the flashes updated in one go.
+    self.pk_boot = None
     self.erase_en = True
     self.stm_fw = IntelHexFileDialog('STM')
     self.stm_fw.on_trait_change(self._manage_enables, 'status')
@@ -551,38 +563,45 @@ class UpdateView(HasTraits):
       return
 
   def manage_stm_firmware_update(self):
-    # Erase all of STM's flash (other than bootloader) if box is checked.
-    if self.erase_stm:
+    self.create_flash("STM")
+    # Erase all of STM's flash (other than bootloader) if box is checked. A
+    # delta update erases only the sectors that changed instead.
+    erase_all = self.erase_stm and not self.delta_update
+    erased_sectors = None
+    if erase_all:
       text = "Erasing STM"
       self._write(text)
-      self.create_flash("STM")
       sectors_to_erase = set(range(self.pk_flash.n_sectors)).difference(set(self.pk_flash.restricted_sectors))
       progress_dialog = PulsableProgressDialog(len(sectors_to_erase), False)
       progress_dialog.title = text
       GUI.invoke_later(progress_dialog.open)
-      erase_count = 0
-      for s in sorted(sectors_to_erase):
-        progress_dialog.progress(erase_count)
-        self._write('Erasing %s sector %d' % (self.pk_flash.flash_type,s))
-        self.pk_flash.erase_sector(s)
-        erase_count += 1
-      self.stop_flash()
+      erased_sectors = sorted(sectors_to_erase)
+      timings = self.pk_flash.erase_sectors(erased_sectors,
+                                            erased_cb=progress_dialog.progress)
+      for s, seconds in timings:
+        self._write('Erased %s sector %d in %.2f s' % \
+                    (self.pk_flash.flash_type, s, seconds))
       self._write("")
       progress_dialog.close()
 
     # Flash STM.
     text = "Updating STM"
     self._write(text)
-    self.create_flash("STM")
     stm_n_ops = self.pk_flash.ihx_n_ops(self.stm_fw.ihx, \
-                                        erase = not self.erase_stm)
+                                        erase = not erase_all, \
+                                        delta = self.delta_update, \
+                                        erased_sectors = erased_sectors)
     progress_dialog = PulsableProgressDialog(stm_n_ops, True)
     progress_dialog.title = text
     GUI.invoke_later(progress_dialog.open)
     # Don't erase sectors if we've already done so above.
+    journal = self.load_journal("STM")
+    if erase_all and journal is not None:
+      journal.reset()
     self.pk_flash.write_ihx(self.stm_fw.ihx, self.stream, mod_print=0x40, \
                             elapsed_ops_cb = progress_dialog.progress, \
-                            erase = not self.erase_stm)
+                            erase = not erase_all, delta = self.delta_update, \
+                            erased_sectors = erased_sectors, journal = journal)
     self.stop_flash()
     self._write("")
     progress_dialog.close()
@@ -600,12 +619,15 @@ class UpdateView(HasTraits):
       text = "Updating NAP"
       self._write(text)
       self.create_flash("M25")
-      nap_n_ops = self.pk_flash.ihx_n_ops(self.nap_fw.ihx)
+      nap_n_ops = self.pk_flash.ihx_n_ops(self.nap_fw.ihx, \
+                                          delta = self.delta_update)
       progress_dialog = PulsableProgressDialog(nap_n_ops, True)
       progress_dialog.title = text
       GUI.invoke_later(progress_dialog.open)
       self.pk_flash.write_ihx(self.nap_fw.ihx, self.stream, mod_print=0x40, \
-                              elapsed_ops_cb = progress_dialog.progress)
+                              elapsed_ops_cb = progress_dialog.progress, \
+                              delta = self.delta_update, \
+                              journal = self.load_journal("M25"))
       self.stop_flash()
       self._write("")
       progress_dialog.close()
@@ -621,37 +643,43 @@ class UpdateView(HasTraits):
     """
     Update Piksi firmware. Erase entire STM flash (other than bootloader)
     if so directed. Flash NAP only if new firmware is available.
+
+    The device is reset into the bootloader once, when the first flash is
+    updated, and both flashes of a full update are written back-to-back in
+    that bootloader session.
     """
     self.updating = True
-    update_nap = False
     self._write('')
 
-    if device == "STM":
-      self.manage_stm_firmware_update()
-    elif device == "M25":
-      update_nap = self.manage_nap_firmware_update()
-    else:
-      self.manage_stm_firmware_update()
-      update_nap = self.manage_nap_firmware_update(check_version=True)
-
-    # Must tell Piksi to jump to application after updating firmware.
-    if device == "STM" or update_nap:
-        self.link(MsgBootloaderJumpToApp(jump=0))
-        self._write("Firmware update finished.")
-        self._write("")
-
-    self.updating = False
+    flashed = False
+    try:
+      if device == "STM":
+        self.manage_stm_firmware_update()
+      elif device == "M25":
+        self.manage_nap_firmware_update()
+      else:
+        self.manage_stm_firmware_update()
+        self.manage_nap_firmware_update(check_version=True)
+    finally:
+      # Must tell Piksi to jump to application after updating firmware. A
+      # bootloader session is only started to write a flash.
+      flashed = self.pk_boot is not None
+      if flashed:
+        self.leave_bootloader()
+      self.updating = False
+
+    if flashed:
+      self._write("Firmware update finished.")
+      self._write("")
 
-  def create_flash(self, flash_type):
+  def enter_bootloader(self):
     """
-    Create flash.Flash instance and set Piksi into bootloader mode, prompting
-    user to reset if necessary.
-
-    Parameter
-    ---------
-    flash_type : string
-      Either "STM" or "M25".
+    Set Piksi into bootloader mode, prompting user to reset if necessary,
+    unless it is already in a bootloader session started by this instance.
     """
+    if self.pk_boot is not None:
+      return
+
     # Reset device if the application is running to put into bootloader mode.
     self.link(MsgReset())
 
@@ -686,11 +714,49 @@ class UpdateView(HasTraits):
     self._write("received bootloader handshake message.")
     self._write("Piksi Onboard Bootloader Version: " + self.pk_boot.version)
 
+    # Key the journal of interrupted updates by the device's STM unique ID.
+    with STMUniqueID(self.link) as stm_unique_id:
+      unique_id = stm_unique_id.get_id(self.pk_boot.sbp_version,
+                                       TIMEOUT_GET_UNIQUE_ID)
+    if unique_id is None:
+      self._write("No STM unique ID received, interrupted updates won't be "
+                  "resumed.")
+      self.device_id = None
+    else:
+      self.device_id = flash_cache.device_id_str(unique_id)
+
+  def load_journal(self, flash_type):
+    """
+    Load the update journal of a flash of the device, None if the device's
+    unique ID isn't known.
+    """
+    if self.device_id is None:
+      return None
+    return flash_cache.load_journal(self.device_id, flash_type)
+
+  def leave_bootloader(self):
+    """
+    Tell Piksi to jump to the application and end the bootloader session.
+    """
+    self.link(MsgBootloaderJumpToApp(jump=0))
+    self.pk_boot.stop()
+    self.pk_boot = None
+
+  def create_flash(self, flash_type):
+    """
+    Create flash.Flash instance, entering the bootloader first if needed.
+
+    Parameter
+    ---------
+    flash_type : string
+      Either "STM" or "M25".
+    """
+    self.enter_bootloader()
     self.pk_flash = flash.Flash(self.link, flash_type, self.pk_boot.sbp_version)
 
   def stop_flash(self):
     """
-    Stop Flash and Bootloader instances (removes callback from SerialLink).
+    Stop Flash instance (removes callback from SerialLink). The bootloader
+    session is kept for the next flash, see self.leave_bootloader.
     """
     self.pk_flash.stop()
-    self.pk_boot.stop()
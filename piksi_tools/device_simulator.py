@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+The :mod:`piksi_tools.device_simulator` module contains a software model of
+the Piksi bootloader, flash and file system, for exercising and benchmarking
+piksi_tools.bootload, piksi_tools.flash and piksi_tools.fileio without
+hardware.
+"""
+
+import os
+import random
+import select
+import struct
+import threading
+import time
+
+from collections import deque
+
+from sbp.msg import SBP
+from sbp.bootload import *
+from sbp.file_io import *
+from sbp.flash import *
+from sbp.piksi import SBP_MSG_RESET
+from sbp.system import SBP_MSG_HEARTBEAT
+from sbp.client import Framer
+
+from flash import STM_N_SECTORS, M25_N_SECTORS, \
+                  stm_addr_sector_map, m25_addr_sector_map
+
+STM_FLASH_BASE = 0x08000000
+STM_FLASH_SIZE = 0x100000
+M25_FLASH_BASE = 0x0
+M25_FLASH_SIZE = 0x100000
+
+# Return codes sent in MSG_FLASH_DONE.
+FLASH_OK = 0
+FLASH_INVALID_FLASH = 1
+FLASH_INVALID_LEN = 2
+FLASH_INVALID_ADDR = 3
+FLASH_INVALID_RANGE = 4
+FLASH_INVALID_SECTOR = 5
+
+# Longest single wait, in seconds, on the simulated link.
+WAIT_SLICE = 0.0005
+
+# Largest number of addresses the device will program/read in one message.
+MAX_OP_LEN = 128
+
+# Largest payload of an SBP message.
+MAX_PAYLOAD_SIZE = 255
+
+class SimulatedUART(object):
+  """
+  One direction of a simulated serial link. Bytes written become readable
+  after the time they would take to be clocked out at the configured baud
+  rate (10 bits per byte). If the reader falls behind by more than
+  buffer_size bytes, newly arriving bytes are dropped, as they would be by an
+  overflowing UART RX buffer.
+
+  Parameters
+  ----------
+  baud : int
+    Baud rate to throttle the link to, or None for no throttling.
+  buffer_size : int
+    Size of the receiving end's buffer in bytes, or None for unbounded.
+  """
+
+  def __init__(self, baud=None, buffer_size=None):
+    self.baud = baud
+    self.buffer_size = buffer_size
+    self.n_dropped = 0
+    self._cond = threading.Condition()
+    self._in_flight = deque()
+    self._rx = bytearray()
+    self._line_free = 0.0
+    self._closed = False
+
+  def write(self, data):
+    """ Queue bytes for transmission. """
+    with self._cond:
+      now = time.time()
+      if self.baud:
+        start = max(now, self._line_free)
+        self._line_free = start + len(data) * 10.0 / self.baud
+      else:
+        self._line_free = now
+      self._in_flight.append((self._line_free, bytes(data)))
+      self._cond.notify_all()
+    return len(data)
+
+  def _deliver(self, now):
+    """ Move bytes that have finished transmission into the RX buffer. """
+    while self._in_flight and self._in_flight[0][0] <= now:
+      data = self._in_flight.popleft()[1]
+      if self.buffer_size is not None:
+        room = self.buffer_size - len(self._rx)
+        if room < len(data):
+          self.n_dropped += len(data) - max(room, 0)
+          data = data[:max(room, 0)]
+      self._rx += data
+
+  def read(self, size, timeout=0.01):
+    """
+    Read up to size received bytes, waiting at most timeout seconds for some
+    to arrive.
+
+    Returns
+    -------
+    out : str
+      Received bytes, empty if none arrived before the timeout.
+    """
+    with self._cond:
+      expire = time.time() + timeout
+      while True:
+        now = time.time()
+        self._deliver(now)
+        if self._rx or self._closed or now >= expire:
+          break
+        wake = expire
+        if self._in_flight:
+          wake = min(wake, self._in_flight[0][0])
+        # Wait in short slices: Python 2's Condition.wait(timeout) sleeps with
+        # an increasing backoff and would otherwise add latency to the link.
+        self._cond.wait(min(max(wake - now, 0), WAIT_SLICE))
+      data = str(self._rx[:size])
+      del self._rx[:size]
+      return data
+
+  def close(self):
+    """ Wake up any blocked reader. """
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+
+class DeviceSimulator(object):
+  """
+  Simulated Piksi that answers the SBP bootloader handshake, flash
+  erase/program/read, STM sector lock/unlock, M25 status register writes,
+  STM unique ID requests and, while running the application, file
+  read/write/remove/directory listing requests. Flash contents are modelled
+  so programming only clears bits, as on real flash, so a missing erase
+  shows up as a verification failure.
+
+  Files are held in the files dict, keyed by path. Paths containing '/'
+  are in subdirectories, which directory listings show with a trailing '/'.
+
+  Parameters
+  ----------
+  baud : int
+    Baud rate to throttle both directions of the link to, or None.
+  rx_buffer_size : int
+    Size of the device UART RX buffer in bytes, or None for unbounded.
+  op_latency : float
+    Seconds the device takes to service a program, read or file operation.
+  erase_latency : float
+    Seconds the device takes to erase a sector.
+  error_rate : float
+    Probability of answering a flash operation with an error return code.
+  drop_rate : float
+    Probability of silently dropping a received message.
+  corrupt_rate : float
+    Probability of flipping a bit in data returned by a flash read.
+  sbp_version : (int, int)
+    SBP protocol version reported in the bootloader handshake.
+  version : str
+    Bootloader version string reported in the bootloader handshake.
+  handshake_period : float
+    Seconds between bootloader handshake messages while waiting for the host.
+  heartbeat_period : float
+    Seconds between heartbeats while running the application.
+  in_bootloader : bool
+    Start in the bootloader rather than the application.
+  seed : int
+    Seed for the error injection random number generator.
+  """
+
+  def __init__(self, baud=None, rx_buffer_size=None, op_latency=0.0,
+               erase_latency=0.0, error_rate=0.0, drop_rate=0.0,
+               corrupt_rate=0.0, sbp_version=(0, 0), version="v0.1-sim",
+               handshake_period=0.1, heartbeat_period=1.0,
+               in_bootloader=False, seed=None):
+    self.host_to_device = SimulatedUART(baud, rx_buffer_size)
+    self.device_to_host = SimulatedUART(baud)
+    self.op_latency = op_latency
+    self.erase_latency = erase_latency
+    self.error_rate = error_rate
+    self.drop_rate = drop_rate
+    self.corrupt_rate = corrupt_rate
+    self.sbp_version = sbp_version
+    self.version = version
+    self.handshake_period = handshake_period
+    self.heartbeat_period = heartbeat_period
+    self.random = random.Random(seed)
+    self.stm = bytearray('\xff' * STM_FLASH_SIZE)
+    self.m25 = bytearray('\xff' * M25_FLASH_SIZE)
+    self.stm_locked = set([0])
+    self.m25_status = 0
+    self.unique_id = tuple(self.random.randint(0, 255) for i in range(12))
+    self.files = {}
+    self.stats = dict.fromkeys(['erase', 'program', 'read', 'dropped',
+                                'errors', 'handshakes', 'resets',
+                                'file_read', 'file_write', 'read_dir'], 0)
+    self._state = 'bootloader_wait' if in_bootloader else 'app'
+    self._next_beat = 0.0
+    self._stopped = False
+    self._framer = Framer(self._device_read, self.device_to_host.write)
+    self._thread = threading.Thread(target=self._run, name="DeviceSimulator")
+    self._thread.daemon = True
+    self._pty_threads = []
+    self._pty_master = None
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *args):
+    self.stop()
+
+  def start(self):
+    """ Start the simulated device. """
+    self._thread.start()
+
+  def stop(self):
+    """ Stop the simulated device and wake up any blocked reads. """
+    self._stopped = True
+    self._framer.breakiter()
+    self.host_to_device.close()
+    self.device_to_host.close()
+    self._thread.join(1.0)
+    for t in self._pty_threads:
+      t.join(1.0)
+    if self._pty_master is not None:
+      os.close(self._pty_master)
+      self._pty_master = None
+
+  # Host side of the link, usable in place of a driver's read/write.
+
+  def read(self, size):
+    """ Read bytes sent by the device to the host. """
+    return self.device_to_host.read(size)
+
+  def write(self, data):
+    """ Write bytes from the host to the device. """
+    return self.host_to_device.write(data)
+
+  def flush(self):
+    pass
+
+  def close(self):
+    self.stop()
+
+  def serve_pty(self):
+    """
+    Expose the simulated device on a pseudo terminal, so tools that open a
+    serial port can be pointed at it.
+
+    Returns
+    -------
+    out : str
+      Path of the slave end of the pseudo terminal.
+    """
+    import tty
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    self._pty_master = master
+    def to_device():
+      while not self._stopped:
+        if not select.select([master], [], [], 0.1)[0]:
+          continue
+        try:
+          data = os.read(master, 4096)
+        except OSError:
+          return
+        self.write(data)
+    def to_host():
+      while not self._stopped:
+        data = self.read(4096)
+        if data:
+          try:
+            os.write(master, data)
+          except OSError:
+            return
+    for target in (to_device, to_host):
+      t = threading.Thread(target=target, name="DeviceSimulator pty")
+      t.daemon = True
+      t.start()
+      self._pty_threads.append(t)
+    return os.ttyname(slave)
+
+  # Device side.
+
+  def flash(self, target):
+    """
+    Get the contents and base address of a flash.
+
+    Parameters
+    ----------
+    target : int
+      Flash target byte (0 for STM, 1 for M25).
+
+    Returns
+    -------
+    out : (bytearray, int)
+      Flash contents and address of the first byte.
+    """
+    if target == 0:
+      return self.stm, STM_FLASH_BASE
+    elif target == 1:
+      return self.m25, M25_FLASH_BASE
+    raise ValueError("Invalid flash target %d" % target)
+
+  def _device_read(self, size):
+    self._tick()
+    return self.host_to_device.read(size, 0.05)
+
+  def _send(self, msg_type, payload):
+    self._framer(SBP(msg_type, payload=payload))
+
+  def _run(self):
+    for msg, metadata in self._framer:
+      if self.drop_rate and self.random.random() < self.drop_rate:
+        self.stats['dropped'] += 1
+        continue
+      self._handle(msg)
+
+  def _tick(self):
+    """ Send periodic handshake/heartbeat messages. """
+    now = time.time()
+    if now < self._next_beat:
+      return
+    if self._state == 'bootloader_wait':
+      flags = (self.sbp_version[0] << 8) | self.sbp_version[1]
+      self._send(SBP_MSG_BOOTLOADER_HANDSHAKE_RESP,
+                 struct.pack("<I", flags) + self.version)
+      self._next_beat = now + self.handshake_period
+    elif self._state == 'app':
+      flags = (self.sbp_version[0] << 16) | (self.sbp_version[1] << 8)
+      self._send(SBP_MSG_HEARTBEAT, struct.pack("<I", flags))
+      self._next_beat = now + self.heartbeat_period
+
+  def _done(self, ret):
+    if ret == FLASH_OK and self.error_rate and \
+        self.random.random() < self.error_rate:
+      ret = FLASH_INVALID_RANGE
+    if ret != FLASH_OK:
+      self.stats['errors'] += 1
+    self._send(SBP_MSG_FLASH_DONE, struct.pack("B", ret))
+
+  def _decode_op(self, msg):
+    """
+    Decode target, address, length and data of a program/read request in
+    either the pre-0.45 (4 byte address) or current (3 byte address offset)
+    encoding.
+    """
+    p = msg.payload
+    if msg.msg_type in (SBP_MSG_FLASH_DONE, SBP_MSG_FLASH_READ_RESP):
+      target, addr, length = struct.unpack("<BIB", p[:6])
+      return target, addr, length, p[6:]
+    target = ord(p[0])
+    addr = struct.unpack("<I", p[1:4] + '\0')[0]
+    if target == 0 and addr < STM_FLASH_BASE:
+      addr += STM_FLASH_BASE
+    return target, addr, ord(p[4]), p[5:]
+
+  def _sector_locked(self, target, addr):
+    return target == 0 and stm_addr_sector_map(addr) in self.stm_locked
+
+  def _handle(self, msg):
+    t = msg.msg_type
+    if t == SBP_MSG_RESET:
+      self.stats['resets'] += 1
+      self._state = 'bootloader_wait'
+      self._next_beat = 0.0
+    elif t in (SBP_MSG_BOOTLOADER_HANDSHAKE_REQ,
+               SBP_MSG_BOOTLOADER_HANDSHAKE_DEP_A):
+      if self._state == 'bootloader_wait':
+        self.stats['handshakes'] += 1
+        self._state = 'bootloader'
+    elif t == SBP_MSG_BOOTLOADER_JUMP_TO_APP:
+      self._state = 'app'
+      self._next_beat = 0.0
+    elif t == SBP_MSG_FLASH_ERASE:
+      target, sector = struct.unpack("<BI", msg.payload[:5])
+      self._erase(target, sector)
+    elif t in (SBP_MSG_FLASH_DONE, SBP_MSG_FLASH_PROGRAM) and \
+        self._state != 'app':
+      self._program(*self._decode_op(msg))
+    elif t in (SBP_MSG_FLASH_READ_RESP, SBP_MSG_FLASH_READ_REQ) and \
+        self._state != 'app':
+      self._read(*self._decode_op(msg)[:3])
+    elif t in (SBP_MSG_STM_FLASH_LOCK_SECTOR, SBP_MSG_STM_FLASH_UNLOCK_SECTOR):
+      sector = struct.unpack("<I", msg.payload[:4])[0]
+      if sector >= STM_N_SECTORS:
+        self._done(FLASH_INVALID_SECTOR)
+        return
+      if t == SBP_MSG_STM_FLASH_LOCK_SECTOR:
+        self.stm_locked.add(sector)
+      else:
+        self.stm_locked.discard(sector)
+      self._done(FLASH_OK)
+    elif t == SBP_MSG_M25_FLASH_WRITE_STATUS:
+      self.m25_status = ord(msg.payload[0])
+      self._done(FLASH_OK)
+    elif t in (SBP_MSG_STM_UNIQUE_ID_REQ, SBP_MSG_STM_UNIQUE_ID_RESP):
+      self._send(SBP_MSG_STM_UNIQUE_ID_RESP,
+                 struct.pack("<12B", *self.unique_id))
+    elif t == SBP_MSG_FILEIO_READ_REQ and self._state == 'app':
+      seq, offset, chunk_size = struct.unpack("<IIB", msg.payload[:9])
+      self._file_read(seq, offset, chunk_size, msg.payload[9:].rstrip('\0'))
+    elif t == SBP_MSG_FILEIO_READ_DIR_REQ and self._state == 'app':
+      seq, offset = struct.unpack("<II", msg.payload[:8])
+      self._read_dir(seq, offset, msg.payload[8:].rstrip('\0'))
+    elif t == SBP_MSG_FILEIO_WRITE_REQ and self._state == 'app':
+      seq, offset = struct.unpack("<II", msg.payload[:8])
+      filename, data = msg.payload[8:].split('\0', 1)
+      self._file_write(seq, offset, filename, data)
+    elif t == SBP_MSG_FILEIO_REMOVE and self._state == 'app':
+      self.files.pop(msg.payload.rstrip('\0'), None)
+
+  def _erase(self, target, sector):
+    self.stats['erase'] += 1
+    if self.erase_latency:
+      time.sleep(self.erase_latency)
+    if target == 0:
+      if sector >= STM_N_SECTORS:
+        return self._done(FLASH_INVALID_SECTOR)
+      if sector in self.stm_locked:
+        return self._done(FLASH_INVALID_RANGE)
+      addrs = [a for a in range(STM_FLASH_BASE, STM_FLASH_BASE + STM_FLASH_SIZE,
+                                0x4000) if stm_addr_sector_map(a) == sector]
+      start, end = addrs[0], addrs[-1] + 0x4000
+    elif target == 1:
+      if sector >= M25_N_SECTORS:
+        return self._done(FLASH_INVALID_SECTOR)
+      start, end = sector << 16, (sector + 1) << 16
+    else:
+      return self._done(FLASH_INVALID_FLASH)
+    mem, base = self.flash(target)
+    mem[start - base:end - base] = '\xff' * (end - start)
+    self._done(FLASH_OK)
+
+  def _check_range(self, target, addr, length):
+    if target not in (0, 1):
+      return FLASH_INVALID_FLASH
+    if length > MAX_OP_LEN:
+      return FLASH_INVALID_LEN
+    sector_map = stm_addr_sector_map if target == 0 else m25_addr_sector_map
+    try:
+      sector_map(addr)
+      sector_map(addr + length - 1)
+    except IndexError:
+      return FLASH_INVALID_ADDR
+    return FLASH_OK
+
+  def _program(self, target, addr, length, data):
+    self.stats['program'] += 1
+    if self.op_latency:
+      time.sleep(self.op_latency)
+    ret = self._check_range(target, addr, length)
+    if ret != FLASH_OK:
+      return self._done(ret)
+    if self._sector_locked(target, addr) or \
+        self._sector_locked(target, addr + length - 1):
+      return self._done(FLASH_INVALID_RANGE)
+    mem, base = self.flash(target)
+    offset = addr - base
+    for i, b in enumerate(bytearray(data[:length])):
+      mem[offset + i] &= b
+    self._done(FLASH_OK)
+
+  def _read(self, target, addr, length):
+    self.stats['read'] += 1
+    if self.op_latency:
+      time.sleep(self.op_latency)
+    ret = self._check_range(target, addr, length)
+    if ret != FLASH_OK:
+      return self._done(ret)
+    mem, base = self.flash(target)
+    data = mem[addr - base:addr - base + length]
+    if self.corrupt_rate and self.random.random() < self.corrupt_rate:
+      data[self.random.randrange(length)] ^= 1 << self.random.randrange(8)
+    self._send(SBP_MSG_FLASH_READ_RESP,
+               struct.pack("<IB", addr, length) + str(data))
+
+  def _file_read(self, seq, offset, chunk_size, filename):
+    self.stats['file_read'] += 1
+    if self.op_latency:
+      time.sleep(self.op_latency)
+    data = self.files.get(filename, '')
+    length = min(chunk_size, MAX_PAYLOAD_SIZE - 4)
+    self._send(SBP_MSG_FILEIO_READ_RESP,
+               struct.pack("<I", seq) + str(data[offset:offset + length]))
+
+  def _file_write(self, seq, offset, filename, data):
+    self.stats['file_write'] += 1
+    if self.op_latency:
+      time.sleep(self.op_latency)
+    contents = self.files.setdefault(filename, bytearray())
+    if len(contents) < offset:
+      contents.extend('\0' * (offset - len(contents)))
+    contents[offset:offset + len(data)] = data
+    self._send(SBP_MSG_FILEIO_WRITE_RESP, struct.pack("<I", seq))
+
+  def _read_dir(self, seq, offset, dirname):
+    self.stats['read_dir'] += 1
+    if self.op_latency:
+      time.sleep(self.op_latency)
+    prefix = dirname.strip('/') + '/' if dirname.strip('/.') else ''
+    entries = set()
+    for path in self.files:
+      if path.startswith(prefix):
+        name = path[len(prefix):]
+        entries.add(name.split('/')[0] + '/' if '/' in name else name)
+    contents = ''
+    for name in sorted(entries)[offset:]:
+      if len(contents) + len(name) + 1 > MAX_PAYLOAD_SIZE - 4:
+        break
+      contents += name + '\0'
+    self._send(SBP_MSG_FILEIO_READ_DIR_RESP, struct.pack("<I", seq) + contents)
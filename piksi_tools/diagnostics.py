@@ -20,6 +20,13 @@ from sbp.piksi          import *
 from sbp.settings       import *
 from sbp.system         import *
 from sbp.logging        import *
+from timeout            import Event, backoff
+
+# Seconds between resends of the first settings read request, and between
+# resets of the device while waiting for its bootloader handshake.
+SETTINGS_RETRY_PERIOD = 15.0
+RESET_PERIOD = 10.0
+RESET_BACKOFF = 1.0
 
 DIAGNOSTICS_FILENAME = "diagnostics.yaml"
 
@@ -29,13 +36,33 @@ class Diagnostics(object):
 
   The :class:`Diagnostics` class collects devices diagnostics.
   """
-  def __init__(self, link, timeout=None):
+  def __init__(self, link, timeout=None, reset_period=RESET_PERIOD,
+               reset_backoff=RESET_BACKOFF, max_reset_period=None):
+    """
+    Collect the diagnostics of a device: wait for its heartbeat, read its
+    settings, then reset it to get its bootloader version and jump back to
+    the application. Each step continues as soon as its message arrives.
+
+    Parameters
+    ==========
+    link : sbp.client.handler.Handler
+      Handler to send messages to Piksi over and register callbacks with.
+    timeout : float
+      Seconds to wait for all of the diagnostics, None to wait forever.
+    reset_period : float
+      Seconds to wait for the bootloader handshake after the first reset
+      before resetting the device again.
+    reset_backoff : float
+      Factor by which the time waited grows with every further reset.
+    max_reset_period : float
+      Longest time to wait between resets, None for no limit.
+    """
     self.diagnostics = {}
     self.diagnostics['versions'] = {}
     self.diagnostics['settings'] = {}
-    self.settings_received = False
-    self.heartbeat_received = False
-    self.handshake_received = False
+    self.settings_event = Event()
+    self.heartbeat_event = Event()
+    self.handshake_event = Event()
     self.sbp_version = (0, 0)
     self.link = link
     self.link.add_callback(self._settings_callback,
@@ -51,40 +78,62 @@ class Diagnostics(object):
                            SBP_MSG_BOOTLOADER_HANDSHAKE_RESP)
     self.link.add_callback(self._print_callback,
                            [SBP_MSG_LOG, SBP_MSG_PRINT_DEP])
-    timeout = time.time() + timeout if timeout is not None else None
+    deadline = time.time() + timeout if timeout is not None else None
     # Wait for the heartbeat
-    while not self.heartbeat_received:
-      time.sleep(0.1)
-      if timeout is not None and time.time() > timeout:
-        print "timeout waiting for heartbeat"
-        return
+    if not self._wait(self.heartbeat_event, deadline):
+      print "timeout waiting for heartbeat"
+      return
     # Wait for the settings
     print "received heartbeat"
-    expire = time.time() + 15.0
-    self.link(MsgSettingsReadByIndexReq(index=0))
-    while not self.settings_received:
-      time.sleep(0.1)
-      if time.time() > expire:
-        expire = time.time() + 15.0
-        self.link(MsgSettingsReadByIndexReq(index=0))
-      if timeout is not None and time.time() > timeout:
-        print "timeout waiting for settings"
-        return
+    if not self._wait(self.settings_event, deadline,
+                      lambda: self.link(MsgSettingsReadByIndexReq(index=0)),
+                      backoff(SETTINGS_RETRY_PERIOD)):
+      print "timeout waiting for settings"
+      return
 
     # Wait for the handshake
     print "received settings"
-    expire = time.time() + 10.0
-    self.link(MsgReset())
-    while not self.handshake_received:
-      time.sleep(0.1)
-      if time.time() > expire:
-        expire = time.time() + 10.0
-        self.link(MsgReset())
-      if timeout is not None and time.time() > timeout:
-        print "timeout waiting for handshake"
-        return
+    if not self._wait(self.handshake_event, deadline,
+                      lambda: self.link(MsgReset()),
+                      backoff(reset_period, reset_backoff, max_reset_period)):
+      print "timeout waiting for handshake"
+      return
     print "received bootloader handshake"
 
+  @property
+  def settings_received(self):
+    return self.settings_event.is_set()
+
+  @property
+  def heartbeat_received(self):
+    return self.heartbeat_event.is_set()
+
+  @property
+  def handshake_received(self):
+    return self.handshake_event.is_set()
+
+  def _wait(self, event, deadline, request=None, periods=None):
+    """
+    Wait for an event, sending a request and repeating it after every period
+    until the event is set.
+
+    Returns
+    =======
+    out : bool
+      Whether the event was set before the deadline.
+    """
+    for period in periods or [None]:
+      if request is not None:
+        request()
+      if deadline is not None:
+        remaining = deadline - time.time()
+        period = remaining if period is None else min(period, remaining)
+      if event.wait(period):
+        return True
+      if deadline is not None and time.time() >= deadline:
+        return False
+    return False
+
   def _print_callback(self, msg, **metadata):
     print msg.text
 
@@ -93,24 +142,24 @@ class Diagnostics(object):
       self.diagnostics['versions']['bootloader'] = "v0.1"
     else:
       self.diagnostics['versions']['bootloader'] = sbp_msg.payload
-    self.handshake_received = True
+    self.handshake_event.set()
     self.link(MsgBootloaderJumpToApp(jump=0))
 
   def _handshake_callback(self, sbp_msg, **metadata):
     msg = MsgBootloaderHandshakeDevice(sbp_msg)
     self.diagnostics['versions']['bootloader'] = msg.version
-    self.handshake_received = True
+    self.handshake_event.set()
     self.link(MsgBootloaderJumpToApp(jump=0))
 
   def _heartbeat_callback(self, sbp_msg, **metadata):
     msg = MsgHeartbeat(sbp_msg)
     self.sbp_version = (msg.flags >> 16) & 0xFF, (msg.flags >> 8) & 0xFF
     self.diagnostics['versions']['sbp'] = '%d.%d' % self.sbp_version
-    self.heartbeat_received = True
+    self.heartbeat_event.set()
 
   def _settings_callback(self, sbp_msg, **metadata):
     if not sbp_msg.payload:
-      self.settings_received = True
+      self.settings_event.set()
     else:
       section, setting, value, format_type = sbp_msg.payload[2:].split('\0')[:4]
       if not self.diagnostics['settings'].has_key(section):
@@ -120,7 +169,7 @@ class Diagnostics(object):
       self.link(MsgSettingsReadByIndexReq(index=index+1))
 
   def _settings_done_callback(self, sbp_msg, **metadata):
-    self.settings_received = True
+    self.settings_event.set()
 
 
 def parse_device_details_yaml(device_details):
@@ -12,24 +12,305 @@
 import serial_link
 import random
 import array
+import copy
+import struct
+import sys
+import threading
+import time
 
 from sbp.file_io import *
 from sbp.client import *
+from timeout import Event
 
 MAX_PAYLOAD_SIZE = 255
+# Largest number of bytes of a file returned by one read reply, after the
+# 4 byte sequence number.
+READ_CHUNK_SIZE = MAX_PAYLOAD_SIZE - 4
+# Seconds to wait for the reply to a request.
+REPLY_TIMEOUT = 1.0
+# Number of times a request is resent before giving up.
+REQUEST_RETRIES = 3
+# Default number of requests kept in flight by pipelined transfers.
+DEFAULT_WINDOW = 8
+# Seconds a directory tree returned by FileIO.walk is reused for.
+WALK_CACHE_TTL = 5.0
+
+def join_path(dirname, name):
+  """ Path on the device of a file or directory in a directory. """
+  if dirname.strip('/.') == '':
+    return name
+  return dirname.rstrip('/') + '/' + name
+
+def tree_files(tree, prefix=''):
+  """
+  Paths and sizes of the files in a directory tree returned by FileIO.walk.
+
+  Parameters
+  ----------
+  tree : dict
+      Directory tree.
+  prefix : str (optional)
+      Prefix of the returned paths.
+
+  Returns
+  -------
+  out : [(str, int)]
+      Path, relative to the root of the tree, and size, or None if unknown,
+      of each file, sorted by path.
+  """
+  files = [(prefix + name, size) for name, size in tree['files'].items()]
+  for name, subtree in tree['dirs'].items():
+    files += tree_files(subtree, prefix + name + '/')
+  return sorted(files)
+
+class RequestWindow(object):
+  """
+  Requests in flight on a link, matched to their replies by sequence number.
+
+  The device answers requests in the order it receives them, so a reply to
+  a request means any request sent before it that is still unanswered was
+  lost, and it is resent straight away. Requests are also resent if no reply
+  at all arrives for REPLY_TIMEOUT seconds, up to REQUEST_RETRIES times.
+
+  Parameters
+  ----------
+  link : sbp.client.handler.Handler
+      Link to send requests over and receive replies from.
+  reply_type : int
+      Message type of the replies.
+  name : str
+      Name of the request, for error messages.
+  """
+
+  def __init__(self, link, reply_type, name):
+    self.link = link
+    self.reply_type = reply_type
+    self.name = name
+    self.n_sent = 0
+    self.n_retries = 0
+    self.latencies = []
+    self._lock = threading.Lock()
+    self._event = Event()
+    # seq -> [key, msg, t_sent, send index, tries, lost]
+    self._pending = {}
+    self._replies = []
+    self._t_reply = 0.0
+
+  def __enter__(self):
+    self.link.add_callback(self._callback, self.reply_type)
+    return self
+
+  def __exit__(self, *args):
+    self.link.remove_callback(self._callback, self.reply_type)
+
+  def __len__(self):
+    return len(self._pending)
+
+  def send(self, key, msg):
+    """
+    Send a request.
+
+    Parameters
+    ----------
+    key : object
+        Returned with the reply to identify the request, e.g. its offset.
+    msg : sbp.msg.SBP
+        Request, with a sequence number distinct from the other requests in
+        flight.
+    """
+    with self._lock:
+      self._pending[msg.sequence] = [key, msg, time.time(), self.n_sent, 1,
+                                     False]
+      self.n_sent += 1
+    self.link(msg)
+
+  def discard(self, keep):
+    """
+    Stop waiting for the replies to some requests.
+
+    Parameters
+    ----------
+    keep : function
+        Called with the key of each request in flight, returns False for the
+        requests to discard.
+    """
+    with self._lock:
+      for seq, request in self._pending.items():
+        if not keep(request[0]):
+          del self._pending[seq]
+
+  def poll(self):
+    """
+    Resend the requests that were lost or timed out.
+
+    Returns
+    -------
+    out : [(object, str)]
+        Key and payload after the sequence number of each reply received
+        since the last call, in order of arrival.
+    """
+    now = time.time()
+    resend = []
+    with self._lock:
+      replies, self._replies = self._replies, []
+      self._event.clear()
+      for request in self._pending.values():
+        if request[5] or now >= max(request[2], self._t_reply) + REPLY_TIMEOUT:
+          if request[4] > REQUEST_RETRIES:
+            raise Exception("Timeout waiting for %s reply" % self.name)
+          request[2:] = [now, self.n_sent, request[4] + 1, False]
+          self.n_sent += 1
+          self.n_retries += 1
+          resend.append(request[1])
+    for msg in resend:
+      self.link(msg)
+    return replies
+
+  def wait(self):
+    """
+    Wait for a reply, or for the next request to time out.
+    """
+    with self._lock:
+      if not self._pending:
+        return
+      deadline = max(min([r[2] for r in self._pending.values()]),
+                     self._t_reply) + REPLY_TIMEOUT
+    self._event.wait(max(0.0, deadline - time.time()))
+
+  def _callback(self, sbp_msg, **metadata):
+    seq = struct.unpack('<I', sbp_msg.payload[:4])[0]
+    with self._lock:
+      request = self._pending.pop(seq, None)
+      if request is None:
+        return
+      for other in self._pending.values():
+        if other[3] < request[3]:
+          other[5] = True
+      self._replies.append((request[0], sbp_msg.payload[4:]))
+      self._t_reply = time.time()
+      self.latencies.append(self._t_reply - request[2])
+      self._event.set()
 
 class FileIO(object):
-  def __init__(self, link):
+  def __init__(self, link, window=DEFAULT_WINDOW):
     self.link = link
+    self.window = window
+    self.stats = None
     self._seq = random.randint(0, 0xffffffff)
+    self._walk_cache = {}
 
   def next_seq(self):
-    self._seq += 1
+    self._seq = (self._seq + 1) & 0xffffffff
     return self._seq
 
+  def _record_stats(self, requests, elapsed, n_bytes):
+    """ Record the statistics of a transfer in self.stats. """
+    latencies = requests.latencies or [0.0]
+    self.stats = {
+      'bytes': n_bytes,
+      'seconds': elapsed,
+      'requests': requests.n_sent,
+      'retries': requests.n_retries,
+      'latency_mean': sum(latencies) / len(latencies),
+      'latency_max': max(latencies),
+    }
+
+  def throughput_report(self):
+    """
+    Describe the throughput and request latency of the last read or write.
+
+    Returns
+    -------
+    out : str
+    """
+    s = self.stats
+    return "%d bytes in %.2f s (%.1f kB/s), %d requests, %d retries, " \
+           "latency %.1f ms mean, %.1f ms max" % \
+           (s['bytes'], s['seconds'],
+            s['bytes'] / 1024.0 / max(s['seconds'], 1e-3), s['requests'],
+            s['retries'], 1000 * s['latency_mean'], 1000 * s['latency_max'])
+
+  def read_chunks(self, filename, progress_cb=None):
+    """
+    Read the contents of a file as it arrives, keeping up to self.window read
+    requests in flight at consecutive offsets. Only the chunks received
+    ahead of the next one due are held in memory. Statistics of the transfer
+    are left in self.stats once the file has been read.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file to read.
+    progress_cb : function (optional)
+        Called with the number of bytes read so far after each chunk.
+
+    Returns
+    -------
+    out : generator
+        Consecutive chunks of the file, as str.
+    """
+    start_time = time.time()
+    chunks = {}
+    offset = 0
+    n_read = 0
+    eof = None
+    with RequestWindow(self.link, SBP_MSG_FILEIO_READ_RESP,
+                       "FILEIO_READ") as requests:
+      while True:
+        for chunk_offset, chunk in requests.poll():
+          chunks[chunk_offset] = chunk
+          # A short chunk ends the file.
+          if len(chunk) < READ_CHUNK_SIZE and \
+              (eof is None or chunk_offset + len(chunk) < eof):
+            eof = chunk_offset + len(chunk)
+        if eof is not None:
+          requests.discard(lambda o: o < eof)
+        while n_read in chunks and (eof is None or n_read < eof):
+          chunk = chunks.pop(n_read)
+          n_read += len(chunk)
+          yield chunk
+          if progress_cb is not None:
+            progress_cb(n_read)
+        if n_read == eof:
+          break
+        while eof is None and len(requests) < self.window:
+          msg = MsgFileioReadReq(sequence=self.next_seq(),
+                                 offset=offset,
+                                 chunk_size=READ_CHUNK_SIZE,
+                                 filename=filename)
+          requests.send(offset, msg)
+          offset += READ_CHUNK_SIZE
+        requests.wait()
+    self._record_stats(requests, time.time() - start_time, n_read)
+
+  def read_into(self, filename, fileobj, progress_cb=None):
+    """
+    Read a file into a file-like object, writing each chunk as it arrives
+    so the file never has to fit in memory.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file to read.
+    fileobj : file
+        Object with a write method, e.g. a local file or a socket's makefile.
+    progress_cb : function (optional)
+        Called with the number of bytes read so far after each chunk.
+
+    Returns
+    -------
+    out : int
+        Size of the file.
+    """
+    n_read = 0
+    for chunk in self.read_chunks(filename, progress_cb):
+      fileobj.write(chunk)
+      n_read += len(chunk)
+    return n_read
+
   def read(self, filename):
     """
-    Read the contents of a file.
+    Read the contents of a file, see read_chunks.
 
     Parameters
     ----------
@@ -38,29 +319,42 @@ class FileIO(object):
 
     Returns
     -------
-    out : str
+    out : bytearray
         Contents of the file.
     """
-    chunksize = MAX_PAYLOAD_SIZE
-    seq = self.next_seq()
-    buf = []
-    while True:
-      msg = MsgFileioReadReq(sequence=seq,
-                             offset=len(buf),
-                             chunk_size=chunksize,
-                             filename=filename)
-      self.link(msg)
-      reply = self.link.wait(SBP_MSG_FILEIO_READ_RESP, timeout=1.0)
-      if not reply:
-        raise Exception("Timeout waiting for FILEIO_READ reply")
-      # Why isn't this already decoded?
-      reply = MsgFileioReadResp(reply)
-      if reply.sequence != seq:
-        raise Exception("Reply FILEIO_READ doesn't match request")
-      chunk = reply.contents
-      buf += chunk
-      if len(chunk) == 0:
-        return bytearray(buf)
+    return bytearray(''.join(self.read_chunks(filename)))
+
+  def has_size(self, filename, size):
+    """
+    Check the size of a file with a single read request, without reading
+    its contents. A missing file has size 0.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file to check.
+    size : int
+        Expected size of the file.
+
+    Returns
+    -------
+    out : bool
+        Whether the file is size bytes long.
+    """
+    # Asking for 2 bytes from the last expected one returns 1 byte only if
+    # the file ends right there.
+    msg = MsgFileioReadReq(sequence=self.next_seq(),
+                           offset=max(size - 1, 0),
+                           chunk_size=2,
+                           filename=filename)
+    with RequestWindow(self.link, SBP_MSG_FILEIO_READ_RESP,
+                       "FILEIO_READ") as requests:
+      requests.send(None, msg)
+      replies = requests.poll()
+      while not replies:
+        requests.wait()
+        replies = requests.poll()
+    return len(replies[0][1]) == min(size, 1)
 
   def readdir(self, dirname='.'):
     """
@@ -74,26 +368,156 @@ class FileIO(object):
     Returns
     -------
     out : [str]
-        List of file names.
-    """
-    files = []
-    seq = self.next_seq()
-    while True:
-      msg = MsgFileioReadDirReq(sequence=seq,
-                                offset=len(files),
-                                dirname=dirname)
-      self.link(msg)
-      reply = self.link.wait(SBP_MSG_FILEIO_READ_DIR_RESP, timeout=1.0)
-      if not reply:
-        raise Exception("Timeout waiting for FILEIO_READ_DIR reply")
-      # Why isn't this already decoded?
-      reply = MsgFileioReadDirResp(reply)
-      if reply.sequence != seq:
-        raise Exception("Reply FILEIO_READ_DIR doesn't match request")
-      chunk = str(bytearray(reply.contents)).rstrip('\0')
-      if len(chunk) == 0:
-        return files
-      files += chunk.split('\0')
+        List of file names. Names of subdirectories end in '/'.
+    """
+    return self._list_dirs([dirname])[dirname]
+
+  def walk(self, dirname='.', sizes=False, ttl=WALK_CACHE_TTL):
+    """
+    List a directory and all its subdirectories. Up to self.window
+    directories are listed at once, each with its own sequence numbers.
+    Trees are reused for ttl seconds, unless files are written or removed
+    through this FileIO in the meantime.
+
+    Parameters
+    ----------
+    dirname : str (optional)
+        Name of the directory to list. Defaults to the root directory.
+    sizes : bool (optional)
+        Find the size of each file. The device has no request for the size
+        of a file, so it is found by bisection with a few reads at chosen
+        offsets, see file_sizes.
+    ttl : float (optional)
+        Seconds a cached tree is reused for, 0 to always list again.
+
+    Returns
+    -------
+    out : dict
+        Tree of the directory: 'files' maps the name of each file to its
+        size, or None if sizes is False, and 'dirs' maps the name of each
+        subdirectory to its own tree, see tree_files.
+    """
+    key = (dirname, sizes)
+    cached = self._walk_cache.get(key)
+    if cached is not None and time.time() - cached[0] < ttl:
+      return copy.deepcopy(cached[1])
+    listings = self._list_dirs([dirname], recursive=True)
+    file_sizes = {}
+    if sizes:
+      file_sizes = self.file_sizes([join_path(d, name)
+                                    for d, names in listings.items()
+                                    for name in names
+                                    if not name.endswith('/')])
+    def tree(d):
+      t = {'files': {}, 'dirs': {}}
+      for name in listings[d]:
+        if name.endswith('/'):
+          t['dirs'][name[:-1]] = tree(join_path(d, name[:-1]))
+        else:
+          t['files'][name] = file_sizes.get(join_path(d, name))
+      return t
+    result = tree(dirname)
+    self._walk_cache[key] = (time.time(), result)
+    return copy.deepcopy(result)
+
+  def _list_dirs(self, dirnames, recursive=False):
+    """
+    List directories, keeping requests for up to self.window of them in
+    flight. The listing of each directory is paged, so requests for the
+    same directory are made one at a time.
+
+    Parameters
+    ----------
+    dirnames : [str]
+        Names of the directories to list.
+    recursive : bool (optional)
+        Also list all their subdirectories.
+
+    Returns
+    -------
+    out : dict
+        Names in each directory listed, by directory name.
+    """
+    listings = dict([(d, []) for d in dirnames])
+    todo = list(dirnames)
+    with RequestWindow(self.link, SBP_MSG_FILEIO_READ_DIR_RESP,
+                       "FILEIO_READ_DIR") as requests:
+      while True:
+        for d, contents in requests.poll():
+          names = [n for n in contents.split('\0') if n]
+          if not names:
+            continue
+          listings[d] += names
+          todo.insert(0, d)
+          if recursive:
+            for name in names:
+              subdir = join_path(d, name[:-1])
+              if name.endswith('/') and subdir not in listings:
+                listings[subdir] = []
+                todo.append(subdir)
+        while todo and len(requests) < self.window:
+          d = todo.pop(0)
+          requests.send(d, MsgFileioReadDirReq(sequence=self.next_seq(),
+                                               offset=len(listings[d]),
+                                               dirname=d))
+        if not len(requests):
+          return listings
+        requests.wait()
+
+  def file_sizes(self, filenames):
+    """
+    Find the sizes of files without reading them, keeping a read request
+    for up to self.window of them in flight.
+
+    A read of READ_CHUNK_SIZE bytes at an offset returns a short chunk only
+    if the file ends within it, and an empty one if the file ends before
+    it, so each size is found from the lengths of the replies to reads at
+    doubling offsets then by bisection, in about 2 * log2(size /
+    READ_CHUNK_SIZE) requests.
+
+    Parameters
+    ----------
+    filenames : [str]
+        Names of the files. A missing file has size 0.
+
+    Returns
+    -------
+    out : dict
+        Size of each file, by name.
+    """
+    sizes = {}
+    # Each size is at least lo and at most hi, None until known.
+    bounds = dict([(f, [0, None]) for f in filenames])
+    todo = [(f, 0) for f in bounds]
+    with RequestWindow(self.link, SBP_MSG_FILEIO_READ_RESP,
+                       "FILEIO_READ") as requests:
+      while True:
+        for (f, offset), chunk in requests.poll():
+          b = bounds[f]
+          if 0 < len(chunk) < READ_CHUNK_SIZE:
+            b[:] = [offset + len(chunk)] * 2
+          elif chunk:
+            b[0] = offset + len(chunk)
+          else:
+            b[1] = offset
+          if b[1] is not None and b[0] >= b[1]:
+            sizes[f] = b[1]
+          elif b[1] is None:
+            todo.append((f, 2 * b[0]))
+          elif b[1] - b[0] <= READ_CHUNK_SIZE:
+            todo.append((f, b[0]))
+          else:
+            todo.append((f, (b[0] + b[1]) // 2))
+        while todo and len(requests) < self.window:
+          f, offset = todo.pop(0)
+          requests.send((f, offset),
+                        MsgFileioReadReq(sequence=self.next_seq(),
+                                         offset=offset,
+                                         chunk_size=READ_CHUNK_SIZE,
+                                         filename=f))
+        if not len(requests):
+          return sizes
+        requests.wait()
 
   def remove(self, filename):
     """
@@ -106,17 +530,19 @@ class FileIO(object):
     """
     msg = MsgFileioRemove(filename=filename)
     self.link(msg)
+    self._walk_cache.clear()
 
   def write(self, filename, data, offset=0, trunc=True):
     """
-    Write to a file.
+    Write to a file, keeping up to self.window write requests in flight at
+    consecutive offsets. Statistics of the transfer are left in self.stats.
 
     Parameters
     ----------
     filename : str
         Name of the file to write to.
-    data : str
-        Data to write
+    data : str or bytearray
+        Data to write.
     offset : int (optional)
         Offset into the file at which to start writing in bytes.
     trunc : bool (optional)
@@ -124,34 +550,31 @@ class FileIO(object):
         this option is not specified and the existing file is longer than the
         current write then the contents of the file beyond the write will
         remain. If offset is non-zero then this flag is ignored.
-
-    Returns
-    -------
-    out : str
-        Contents of the file.
     """
     if trunc and offset == 0:
       self.remove(filename)
-    # How do we calculate this from the MsgFileioWriteRequest class?
-    chunksize = MAX_PAYLOAD_SIZE - len(filename) - 8
-    seq = self.next_seq()
-    while data:
-      chunk = data[:chunksize]
-      data = data[chunksize:]
-      msg = MsgFileioWriteReq(sequence=seq,
-                              filename=(filename + '\0' + chunk),
-                              offset=offset)
-      self.link(msg)
-      reply = self.link.wait(SBP_MSG_FILEIO_WRITE_RESP, timeout=1.0)
-      if not reply:
-        raise Exception("Timeout waiting for FILEIO_WRITE reply")
-      # Why isn't this already decoded?
-      reply = MsgFileioWriteResp(reply)
-      if reply.sequence != seq:
-        raise Exception("Reply FILEIO_WRITE doesn't match request")
-      offset += len(chunk)
-
-def hexdump(data):
+    self._walk_cache.clear()
+    # 4 byte sequence, 4 byte offset and null terminated filename.
+    chunksize = MAX_PAYLOAD_SIZE - 8 - len(filename) - 1
+    # Chunks are sliced from a view, so the data isn't copied each time.
+    view = memoryview(data)
+    start_time = time.time()
+    pos = 0
+    with RequestWindow(self.link, SBP_MSG_FILEIO_WRITE_RESP,
+                       "FILEIO_WRITE") as requests:
+      while pos < len(view) or len(requests):
+        requests.poll()
+        while pos < len(view) and len(requests) < self.window:
+          msg = MsgFileioWriteReq(sequence=self.next_seq(),
+                                  offset=offset + pos,
+                                  filename=filename + '\0',
+                                  data=bytearray(view[pos:pos + chunksize]))
+          requests.send(pos, msg)
+          pos += chunksize
+        requests.wait()
+    self._record_stats(requests, time.time() - start_time, len(view))
+
+def hexdump(data, ofs=0):
   """
   Print a hex dump.
 
@@ -160,9 +583,10 @@ def hexdump(data):
   data : indexable
       Data to display dump of, can be anything that supports length and index
       operations.
+  ofs : int (optional)
+      Offset shown for the first byte of data.
   """
   ret = ''
-  ofs = 0
   while data:
     chunk = data[:16]
     data = data[16:]
@@ -177,6 +601,36 @@ def hexdump(data):
     ret += s
   return ret
 
+class HexDumpWriter(object):
+  """
+  File-like object writing a hex dump of the data written to it to a stream,
+  a line of 16 bytes at a time, see hexdump.
+
+  Parameters
+  ----------
+  stream : file
+      Stream to write the hex dump to.
+  """
+
+  def __init__(self, stream):
+    self.stream = stream
+    self.offset = 0
+    self._buf = ''
+
+  def write(self, data):
+    self._buf += str(data)
+    n = len(self._buf) - len(self._buf) % 16
+    self.stream.write(hexdump(self._buf[:n], self.offset))
+    self.offset += n
+    self._buf = self._buf[n:]
+
+  def flush(self):
+    """ Write the last, partial, line. """
+    self.stream.write(hexdump(self._buf, self.offset))
+    self.offset += len(self._buf)
+    self._buf = ''
+    self.stream.flush()
+
 def print_dir_listing(files):
   """
   Print a directory listing.
@@ -189,6 +643,18 @@ def print_dir_listing(files):
   for f in files:
     print f
 
+def print_tree(tree):
+  """
+  Print a recursive directory listing, with file sizes where known.
+
+  Parameters
+  ----------
+  tree : dict
+      Directory tree returned by FileIO.walk.
+  """
+  for path, size in tree_files(tree):
+    print "%10s  %s" % ('' if size is None else size, path)
+
 def get_args():
   """
   Get and parse arguments.
@@ -197,10 +663,27 @@ def get_args():
   parser = argparse.ArgumentParser(description='Swift Nav File I/O Utility.')
   parser.add_argument('-r', '--read', nargs=1,
                      help='read a file')
+  parser.add_argument('-o', '--output',
+                     help='file to write the file read with -r to, instead '
+                          'of stdout.')
   parser.add_argument('-l', '--list', default=None, nargs=1,
                      help='list a directory')
+  parser.add_argument('-t', '--tree', default=None, nargs=1,
+                     help='list a directory and its subdirectories, with '
+                          'file sizes')
   parser.add_argument('-d', '--delete', nargs=1,
                      help='delete a file')
+  parser.add_argument('--write', nargs=2, metavar=('LOCAL', 'REMOTE'),
+                     help='write a local file to a file on the device')
+  parser.add_argument('-s', '--sync', metavar='LOCAL_DIR',
+                     help='sync the files of the device with a local '
+                          'directory, see fileio_sync.py.')
+  parser.add_argument('--direction', default='pull',
+                     choices=['pull', 'push', 'both'],
+                     help='direction to sync files in.')
+  parser.add_argument('--checksum', action='store_true',
+                     help='compare the contents of files to sync rather than '
+                          'their sizes.')
   parser.add_argument('-p', '--port',
                      default=[serial_link.SERIAL_PORT], nargs=1,
                      help='specify the serial port to use.')
@@ -216,6 +699,8 @@ def get_args():
   parser.add_argument("-f", "--ftdi",
                      help="use pylibftdi instead of pyserial.",
                      action="store_true")
+  parser.add_argument("-w", "--window", type=int, default=DEFAULT_WINDOW,
+                     help="number of requests to keep in flight.")
   return parser.parse_args()
 
 def main():
@@ -226,17 +711,36 @@ def main():
   with serial_link.get_driver(args.ftdi, port, baud) as driver:
     # Handler with context
     with Handler(Framer(driver.read, driver.write, args.verbose)) as link:
-      f = FileIO(link)
+      f = FileIO(link, args.window)
 
       try:
         if args.read:
-          data = f.read(args.read[0])
-          if args.hex:
-            print hexdump(data)
+          if args.output:
+            def progress_cb(n_read):
+              sys.stdout.write('\rRead %d bytes' % n_read)
+              sys.stdout.flush()
+            with open(args.output, 'wb') as output:
+              f.read_into(args.read[0], output, progress_cb)
+            print
+            print f.throughput_report()
+          elif args.hex:
+            dump = HexDumpWriter(sys.stdout)
+            f.read_into(args.read[0], dump)
+            dump.flush()
           else:
-            print data
+            f.read_into(args.read[0], sys.stdout)
+        elif args.write:
+          with open(args.write[0], 'rb') as local:
+            f.write(args.write[1], local.read())
+          print f.throughput_report()
+        elif args.sync:
+          from fileio_sync import sync
+          print sync(f, args.sync, direction=args.direction,
+                     checksum=args.checksum)
         elif args.delete:
           f.remove(args.delete[0])
+        elif args.tree is not None:
+          print_tree(f.walk(args.tree[0], sizes=True))
         elif args.list is not None:
           print_dir_listing(f.readdir(args.list[0]))
         else:
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+The :mod:`piksi_tools.fileio_sync` module mirrors the files of a Piksi to a
+local directory and back over piksi_tools.fileio, transferring only the
+files that changed since the last sync.
+
+The size, modification time and SHA-1 of every file as of the last sync are
+kept in a cache file in the local directory. Local changes are found from
+the sizes and modification times, hashing only the files whose ones
+changed. The device has no way to report the size or hash of a file, so
+remote changes are found by checking, with a single read request per file,
+that it still has the size it had at the last sync, or, with checksum=True,
+by reading and hashing the whole file.
+
+Files are never deleted, on either side.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import time
+
+import serial_link
+
+from fileio import FileIO, DEFAULT_WINDOW, join_path, tree_files
+from flash_cache import file_sha
+from sbp.client import Handler, Framer
+
+PULL = 'pull'
+PUSH = 'push'
+BOTH = 'both'
+DIRECTIONS = [PULL, PUSH, BOTH]
+
+# Name of the cache file kept in the local directory.
+CACHE_FILENAME = '.piksi_sync.json'
+# Version of the cache file format, bumped whenever it changes.
+CACHE_FORMAT_VERSION = 1
+
+class SyncCache(object):
+  """
+  Size, local modification time and SHA-1 of each file as of the last sync,
+  when both copies were the same, stored in CACHE_FILENAME in the local
+  directory.
+
+  Parameters
+  ----------
+  local_dir : str
+    Local directory mirroring the device's files.
+  """
+
+  def __init__(self, local_dir):
+    self.path = os.path.join(local_dir, CACHE_FILENAME)
+    self.files = {}
+    try:
+      with open(self.path) as f:
+        contents = json.load(f)
+      if contents.get('version') == CACHE_FORMAT_VERSION:
+        self.files = contents['files']
+    except (IOError, OSError, ValueError, KeyError):
+      pass
+
+  def get(self, path):
+    """ Entry of a file, or None if it wasn't synced before. """
+    return self.files.get(path)
+
+  def update(self, path, local_path, sha):
+    """ Record a file as the same on both sides. """
+    st = os.stat(local_path)
+    self.files[path] = {'size': st.st_size, 'mtime': st.st_mtime, 'sha': sha}
+
+  def save(self):
+    with open(self.path, 'w') as f:
+      json.dump({'version': CACHE_FORMAT_VERSION, 'files': self.files}, f,
+                indent=2, sort_keys=True)
+
+class _HashingWriter(object):
+  """ File-like object hashing the data written through it to a file. """
+
+  def __init__(self, f):
+    self.f = f
+    self.sha = hashlib.sha1()
+
+  def write(self, data):
+    self.sha.update(data)
+    self.f.write(data)
+
+class SyncSummary(object):
+  """
+  Files transferred and bytes sent and received by a sync.
+  """
+
+  def __init__(self):
+    self.start_time = time.time()
+    self.pulled = []
+    self.pushed = []
+    self.conflicts = []
+    self.n_unchanged = 0
+    self.bytes_sent = 0
+    self.bytes_received = 0
+
+  def __str__(self):
+    elapsed = max(time.time() - self.start_time, 1e-3)
+    lines = ['> %s' % path for path in self.pulled] + \
+            ['< %s' % path for path in self.pushed] + \
+            ['! %s (changed on both sides, skipped)' % path
+             for path in self.conflicts]
+    lines.append("sent %d bytes  received %d bytes  %.1f bytes/sec" %
+                 (self.bytes_sent, self.bytes_received,
+                  (self.bytes_sent + self.bytes_received) / elapsed))
+    lines.append("%d pulled, %d pushed, %d unchanged, %d conflicts" %
+                 (len(self.pulled), len(self.pushed), self.n_unchanged,
+                  len(self.conflicts)))
+    return '\n'.join(lines)
+
+def remote_files(fileio, dirname='.'):
+  """
+  Recursively list the files in a directory of the device, see
+  piksi_tools.fileio.FileIO.walk.
+
+  Parameters
+  ----------
+  fileio : piksi_tools.fileio.FileIO
+    FileIO of the device.
+  dirname : str
+    Directory to list.
+
+  Returns
+  -------
+  out : [str]
+    Paths of the files, relative to dirname and separated by '/'.
+  """
+  return [path for path, size in tree_files(fileio.walk(dirname, ttl=0))]
+
+def local_files(local_dir):
+  """
+  Recursively list the files in a local directory, except the sync cache.
+
+  Returns
+  -------
+  out : [str]
+    Paths of the files, relative to local_dir and separated by '/'.
+  """
+  files = []
+  for root, dirs, names in os.walk(local_dir):
+    rel = os.path.relpath(root, local_dir)
+    for name in names:
+      path = name if rel == os.curdir else '/'.join(rel.split(os.sep) + [name])
+      if path != CACHE_FILENAME and not name.endswith('.sync.tmp'):
+        files.append(path)
+  return files
+
+def _fetch(fileio, rpath, local_path):
+  """
+  Read a remote file into a temporary file next to local_path.
+
+  Returns
+  -------
+  out : (str, str, int)
+    Path of the temporary file, SHA-1 and size of its contents.
+  """
+  if not os.path.isdir(os.path.dirname(local_path)):
+    os.makedirs(os.path.dirname(local_path))
+  tmp_path = local_path + '.sync.tmp'
+  with open(tmp_path, 'wb') as f:
+    writer = _HashingWriter(f)
+    size = fileio.read_into(rpath, writer)
+  return tmp_path, writer.sha.hexdigest(), size
+
+def sync(fileio, local_dir, remote_dir='.', direction=PULL, checksum=False,
+         stream=None):
+  """
+  Sync the files in a directory of the device with a local directory.
+
+  With PULL, local files are made the same as the device's, with PUSH the
+  device's files are made the same as the local ones, and with BOTH each
+  file is copied from the side it changed on since the last sync. Files
+  changed on both sides are left alone and reported as conflicts.
+
+  Parameters
+  ----------
+  fileio : piksi_tools.fileio.FileIO
+    FileIO of the device.
+  local_dir : str
+    Local directory.
+  remote_dir : str
+    Directory of the device.
+  direction : str
+    One of DIRECTIONS.
+  checksum : bool
+    Read and hash every remote file to find the changed ones, rather than
+    comparing sizes.
+  stream : stream
+    Object implementing write and flush methods to write the paths of the
+    transferred files to as they are transferred.
+
+  Returns
+  -------
+  out : SyncSummary
+  """
+  if not os.path.isdir(local_dir):
+    os.makedirs(local_dir)
+  cache = SyncCache(local_dir)
+  summary = SyncSummary()
+  remote = set(remote_files(fileio, remote_dir))
+  local = set(local_files(local_dir))
+
+  def log(line):
+    if stream:
+      stream.write(line + '\n')
+      stream.flush()
+
+  def local_sha(path, local_path, entry):
+    st = os.stat(local_path)
+    if entry is not None and \
+       (entry['size'], entry['mtime']) == (st.st_size, st.st_mtime):
+      return entry['sha']
+    return file_sha(local_path)
+
+  def fetch(rpath, local_path):
+    fetched = _fetch(fileio, rpath, local_path)
+    summary.bytes_received += fetched[2]
+    return fetched
+
+  def pull(path, rpath, local_path, fetched=None):
+    tmp_path, sha, _ = fetched or fetch(rpath, local_path)
+    if os.path.exists(local_path):
+      os.remove(local_path)
+    os.rename(tmp_path, local_path)
+    cache.update(path, local_path, sha)
+    summary.pulled.append(path)
+    log('> ' + path)
+
+  def push(path, rpath, local_path, sha):
+    with open(local_path, 'rb') as f:
+      data = f.read()
+    fileio.write(rpath, data)
+    cache.update(path, local_path, sha)
+    summary.pushed.append(path)
+    summary.bytes_sent += len(data)
+    log('< ' + path)
+
+  try:
+    for path in sorted(remote | local):
+      rpath = join_path(remote_dir, path)
+      local_path = os.path.join(local_dir, *path.split('/'))
+      entry = cache.get(path)
+      if path not in local:
+        if direction != PUSH:
+          pull(path, rpath, local_path)
+        continue
+      sha = local_sha(path, local_path, entry)
+      if path not in remote:
+        if direction != PULL:
+          push(path, rpath, local_path, sha)
+        continue
+      fetched = None
+      if entry is None or checksum:
+        # Compare contents, reusing them if the file is to be pulled.
+        fetched = fetch(rpath, local_path)
+        if entry is None:
+          # Without a previous sync, differing files changed on both sides.
+          remote_changed = local_changed = fetched[1] != sha
+        else:
+          remote_changed = fetched[1] != entry['sha']
+          local_changed = sha != entry['sha']
+      else:
+        remote_changed = not fileio.has_size(rpath, entry['size'])
+        local_changed = sha != entry['sha']
+      if not remote_changed and not local_changed:
+        cache.update(path, local_path, sha)
+        summary.n_unchanged += 1
+      elif direction == PULL or (direction == BOTH and not local_changed):
+        pull(path, rpath, local_path, fetched)
+        fetched = None
+      elif direction == PUSH or not remote_changed:
+        push(path, rpath, local_path, sha)
+      else:
+        summary.conflicts.append(path)
+        log('! ' + path)
+      if fetched is not None:
+        os.remove(fetched[0])
+  finally:
+    cache.save()
+  return summary
+
+def get_args():
+  """
+  Get and parse arguments.
+  """
+  import argparse
+  parser = argparse.ArgumentParser(description='Piksi File Sync')
+  parser.add_argument("local_dir",
+                      help="local directory to sync with the device.")
+  parser.add_argument("-r", "--remote-dir", default='.',
+                      help="directory of the device to sync.")
+  parser.add_argument("-d", "--direction", choices=DIRECTIONS, default=PULL,
+                      help="pull to copy the device's files to the local "
+                           "directory, push to copy local files to the "
+                           "device, both to copy each changed file from the "
+                           "side it changed on.")
+  parser.add_argument("-c", "--checksum", action="store_true",
+                      help="compare the contents of remote files rather than "
+                           "their sizes.")
+  parser.add_argument('-p', '--port',
+                      default=[serial_link.SERIAL_PORT], nargs=1,
+                      help='specify the serial port to use.')
+  parser.add_argument("-b", "--baud",
+                      default=[serial_link.SERIAL_BAUD], nargs=1,
+                      help="specify the baud rate to use.")
+  parser.add_argument("-f", "--ftdi",
+                      help="use pylibftdi instead of pyserial.",
+                      action="store_true")
+  parser.add_argument("-w", "--window", type=int, default=DEFAULT_WINDOW,
+                      help="number of requests to keep in flight.")
+  return parser.parse_args()
+
+def main():
+  """
+  Sync the device's files over one link and print a summary.
+  """
+  args = get_args()
+  with serial_link.get_driver(args.ftdi, args.port[0], args.baud[0]) as driver:
+    with Handler(Framer(driver.read, driver.write)) as link:
+      summary = sync(FileIO(link, args.window), args.local_dir,
+                     args.remote_dir, args.direction, args.checksum)
+  print summary
+  if summary.conflicts:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -10,18 +10,62 @@
 # EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
 # WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
 
+import hashlib
 import struct
 import time
 import sys
 import new
-from intelhex import IntelHex
-from threading import Lock
+from bisect import bisect_left, bisect_right
+from intelhex import IntelHex, NotEnoughDataError
+from threading import Condition, Lock
 
+from collections import deque
 from itertools import groupby
 from sbp.flash import *
+from timeout import check_timeouts, TimeoutError
 
 ADDRS_PER_OP = 128
 
+# Flash.write_ihx keeps a sliding window of outstanding program/read
+# operations, sized from the measured round trip time of each operation
+# relative to the fastest round trip seen for that kind of operation. If the
+# window holds fewer than WINDOW_ALPHA operations beyond what the link needs
+# to stay busy it is grown, if it holds more than WINDOW_BETA it is shrunk.
+WINDOW_ALPHA = 1
+WINDOW_BETA = 3
+# When the device replies to an operation with an error, e.g. because its
+# receive buffer overflowed, the window is cut by this factor.
+WINDOW_ERROR_DECREASE = 0.5
+# Upper bound on the window when Flash is not given max_queued_ops. Keeps the
+# program/read messages in flight well within the device UART RX buffer.
+AUTO_MAX_QUEUED_OPS = 8
+# Number of erase operations Flash.erase_sectors keeps queued in the device.
+# Two already hide the round trip between sectors, a few more absorb jitter.
+MAX_QUEUED_ERASES = 4
+# Gain of the exponential moving average of the round trip time ratio.
+RTT_GAIN = 0.125
+# Longest single wait, in seconds, on the queued op count condition. Python 2
+# implements Condition.wait(timeout) by sleeping with an increasing backoff,
+# so waits are kept short to bound the wake up latency after a callback.
+WAIT_POLL_PERIOD = 0.0005
+# Seconds Flash.wait_n_queued_ops waits without any queued operation being
+# answered before giving up, so a lost reply can't block it forever.
+REPLY_TIMEOUT = 30
+
+# Value of every byte of an erased flash sector.
+ERASED_BYTE = '\xff'
+
+# How Flash.write_ihx handles chunks holding only erased bytes that lie in
+# sectors erased before programming: program and read them back as any other
+# chunk, skip programming but read them back to verify, or skip them entirely.
+BLANK_PROGRAM = 'program'
+BLANK_READ = 'read'
+BLANK_SKIP = 'skip'
+BLANK_POLICIES = [BLANK_PROGRAM, BLANK_READ, BLANK_SKIP]
+
+# Seconds between saves of the progress of Flash.write_ihx to its journal.
+JOURNAL_SAVE_PERIOD = 1.0
+
 M25_SR_SRWD = 1 << 7
 M25_SR_BP2  = 1 << 4
 M25_SR_BP1  = 1 << 3
@@ -95,13 +139,55 @@ def m25_addr_sector_map(addr):
     raise IndexError("Attempted to access flash memory at (%s) outside of range (wrong firmware file?)." % hex(addr))
   return addr >> 16
 
+def stm_sector_addr_range(sector):
+  """
+  Map an STM32F4 flash sector to the addresses it spans.
+
+  Parameters
+  ----------
+  sector : int
+      STM flash sector.
+
+  Returns
+  -------
+  out : (int, int)
+      First and last address of the sector.
+  """
+  if not 0 <= sector < STM_N_SECTORS:
+    raise IndexError("STM flash sector %d out of range." % sector)
+  if sector < 4:
+    start = 0x08000000 + sector * 0x4000
+    return (start, start + 0x3FFF)
+  elif sector == 4:
+    return (0x08010000, 0x0801FFFF)
+  start = 0x08020000 + (sector - 5) * 0x20000
+  return (start, start + 0x1FFFF)
+
+def m25_sector_addr_range(sector):
+  """
+  Map an M25 flash sector to the addresses it spans.
+
+  Parameters
+  ----------
+  sector : int
+      M25 flash sector.
+
+  Returns
+  -------
+  out : (int, int)
+      First and last address of the sector.
+  """
+  if not 0 <= sector < M25_N_SECTORS:
+    raise IndexError("M25 flash sector %d out of range." % sector)
+  return (sector << 16, (sector << 16) + 0xFFFF)
+
 def ihx_ranges(ihx):
   """
   Find occupied address ranges in intelhex.IntelHex object.
 
   Parameters
   ----------
-  ihx : intelhex.Intelhex
+  ihx : intelhex.Intelhex or FlashImage
       intelhex.IntelHex object to find occupied address ranges of.
 
   Returns
@@ -109,6 +195,8 @@ def ihx_ranges(ihx):
   out : list[(int, int), (int, int), ...]
       List of min/max tuples of occupied address ranges.
   """
+  if isinstance(ihx, FlashImage):
+    return list(ihx.segments)
   def first_last(x):
     first = x.next()
     last = first
@@ -118,6 +206,218 @@ def ihx_ranges(ihx):
   return [first_last(v) for k, v in
           groupby(enumerate(ihx.addresses()), lambda (i, x) : i - x)]
 
+def add_range(ranges, first, last):
+  """
+  Add an address range to a sorted list of disjoint, non-adjacent (first,
+  last) ranges in place, merging it with any overlapping or adjacent ranges.
+  """
+  i = bisect_left(ranges, (first,))
+  if i > 0 and ranges[i-1][1] >= first - 1:
+    i -= 1
+  j = i
+  while j < len(ranges) and ranges[j][0] <= last + 1:
+    first = min(first, ranges[j][0])
+    last = max(last, ranges[j][1])
+    j += 1
+  ranges[i:j] = [(first, last)]
+
+def remove_range(ranges, first, last):
+  """
+  Remove an address range from a sorted list of disjoint (first, last) ranges
+  in place, splitting any range it falls within.
+  """
+  kept = []
+  for r_first, r_last in ranges:
+    if r_last < first or r_first > last:
+      kept.append((r_first, r_last))
+      continue
+    if r_first < first:
+      kept.append((r_first, first - 1))
+    if r_last > last:
+      kept.append((last + 1, r_last))
+  ranges[:] = kept
+
+def ranges_cover(ranges, first, last):
+  """
+  Whether a sorted list of disjoint (first, last) ranges holds every address
+  in the range first to last.
+  """
+  i = bisect_right(ranges, (first, float('inf'))) - 1
+  return i >= 0 and ranges[i][0] <= first and last <= ranges[i][1]
+
+class FlashImage():
+
+  def __init__(self, start, size, data=None, segments=None):
+    """
+    Contents of a contiguous region of flash, held in a single preallocated
+    bytearray, along with the address segments that hold valid data. Much
+    more compact than an intelhex.IntelHex, which stores a dict entry per
+    address, and lets whole ranges be copied and compared at once.
+
+    Parameters
+    ----------
+    start : int
+      First address of the region.
+    size : int
+      Number of addresses in the region.
+    data : buffer
+      Existing contents of the region, e.g. read from a file, used in place
+      of a new erased bytearray.
+    segments : list[(int, int), (int, int), ...]
+      Sorted, disjoint (first, last) address ranges of data holding valid
+      contents.
+    """
+    self.start = start
+    self.size = size
+    self.data = bytearray(ERASED_BYTE * size) if data is None else data
+    try:
+      self.view = memoryview(self.data)
+    except TypeError:
+      # Python 2 mmaps don't support memoryviews, but slice like one.
+      self.view = self.data
+    # Sorted list of disjoint, non-adjacent (first, last) address tuples.
+    self.segments = []
+    for first, last in segments or []:
+      self.add_segment(first, last)
+
+  @classmethod
+  def from_ihx(cls, ihx, start=None, size=None):
+    """
+    Create a FlashImage holding the contents of an intelhex.IntelHex.
+
+    Parameters
+    ----------
+    ihx : intelhex.IntelHex
+      intelhex.IntelHex to copy, must lie within the region.
+    start : int
+      First address of the region. Defaults to the lowest address of ihx.
+    size : int
+      Number of addresses in the region. Defaults to the span of ihx.
+    """
+    addrs = ihx_ranges(ihx)
+    if start is None:
+      start = addrs[0][0] if addrs else 0
+    if size is None:
+      size = addrs[-1][1] + 1 - start if addrs else 0
+    image = cls(start, size)
+    for first, last in addrs:
+      image.puts(first, ihx.tobinstr(start=first, end=last))
+    return image
+
+  def _offset(self, address, length):
+    offset = address - self.start
+    if offset < 0 or offset + length > self.size:
+      raise IndexError("Addresses 0x%08X-0x%08X outside of flash image" %
+                       (address, address + length - 1))
+    return offset
+
+  def add_segment(self, first, last):
+    """
+    Mark an address range as holding valid data, merging it with any
+    overlapping or adjacent segments.
+    """
+    add_range(self.segments, first, last)
+
+  def covers(self, first, last):
+    """
+    Whether every address in the range first to last holds valid data.
+    """
+    return ranges_cover(self.segments, first, last)
+
+  def puts(self, address, data):
+    """
+    Copy a string of bytes into the image at an address.
+    """
+    if not data:
+      return
+    offset = self._offset(address, len(data))
+    self.view[offset:offset+len(data)] = data
+    self.add_segment(address, address + len(data) - 1)
+
+  def gets(self, address, length):
+    """
+    Get a string of bytes from the image, with the same semantics as
+    intelhex.IntelHex.gets.
+    """
+    offset = self._offset(address, length)
+    if not self.covers(address, address + length - 1):
+      raise NotEnoughDataError(address=address, length=length)
+    return str(self.data[offset:offset+length])
+
+  def digest(self):
+    """
+    SHA-1 of the image's valid segments and their contents, identifying the
+    image independently of the region it spans.
+    """
+    sha = hashlib.sha1()
+    for first, last in self.segments:
+      sha.update(struct.pack("<II", first, last))
+      sha.update(self.view[first-self.start:last+1-self.start])
+    return sha.hexdigest()
+
+  def to_ihx(self):
+    """
+    Copy the valid segments of the image into an intelhex.IntelHex.
+    """
+    ihx = IntelHex()
+    for first, last in self.segments:
+      ihx.puts(first, str(self.data[first-self.start:last+1-self.start]))
+    return ihx
+
+  def mismatches(self, other, segments=None):
+    """
+    Find the address ranges in which this image's valid segments differ from
+    another image, including ranges with no valid data in the other image.
+    Each segment is compared as a single buffer; only differing segments are
+    bisected down to the differing addresses.
+
+    Parameters
+    ----------
+    other : FlashImage
+      Image to compare against, e.g. data read back from the flash.
+    segments : list[(int, int), (int, int), ...]
+      Sorted (first, last) address ranges to compare instead of all of this
+      image's valid segments.
+
+    Returns
+    -------
+    out : list[(int, int), (int, int), ...]
+      Sorted list of (first, last) tuples of differing address ranges.
+    """
+    ranges = []
+    def add(first, last):
+      if ranges and ranges[-1][1] == first - 1:
+        ranges[-1] = (ranges[-1][0], last)
+      else:
+        ranges.append((first, last))
+    def compare(first, last):
+      a = self.view[first-self.start:last+1-self.start]
+      b = other.view[first-other.start:last+1-other.start]
+      if a == b:
+        return
+      if last - first < 64:
+        for i in range(len(a)):
+          if a[i] != b[i]:
+            add(first + i, first + i)
+        return
+      mid = (first + last) // 2
+      compare(first, mid)
+      compare(mid + 1, last)
+    for first, last in segments if segments is not None else self.segments:
+      # Split the segment by the other image's valid segments.
+      addr = first
+      for o_first, o_last in other.segments:
+        if o_last < addr or o_first > last:
+          continue
+        if o_first > addr:
+          add(addr, o_first - 1)
+          addr = o_first
+        compare(addr, min(last, o_last))
+        addr = min(last, o_last) + 1
+      if addr <= last:
+        add(addr, last)
+    return ranges
+
 def sectors_used(addrs, addr_sector_map):
   """
   Given a list of min/max address pairs, find the sectors they occupy.
@@ -140,19 +440,135 @@ def sectors_used(addrs, addr_sector_map):
     sectors |= set(range(addr_sector_map(s), addr_sector_map(e)+1))
   return sorted(list(sectors))
 
-def ihx_n_ops(ihx, addr_sector_map, erase=True):
+def ihx_chunks(addrs):
+  """
+  Split address ranges into the chunks Flash.write_ihx programs and reads
+  in a single operation each.
+
+  Parameters
+  ----------
+  addrs : list[(int, int), (int, int), ...]
+      List of min/max tuples of occupied address ranges.
+
+  Returns
+  -------
+  out : list[(int, int), (int, int), ...]
+      List of (address, length) tuples, length at most ADDRS_PER_OP.
+  """
+  return [(addr, min(ADDRS_PER_OP, e + 1 - addr))
+          for s, e in addrs for addr in range(s, e + 1, ADDRS_PER_OP)]
+
+def blank_chunks(ihx, chunks, erased_sectors, addr_sector_map):
+  """
+  Find the chunks that only hold erased bytes (0xFF) and lie entirely in
+  erased sectors, so programming them would not change the flash.
+
+  Parameters
+  ----------
+  ihx : intelhex.IntelHex or FlashImage
+      Image to be written.
+  chunks : list[(int, int), (int, int), ...]
+      List of (address, length) tuples, see ihx_chunks.
+  erased_sectors : list[int]
+      Sectors that are erased before programming.
+  addr_sector_map : function
+      Function that maps an address to a sector.
+
+  Returns
+  -------
+  out : set(int)
+      Start addresses of the blank chunks.
+  """
+  erased_sectors = set(erased_sectors)
+  blank = set()
+  for addr, length in chunks:
+    if addr_sector_map(addr) in erased_sectors and \
+       addr_sector_map(addr + length - 1) in erased_sectors and \
+       ihx.gets(addr, length) == ERASED_BYTE * length:
+      blank.add(addr)
+  return blank
+
+def chunk_n_ops(blank, blank_policy):
+  """
+  Number of sent SBP messages (program, read) needed to write a chunk.
+
+  Parameters
+  ----------
+  blank : bool
+      Whether the chunk is blank, see blank_chunks.
+  blank_policy : str
+      One of BLANK_POLICIES.
+
+  Returns
+  -------
+  out : int
+      Number of program and read operations for the chunk.
+  """
+  if not blank or blank_policy == BLANK_PROGRAM:
+    return 2
+  if blank_policy == BLANK_READ:
+    return 1
+  if blank_policy == BLANK_SKIP:
+    return 0
+  raise ValueError("Unknown blank chunk policy '%s'" % blank_policy)
+
+def sectors_changed(ihx, baseline, addr_sector_map, chunks=None):
+  """
+  Find the sectors in which the contents of an intelhex.IntelHex differ from
+  the current contents of the flash.
+
+  Parameters
+  ----------
+  ihx : intelhex.IntelHex or FlashImage
+      Image to be written.
+  baseline : intelhex.IntelHex or FlashImage
+      Current contents of the flash, at least at the addresses used by ihx.
+      Addresses missing from baseline are treated as differing.
+  addr_sector_map : function
+      Function that maps an address to a sector.
+  chunks : list[(int, int), (int, int), ...]
+      Chunks of ihx to compare, see ihx_chunks. Defaults to all of ihx.
+
+  Returns
+  -------
+  out : list[int]
+      List of sectors in which ihx and baseline differ.
+  """
+  if chunks is None:
+    chunks = ihx_chunks(ihx_ranges(ihx))
+  changed = set()
+  for addr, length in chunks:
+    try:
+      same = baseline.gets(addr, length) == ihx.gets(addr, length)
+    except NotEnoughDataError:
+      same = False
+    if not same:
+      changed |= set(range(addr_sector_map(addr),
+                           addr_sector_map(addr + length - 1) + 1))
+  return sorted(list(changed))
+
+def ihx_n_ops(ihx, addr_sector_map, erase=True, delta=False,
+              erased_sectors=None, blank_policy=BLANK_READ):
   """
   Find the number of sent SBP messages (erase, program, read) Flash.write_ihx
   will require to write a particular intelhex.IntelHex.
 
   Parameters
   ----------
-  ihx : intelhex.Intelhex
-      intelhex.IntelHex to be written.
+  ihx : intelhex.IntelHex or FlashImage
+      Image to be written.
   addr_sector_map : function
       Function that maps an address to a sector.
   erase : bool
       Include number of erase operations required in total.
+  delta : bool
+      Include the read operations needed to compare ihx against the current
+      flash contents. Operations skipped for unchanged sectors are still
+      counted, as Flash.write_ihx reports them as elapsed.
+  erased_sectors : list[int]
+      Sectors already erased before writing, when erase is False.
+  blank_policy : str
+      Handling of blank chunks in erased sectors, one of BLANK_POLICIES.
 
   Returns
   -------
@@ -161,13 +577,18 @@ def ihx_n_ops(ihx, addr_sector_map, erase=True):
       require to write ihx.
   """
   ihx_addrs = ihx_ranges(ihx)
-  erase_ops = len(sectors_used(ihx_addrs, addr_sector_map))
-  program_ops_addr_args = [range(s,e,ADDRS_PER_OP) for s,e in ihx_addrs]
-  program_ops = sum([len(l) for l in program_ops_addr_args])
-  read_ops = program_ops # One read callback for every program callback.
+  sectors = sectors_used(ihx_addrs, addr_sector_map)
+  chunks = ihx_chunks(ihx_addrs)
   if erase:
-    return erase_ops + program_ops + read_ops
-  return program_ops + read_ops
+    erased_sectors = sectors
+  blank = blank_chunks(ihx, chunks, erased_sectors or [], addr_sector_map)
+  n_ops = sum([chunk_n_ops(addr in blank, blank_policy)
+               for addr, length in chunks])
+  if erase:
+    n_ops += len(sectors)
+  if delta:
+    n_ops += len(chunks) # One read per chunk to compare against the flash.
+  return n_ops
 
 # Defining separate functions to lock/unlock STM sectors and to read/write M25
 # status register, as there isn't a great way to define lock/unlock sector
@@ -184,12 +605,11 @@ def _stm_lock_sector(self, sector):
   sector : int
       Sector of STM flash to lock (> 0, <= 11).
   """
-  if not 0 <= sector <+ 11:
+  if not 0 <= sector <= 11:
     raise ValueError("Must have 0 <= sector <= 11, received %d" % sector)
-  self.inc_n_queued_ops()
+  self._start_op('lock', sector)
   self.link(MsgStmFlashLockSector(sector=sector))
-  while self.get_n_queued_ops() > 0:
-    time.sleep(0.001)
+  self.wait_n_queued_ops(0)
 
 def _stm_unlock_sector(self, sector):
   """
@@ -202,10 +622,9 @@ def _stm_unlock_sector(self, sector):
   """
   if not 0 <= sector <= 11:
     raise ValueError("Must have 0 <= sector <= 11, received %d" % sector)
-  self.inc_n_queued_ops()
-  self.link.send(MsgStmFlashUnlockSector(sector=sector))
-  while self.get_n_queued_ops() > 0:
-    time.sleep(0.001)
+  self._start_op('unlock', sector)
+  self.link(MsgStmFlashUnlockSector(sector=sector))
+  self.wait_n_queued_ops(0)
 
 def _m25_write_status(self, sr):
   """
@@ -219,14 +638,13 @@ def _m25_write_status(self, sr):
   if not 0 <= sr <= 255:
     raise ValueError("Must have 0 <= sr <= 255, received %d" % sr)
   msg_buf = struct.pack("B", sr)
-  self.inc_n_queued_ops()
-  self.link.send(SBP_MSG_M25_FLASH_WRITE_STATUS, msg_buf)
-  while self.get_n_queued_ops() > 0:
-    time.sleep(0.001)
+  self._start_op('write_status', sr)
+  self.link(SBP(SBP_MSG_M25_FLASH_WRITE_STATUS, payload=msg_buf))
+  self.wait_n_queued_ops(0)
 
 class Flash():
 
-  def __init__(self, link, flash_type, sbp_version, max_queued_ops=1):
+  def __init__(self, link, flash_type, sbp_version, max_queued_ops=None):
     """
     Object representing either of the two flashes (STM/M25) on the Piksi,
     including methods to erase, program, and read.
@@ -245,7 +663,16 @@ class Flash():
       of the device UART RX buffer will be filled by the program/read callback
       messages. A higher value will significantly speed up flashing, but can
       result in RX buffer overflows in other UARTs if the device is receiving
-      data on other UARTs.
+      data on other UARTs. Flash.write_ihx adapts the number of operations it
+      keeps in flight to the measured round trip time and to error replies,
+      starting from one, up to this limit. If None, the limit is
+      AUTO_MAX_QUEUED_OPS.
+
+    Replies lost on the link aren't detected as such: waits for queued
+    operations raise a piksi_tools.timeout.TimeoutError once no reply has
+    arrived for reply_timeout seconds, REPLY_TIMEOUT by default, or earlier
+    if a piksi_tools.timeout.Timeout expires. The count of queued operations
+    is then off, so the flash session should be started over.
 
     Returns
     -------
@@ -253,20 +680,37 @@ class Flash():
     """
     self._n_queued_ops = 0
     self.max_queued_ops = max_queued_ops
+    self.window_limit = max_queued_ops or AUTO_MAX_QUEUED_OPS
     self.nqo_lock = Lock()
+    # Signalled by the SBP callbacks whenever a queued operation completes.
+    self.nqo_cond = Condition(self.nqo_lock)
+    # Outstanding operations. The device replies to erase/program/lock
+    # operations with a FLASH_DONE message carrying no address, in the order
+    # the operations were sent, so these are tracked in a FIFO of
+    # (kind, address or sector, time sent). Read replies carry their address.
+    self._pending_done = deque()
+    self._pending_reads = {}
+    # Round trip time state for the adaptive window, see self._update_window.
+    self.window = 1
+    self.max_window = 1
+    self.base_rtt = {}
+    self.rtt_ratio = 1.0
+    self._n_acks_in_window = 0
+    self.n_errors = 0
+    self.reply_timeout = REPLY_TIMEOUT
+    self._last_reply = 0.0
+    # (sector, time sent, time done, return code) of completed erases.
+    self._erase_log = []
     self.stopped = False
     self.status = ''
     self.link = link
     self.flash_type = flash_type
     self.sbp_version = sbp_version
-    # IntelHex object to store read flash data in that was read from device.
-    self._read_callback_ihx = IntelHex()
-    self.link.add_callback(self._done_callback, SBP_MSG_FLASH_DONE)
-    self.link.add_callback(self._read_callback, SBP_MSG_FLASH_READ_RESP)
     self.ihx_elapsed_ops = 0 # N operations finished in self.write_ihx
     if self.flash_type == "STM":
       self.flash_type_byte = 0
       self.addr_sector_map = stm_addr_sector_map
+      self.sector_addr_range = stm_sector_addr_range
       # Add STM-specific functions.
       self.__dict__['lock_sector'] = \
           new.instancemethod(_stm_lock_sector, self, Flash)
@@ -277,6 +721,7 @@ class Flash():
     elif self.flash_type == "M25":
       self.flash_type_byte = 1
       self.addr_sector_map = m25_addr_sector_map
+      self.sector_addr_range = m25_sector_addr_range
       # Add M25-specific functions.
       self.__dict__['write_status'] = \
           new.instancemethod(_m25_write_status, self, Flash)
@@ -285,6 +730,10 @@ class Flash():
     else:
       raise ValueError("flash_type must be \"STM\" or \"M25\", got \"%s\"" \
                        % flash_type)
+    # Image of the whole flash to store data read from the device in.
+    self._read_image = self.new_image()
+    self.link.add_callback(self._done_callback, SBP_MSG_FLASH_DONE)
+    self.link.add_callback(self._read_callback, SBP_MSG_FLASH_READ_RESP)
 
   def __enter__(self):
     return self
@@ -294,7 +743,27 @@ class Flash():
     if not self.stopped:
       self.stop()
 
-  def ihx_n_ops(self, ihx, erase=True):
+  def new_image(self, ihx=None):
+    """
+    Create a FlashImage spanning all sectors of this instance's flash.
+
+    Parameters
+    ----------
+    ihx : intelhex.IntelHex
+      Contents to copy into the image. If None, the image is left empty.
+
+    Returns
+    -------
+    out : FlashImage
+    """
+    start = self.sector_addr_range(0)[0]
+    end = self.sector_addr_range(self.n_sectors - 1)[1]
+    if ihx is None:
+      return FlashImage(start, end + 1 - start)
+    return FlashImage.from_ihx(ihx, start, end + 1 - start)
+
+  def ihx_n_ops(self, ihx, erase=True, delta=False, erased_sectors=None,
+                blank_policy=BLANK_READ):
     """
     Find the number of sent SBP messages (erase, program, read) self.write_ihx
     will require to write a particular intelhex.IntelHex for this instance's
@@ -302,10 +771,17 @@ class Flash():
 
     Parameters
     ----------
-    ihx : intelhex.Intelhex
-      intelhex.IntelHex to be written.
+    ihx : intelhex.IntelHex or FlashImage
+      Image to be written.
     erase : bool
       Include number of erase operations required in total.
+    delta : bool
+      Include the read operations needed to compare ihx against the current
+      flash contents.
+    erased_sectors : list[int]
+      Sectors already erased before writing, when erase is False.
+    blank_policy : str
+      Handling of blank chunks in erased sectors, one of BLANK_POLICIES.
 
     Returns
     -------
@@ -313,25 +789,25 @@ class Flash():
       Number of sent SBP messages (erase, program, read) self.write_ihx will
       require to write ihx.
     """
-    return ihx_n_ops(ihx, self.addr_sector_map, erase)
+    return ihx_n_ops(ihx, self.addr_sector_map, erase, delta, erased_sectors,
+                     blank_policy)
 
   def inc_n_queued_ops(self):
     """
     Increment the count of queued flash operation SBP messages in the STM's
     flash in a thread safe way.
     """
-    self.nqo_lock.acquire()
-    self._n_queued_ops += 1
-    self.nqo_lock.release()
+    with self.nqo_lock:
+      self._n_queued_ops += 1
 
   def dec_n_queued_ops(self):
     """
     Decrement the count of queued flash operation SBP messages in the STM's
-    flash in a thread safe way.
+    flash in a thread safe way, waking up any thread waiting on the count.
     """
-    self.nqo_lock.acquire()
-    self._n_queued_ops -= 1
-    self.nqo_lock.release()
+    with self.nqo_lock:
+      self._n_queued_ops -= 1
+      self.nqo_cond.notify_all()
 
   def get_n_queued_ops(self):
     """
@@ -344,6 +820,147 @@ class Flash():
     """
     return self._n_queued_ops
 
+  def wait_n_queued_ops(self, n):
+    """
+    Block until at most n flash operation SBP messages are queued. Woken by the
+    SBP callbacks as operations complete rather than polling. Raises if a
+    piksi_tools.timeout.Timeout of the calling thread expires first.
+
+    Parameters
+    ----------
+    n : int
+      Number of queued operations to wait for the count to drop to.
+
+    Raises
+    ------
+    piksi_tools.timeout.TimeoutError
+      If no queued operation is answered for self.reply_timeout seconds,
+      e.g. because a reply was lost.
+    """
+    start = time.time()
+    with self.nqo_lock:
+      while self._n_queued_ops > n:
+        self._check_replies(start)
+        # Wait with a timeout so Ctrl-C is still delivered to a waiting main
+        # thread.
+        self.nqo_cond.wait(WAIT_POLL_PERIOD)
+
+  def _check_replies(self, start):
+    """
+    Raise if a Timeout of the calling thread has expired, or if no queued
+    operation has been answered for self.reply_timeout seconds since start.
+    Must be called with self.nqo_lock held.
+    """
+    check_timeouts()
+    if self.reply_timeout is not None and \
+        time.time() - max(start, self._last_reply) > self.reply_timeout:
+      raise TimeoutError("No reply to %d queued %s flash operations in %s "
+                         "seconds" % (self._n_queued_ops, self.flash_type,
+                                      self.reply_timeout))
+
+  def _start_op(self, kind, key):
+    """
+    Record a flash operation as sent and queued in the device.
+
+    Parameters
+    ----------
+    kind : string
+      Operation type, "read" for operations answered by FLASH_READ_RESP and
+      anything else for operations answered by FLASH_DONE.
+    key : int
+      Address (or sector) the operation acts on.
+    """
+    with self.nqo_lock:
+      if kind == 'read':
+        self._pending_reads[key] = time.time()
+      else:
+        self._pending_done.append((kind, key, time.time()))
+      self._n_queued_ops += 1
+
+  def _finish_op(self, kind, t_sent):
+    """
+    Account for a completed flash operation. Must be called with
+    self.nqo_lock held.
+
+    Parameters
+    ----------
+    kind : string
+      Operation type.
+    t_sent : float
+      Time the operation was sent, or None if unknown.
+    """
+    self._n_queued_ops -= 1
+    self._last_reply = time.time()
+    assert self._n_queued_ops >= 0, \
+      "Number of queued flash operations is negative"
+    if t_sent is not None:
+      self._update_window(kind, time.time() - t_sent)
+    self.nqo_cond.notify_all()
+
+  def _update_window(self, kind, rtt):
+    """
+    Resize the window of outstanding operations from a measured round trip
+    time. The shortest round trip seen for each kind of operation is taken as
+    the time the device needs to service it on an idle link; the ratio of the
+    smoothed round trip time to that estimates how many operations are sitting
+    queued in the device. Once per window of acknowledgements the window is
+    grown if the device is starved and shrunk if operations are only piling
+    up in its receive buffer. Must be called with self.nqo_lock held.
+
+    Parameters
+    ----------
+    kind : string
+      Operation type.
+    rtt : float
+      Measured round trip time of the operation in seconds.
+    """
+    rtt = max(rtt, 1e-6)
+    base = self.base_rtt.get(kind)
+    if base is None or rtt < base:
+      base = self.base_rtt[kind] = rtt
+    self.rtt_ratio += RTT_GAIN * (rtt / base - self.rtt_ratio)
+    self._n_acks_in_window += 1
+    if self._n_acks_in_window < self.window:
+      return
+    self._n_acks_in_window = 0
+    queued = self.window * (1 - 1 / self.rtt_ratio)
+    if queued < WINDOW_ALPHA and self.window < self.window_limit:
+      self.window += 1
+    elif queued > WINDOW_BETA and self.window > 1:
+      self.window -= 1
+    self.window = min(self.window, self.window_limit)
+    self.max_window = max(self.max_window, self.window)
+
+  def _cut_window(self):
+    """
+    Multiplicatively decrease the window after an error reply, restarting
+    the count of acknowledgements towards the next increase. Must be called
+    with self.nqo_lock held.
+    """
+    self.window = max(1, int(self.window * WINDOW_ERROR_DECREASE))
+    self._n_acks_in_window = 0
+
+  def throughput_report(self, elapsed, n_bytes):
+    """
+    Describe the queue depth chosen while writing and the throughput
+    achieved, to explain slow updates.
+
+    Parameters
+    ----------
+    elapsed : float
+      Time taken, in seconds.
+    n_bytes : int
+      Number of bytes written.
+
+    Returns
+    -------
+    out : str
+    """
+    return self.flash_type + " Flash: %.1f kB/s, queued ops %d (peak %d, " \
+           "limit %d), %d error replies" % \
+           (n_bytes / 1024.0 / max(elapsed, 1e-3), self.window,
+            self.max_window, self.window_limit, self.n_errors)
+
   def stop(self):
     """ Remove instance callbacks from sbp.client.handler.Handler. """
     self.stopped = True
@@ -370,10 +987,68 @@ class Flash():
              (self.flash_type, sector)
       raise Warning(text)
     msg_buf = struct.pack("BB", self.flash_type_byte, sector)
-    self.inc_n_queued_ops()
+    self._start_op('erase', sector)
     self.link(MsgFlashErase(target=self.flash_type_byte, sector_num=sector))
-    while self.get_n_queued_ops() > 0:
-      time.sleep(0.001)
+    self.wait_n_queued_ops(0)
+
+  def erase_sectors(self, sectors, warn=True, erased_cb=None):
+    """
+    Erase sectors of the flash, keeping up to MAX_QUEUED_ERASES erase
+    operations queued in the device so it moves on to the next sector without
+    waiting for a round trip to the host.
+
+    Parameters
+    ----------
+    sectors : list[int]
+      Sectors to be erased, in order.
+    warn : bool
+      Warn if any sector is restricted and should most likely not be erased.
+      Checked before any sector is erased.
+    erased_cb : function
+      Called with the number of sectors erased so far, which are the first
+      sectors of the list, while waiting for the erases to complete.
+
+    Returns
+    -------
+    out : list[(int, float)]
+      (sector, seconds) tuples in the order the sectors were erased, with an
+      approximation of the time the device spent erasing each sector: the
+      time between the replies of the previous sector and this one, or from
+      when this one was sent if that was later. Replies are timed on arrival
+      at the host, so jitter on the link shifts time between neighbouring
+      sectors, but the times add up to the time taken by all the erases.
+    """
+    if warn:
+      for sector in sectors:
+        if sector in self.restricted_sectors:
+          raise Warning('Attempting to erase %s flash restricted sector %d' %
+                        (self.flash_type, sector))
+    depth = min(MAX_QUEUED_ERASES, self.window_limit)
+    with self.nqo_lock:
+      self._erase_log = []
+    for sector in sectors:
+      self.wait_n_queued_ops(depth - 1)
+      if erased_cb != None:
+        erased_cb(len(self._erase_log))
+      self._start_op('erase', sector)
+      self.link(MsgFlashErase(target=self.flash_type_byte, sector_num=sector))
+    self.wait_n_queued_ops(0)
+    if erased_cb != None:
+      erased_cb(len(self._erase_log))
+
+    timings = []
+    failed = []
+    t_prev = None
+    for sector, t_sent, t_done, ret in self._erase_log:
+      t_start = t_sent if t_prev is None else max(t_sent, t_prev)
+      timings.append((sector, t_done - t_start))
+      t_prev = t_done
+      if ret != 0:
+        failed.append(sector)
+    if failed:
+      raise Exception('Failed to erase %s flash sectors %s' %
+                      (self.flash_type, ', '.join(map(str, failed))))
+    return timings
 
   def program(self, address, data):
     """
@@ -389,7 +1064,7 @@ class Flash():
     msg_buf = struct.pack("B", self.flash_type_byte)
     msg_buf += struct.pack("<I", address)
     msg_buf += struct.pack("B", len(data))
-    self.inc_n_queued_ops()
+    self._start_op('program', address)
     # < 0.45 of SBP protocol, reuse single flash message.
     if self.sbp_version < (0, 45):
       self.link(SBP(SBP_MSG_FLASH_DONE, payload=msg_buf+data))
@@ -416,11 +1091,17 @@ class Flash():
     =======
     out : str
       String of bytes (big endian) read from address.
+
+    Raises
+    ======
+    piksi_tools.timeout.TimeoutError
+      If blocking and no queued operation is answered for
+      self.reply_timeout seconds, e.g. because the reply was lost.
     """
     msg_buf = struct.pack("B", self.flash_type_byte)
     msg_buf += struct.pack("<I", address)
     msg_buf += struct.pack("B", length)
-    self.inc_n_queued_ops()
+    self._start_op('read', address)
     # < 0.45 of SBP protocol, reuse single read message.
     if self.sbp_version < (0, 45):
       self.link(SBP(SBP_MSG_FLASH_READ_RESP, payload=msg_buf))
@@ -429,9 +1110,40 @@ class Flash():
                                 addr_start=address,
                                 addr_len=length))
     if block:
-      while self.get_n_queued_ops() > 0:
-        time.sleep(0.001)
-      return self._read_callback_ihx.gets(address, length)
+      start = time.time()
+      with self.nqo_lock:
+        while address in self._pending_reads:
+          self._check_replies(start)
+          self.nqo_cond.wait(WAIT_POLL_PERIOD)
+      return self._read_image.gets(address, length)
+
+  def read_ranges(self, addrs, elapsed_ops_cb=None):
+    """
+    Read sets of addresses of the flash, keeping a window of read operations
+    in flight.
+
+    Parameters
+    ----------
+    addrs : list[(int, int), (int, int), ...]
+      List of min/max tuples of address ranges to read.
+    elapsed_ops_cb : function
+      Callback to execute with the number of elapsed operations of
+      self.write_ihx after each read is sent.
+
+    Returns
+    -------
+    out : FlashImage
+      FlashImage holding the data read from the address ranges.
+    """
+    self._read_image = self.new_image()
+    for addr, length in ihx_chunks(addrs):
+      self.wait_n_queued_ops(self.window - 1)
+      self.read(addr, length)
+      self.ihx_elapsed_ops += 1
+      if elapsed_ops_cb != None:
+        elapsed_ops_cb(self.ihx_elapsed_ops)
+    self.wait_n_queued_ops(0)
+    return self._read_image
 
   def _done_callback(self, sbp_msg, **metadata):
     """
@@ -444,13 +1156,22 @@ class Flash():
     """
     ret = ord(sbp_msg.payload)
 
+    with self.nqo_lock:
+      try:
+        kind, key, t_sent = self._pending_done.popleft()
+      except IndexError:
+        kind, key, t_sent = None, None, None
+      if kind == 'erase':
+        self._erase_log.append((key, t_sent, time.time(), ret))
+      if (ret != 0):
+        self.n_errors += 1
+        self._cut_window()
+        t_sent = None # Don't grow the window on an error's round trip.
+      self._finish_op(kind, t_sent)
+
     if (ret != 0):
       print "Flash operation returned error (%d)" % ret
 
-    self.dec_n_queued_ops()
-    assert self.get_n_queued_ops() >= 0, \
-      "Number of queued flash operations is negative"
-
   def _read_callback(self, sbp_msg, **metadata):
     """
     Handles flash read message sent from device.
@@ -464,21 +1185,160 @@ class Flash():
     address = struct.unpack('<I', sbp_msg.payload[0:4])[0]
     length = struct.unpack('B', sbp_msg.payload[4])[0]
 
-    self._read_callback_ihx.puts(address, sbp_msg.payload[5:])
+    with self.nqo_lock:
+      try:
+        self._read_image.puts(address, sbp_msg.payload[5:5+length])
+      except IndexError:
+        print "Flash read returned addresses outside of flash (0x%08X)" % \
+              address
+      self._finish_op('read', self._pending_reads.pop(address, None))
+
+  def _chunk_sectors(self, addr, length):
+    """ Sectors holding a chunk of addresses. """
+    return set([self.addr_sector_map(addr),
+                self.addr_sector_map(addr + length - 1)])
+
+  def _resume_journal(self, journal, image, sectors, chunks, n_chunk_ops,
+                      erase, stream=None):
+    """
+    Start recording the progress of self.write_ihx in an update journal, and
+    skip the work that an interrupted write of the same image recorded in it.
 
-    self.dec_n_queued_ops()
-    assert self.get_n_queued_ops() >= 0, \
-      "Number of queued flash operations is negative"
+    The recorded work is spot checked first, by reading back one verified
+    chunk and one chunk that should still be blank per sector, along with
+    every chunk programmed but not yet verified. The progress recorded for a
+    sector failing the check is dropped, so the sector is written again.
 
-  def write_ihx(self, ihx, stream=None, mod_print=0, elapsed_ops_cb=None, erase=True):
+    Parameters
+    ----------
+    journal : piksi_tools.flash_cache.UpdateJournal
+      Journal of this instance's flash.
+    image : FlashImage
+      Image being written.
+    sectors : list[int]
+      Sectors self.write_ihx would erase.
+    chunks : list[(int, int), (int, int), ...]
+      (address, length) tuples of the chunks self.write_ihx would write.
+    n_chunk_ops : dict
+      Number of operations per chunk address, see chunk_n_ops.
+    erase : bool
+      Whether self.write_ihx erases sectors before programming them.
+    stream : stream
+      Object implementing write and flush methods to write status updates to.
+
+    Returns
+    -------
+    out : (list[int], list[(int, int), ...])
+      Sectors still to be erased and chunks still to be written.
+    """
+    journal.start(image.digest())
+    if not journal.has_progress():
+      return sectors, chunks
+    # Work recorded in a sector that is erased again is lost.
+    if erase:
+      for sector in set(sectors) - journal.erased_sectors:
+        journal.forget(sector, *self.sector_addr_range(sector))
+
+    # Contents expected of the chunks to check, keyed by address.
+    checks = {}
+    checked_verified = set()
+    checked_blank = set()
+    for addr, length in chunks:
+      last = addr + length - 1
+      chunk_sectors = self._chunk_sectors(addr, length)
+      if ranges_cover(journal.verified, addr, last):
+        if not chunk_sectors <= checked_verified:
+          checks[addr] = image.gets(addr, length)
+          checked_verified |= chunk_sectors
+      elif ranges_cover(journal.programmed, addr, last):
+        checks[addr] = image.gets(addr, length)
+      elif erase and not chunk_sectors <= checked_blank and \
+           chunk_sectors <= journal.erased_sectors:
+        checks[addr] = ERASED_BYTE * length
+        checked_blank |= chunk_sectors
+    self.status = self.flash_type + " Flash: Checking interrupted write"
+    if stream:
+      stream.write('\r' + self.status)
+      stream.flush()
+    self._read_image = self.new_image()
+    for addr in sorted(checks):
+      self.wait_n_queued_ops(self.window - 1)
+      self.read(addr, len(checks[addr]))
+    self.wait_n_queued_ops(0)
+    failed = set()
+    for addr, expected in checks.items():
+      last = addr + len(expected) - 1
+      if not self._read_image.covers(addr, last) or \
+         self._read_image.gets(addr, len(expected)) != expected:
+        failed |= self._chunk_sectors(addr, len(expected))
+    for sector in failed:
+      journal.forget(sector, *self.sector_addr_range(sector))
+    for addr, expected in checks.items():
+      if ranges_cover(journal.programmed, addr, addr + len(expected) - 1):
+        journal.add_verified(addr, addr + len(expected) - 1)
+
+    # Skip the remaining recorded work, counting it as elapsed so progress
+    # matches self.ihx_n_ops.
+    if erase:
+      self.ihx_elapsed_ops += len([s for s in sectors
+                                   if s in journal.erased_sectors])
+      sectors = [s for s in sectors if s not in journal.erased_sectors]
+    remaining = []
+    for addr, length in chunks:
+      if ranges_cover(journal.verified, addr, addr + length - 1):
+        self.ihx_elapsed_ops += n_chunk_ops[addr]
+      else:
+        remaining.append((addr, length))
+    self.status = self.flash_type + " Flash: Resuming interrupted write, " + \
+                  "%d of %d chunks done" % (len(chunks) - len(remaining),
+                                            len(chunks))
+    if stream:
+      stream.write('\r' + self.status + '\n')
+      stream.flush()
+    journal.save()
+    return sectors, remaining
+
+  def _save_journal(self, journal, image, chunks):
+    """
+    Record the progress of the chunks sent by self.write_ihx in its journal
+    and save it.
+
+    Parameters
+    ----------
+    journal : piksi_tools.flash_cache.UpdateJournal
+      Journal of the write.
+    image : FlashImage
+      Image being written.
+    chunks : list[(int, int), (int, int), ...]
+      (address, length) tuples of chunks sent and not yet verified. Updated in
+      place to the chunks still waiting to be read back.
+    """
+    with self.nqo_lock:
+      programming = set([key for kind, key, t_sent in self._pending_done
+                         if kind == 'program'])
+      outstanding = []
+      for addr, length in chunks:
+        last = addr + length - 1
+        if addr in self._pending_reads:
+          if addr not in programming:
+            journal.add_programmed(addr, last)
+          outstanding.append((addr, length))
+        elif not image.mismatches(self._read_image, [(addr, last)]):
+          journal.add_verified(addr, last)
+    chunks[:] = outstanding
+    journal.save()
+
+  def write_ihx(self, ihx, stream=None, mod_print=0, elapsed_ops_cb=None,
+                erase=True, delta=False, baseline=None, erased_sectors=None,
+                blank_policy=BLANK_READ, journal=None):
     """
     Perform all operations to write an intelhex.IntelHex to the flash
     and verify.
 
     Parameters
     ----------
-    ihx : intelhex.IntelHex
-      intelhex.IntelHex to write to the flash.
+    ihx : intelhex.IntelHex or FlashImage
+      Image to write to the flash.
     stream : stream
       Object implementing write and flush methods to write status updates to.
     mod_print : int
@@ -487,6 +1347,25 @@ class Flash():
       Callback to execute every mod_print loops.
     erase : bool
       Erase sectors before writing.
+    delta : bool
+      Only erase and program the sectors in which ihx differs from the current
+      flash contents. Unchanged sectors are left untouched, including any
+      addresses in them not covered by ihx.
+    baseline : intelhex.IntelHex
+      Known current flash contents to compare against in delta mode, e.g. the
+      image last written to this device. If None, the flash contents at the
+      addresses used by ihx are read back from the device.
+    erased_sectors : list[int]
+      Sectors already erased before calling, when erase is False, e.g. by a
+      full erase of the flash.
+    blank_policy : str
+      Handling of chunks that only hold erased bytes (0xFF) in erased sectors,
+      one of BLANK_POLICIES. Programming them would not change the flash, so
+      by default they are only read back to verify the erase.
+    journal : piksi_tools.flash_cache.UpdateJournal
+      Journal to record the progress of the write in, and to resume an
+      interrupted write of the same image from, see self._resume_journal.
+      Removed once the write is verified.
     """
     self.ihx_elapsed_ops = 0
     self.print_count = 0
@@ -494,26 +1373,90 @@ class Flash():
     start_time = time.time()
 
     ihx_addrs = ihx_ranges(ihx)
+    sectors = sectors_used(ihx_addrs, self.addr_sector_map)
+    chunks = ihx_chunks(ihx_addrs)
+    # Copy ihx once into a flat image, which is cheap to slice and compare.
+    if isinstance(ihx, FlashImage):
+      image = ihx
+    else:
+      image = self.new_image(ihx)
+    # Classify chunks against the sectors that will be erased. In delta mode
+    # only changed sectors are erased, but the chunks kept there are then
+    # classified the same, and unchanged sectors already hold ihx's contents.
+    if erase:
+      erased_sectors = sectors
+    blank = blank_chunks(image, chunks, erased_sectors or [],
+                         self.addr_sector_map)
+    n_chunk_ops = dict([(addr, chunk_n_ops(addr in blank, blank_policy))
+                        for addr, length in chunks])
+
+    # Compare against the current flash contents and drop the sectors that
+    # already hold the right data. Skipped operations are counted as elapsed
+    # so progress matches self.ihx_n_ops(ihx, erase, delta=True).
+    if delta:
+      if baseline is None:
+        self.status = self.flash_type + " Flash: Reading current contents"
+        if stream:
+          stream.write('\r' + self.status)
+          stream.flush()
+        baseline = self.read_ranges(ihx_addrs, elapsed_ops_cb)
+      else:
+        self.ihx_elapsed_ops += len(chunks)
+      changed = sectors_changed(image, baseline, self.addr_sector_map, chunks)
+      unchanged = [addr for addr, length in chunks
+                   if self.addr_sector_map(addr) not in changed and
+                      self.addr_sector_map(addr + length - 1) not in changed]
+      self.ihx_elapsed_ops += sum([n_chunk_ops[addr] for addr in unchanged])
+      unchanged = set(unchanged)
+      chunks = [(addr, length) for addr, length in chunks
+                if addr not in unchanged]
+      if erase:
+        self.ihx_elapsed_ops += len(sectors) - len(changed)
+      sectors = changed
+      self.status = self.flash_type + " Flash: %d of %d sectors changed" % \
+                    (len(changed), len(sectors_used(ihx_addrs,
+                                                    self.addr_sector_map)))
+      if stream:
+        stream.write('\r' + self.status + '\n')
+        stream.flush()
+
+    if journal is not None:
+      sectors, chunks = self._resume_journal(journal, image, sectors, chunks,
+                                             n_chunk_ops, erase, stream)
 
     # Erase sectors
-    if erase:
-      for sector in sectors_used(ihx_addrs, self.addr_sector_map):
-        self.status = self.flash_type + " Flash: Erasing sector %d" % sector
+    if erase and sectors:
+      n_elapsed_ops = self.ihx_elapsed_ops
+      def erased_cb(n):
+        self.status = self.flash_type + " Flash: Erased %d of %d sectors" % \
+                      (n, len(sectors))
         if stream:
           stream.write('\r' + self.status)
           stream.flush()
-        self.erase_sector(sector)
-        self.ihx_elapsed_ops += 1
+        if journal is not None and n > self.ihx_elapsed_ops - n_elapsed_ops:
+          for sector, t_sent, t_done, ret in self._erase_log[:n]:
+            if ret == 0:
+              journal.add_erased(sector)
+          journal.save()
+        self.ihx_elapsed_ops = n_elapsed_ops + n
         if elapsed_ops_cb != None:
           elapsed_ops_cb(self.ihx_elapsed_ops)
+      self.erase_sectors(sectors, erased_cb=erased_cb)
       if stream:
         stream.write('\n')
 
+    # Drop data read back by earlier writes so it can't mask missing reads.
+    self._read_image = self.new_image()
+
+    # Chunks sent but not yet recorded as verified in the journal.
+    journal_chunks = []
+    journal_time = time.time()
+
     # Write data to flash and read back to later validate. STM's lowest address
     # is used by bootloader to check that the application is valid, so program
     # from high to low to ensure this address is programmed last.
-    for start, end in reversed(ihx_addrs):
-      for addr in reversed(range(start, end, ADDRS_PER_OP)):
+    try:
+      for addr, length in reversed(chunks):
         self.status = self.flash_type + " Flash: Programming address" + \
                                         " 0x%08X" % addr
         if mod_print == 0 or mod_print != 0 and self.print_count % mod_print == 0:
@@ -526,36 +1469,53 @@ class Flash():
         else:
           self.print_count += 1
 
-        binary = ihx.tobinstr(start=addr, size=ADDRS_PER_OP)
-
-        # Program ADDRS_PER_OP addresses
-        while self.get_n_queued_ops() >= self.max_queued_ops:
-          time.sleep(0.001)
-        self.program(addr, binary)
-        self.ihx_elapsed_ops += 1
-
-        # Read ADDRS_PER_OP addresses
-        while self.get_n_queued_ops() >= self.max_queued_ops:
-          time.sleep(0.001)
-        self.read(addr, ADDRS_PER_OP)
-        self.ihx_elapsed_ops += 1
+        # Program up to ADDRS_PER_OP addresses
+        if n_chunk_ops[addr] == 2:
+          binary = image.gets(addr, length)
+          self.wait_n_queued_ops(self.window - 1)
+          self.program(addr, binary)
+          self.ihx_elapsed_ops += 1
+
+        # Read up to ADDRS_PER_OP addresses
+        if n_chunk_ops[addr] >= 1:
+          self.wait_n_queued_ops(self.window - 1)
+          self.read(addr, length)
+          self.ihx_elapsed_ops += 1
+
+        if journal is not None and n_chunk_ops[addr] >= 1:
+          journal_chunks.append((addr, length))
+          if time.time() - journal_time > JOURNAL_SAVE_PERIOD:
+            self._save_journal(journal, image, journal_chunks)
+            journal_time = time.time()
+
+      self.wait_n_queued_ops(0)
+    finally:
+      if journal is not None:
+        self._save_journal(journal, image, journal_chunks)
 
     # Verify that data written to flash matches data read from flash.
-    while self.get_n_queued_ops() > 0:
-      time.sleep(0.001)
-    for start, end in reversed(ihx_addrs):
-      if self._read_callback_ihx.gets(start, end-start+1) != \
-          ihx.gets(start, end-start+1):
-        for i in range(start, end):
-          r = self._read_callback_ihx.gets(i,1)
-          p = ihx.gets(i,1)
-          if r != p:
-            raise Exception('Data read from flash != Data programmed to flash'
-              ('Addr: %x, Programmed: %x, Read: %x' % (i,r,p)).upper())
+    verified = []
+    for addr, length in chunks:
+      if n_chunk_ops[addr] == 0:
+        continue
+      if verified and verified[-1][1] == addr - 1:
+        verified[-1] = (verified[-1][0], addr + length - 1)
+      else:
+        verified.append((addr, addr + length - 1))
+    mismatches = image.mismatches(self._read_image, verified)
+    if mismatches:
+      raise Exception('Data read from flash != Data programmed to flash '
+                      '(Addr: %s)' % ', '.join(['%x-%x' % (first, last)
+                                                for first, last in mismatches]))
+
+    if journal is not None:
+      journal.finish()
 
     self.status = self.flash_type + " Flash: Successfully programmed and " + \
                                     "verified, total time = %d seconds" % \
                                     int(time.time()-start_time)
     if stream:
       stream.write('\n\r' + self.status + '\n')
-
+      stream.write(self.throughput_report(time.time() - start_time,
+                                          sum([length for addr, length
+                                               in chunks])) + '\n')
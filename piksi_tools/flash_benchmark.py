@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+The :mod:`piksi_tools.flash_benchmark` module measures the time taken by
+Bootloader.handshake and Flash.write_ihx against a simulated device, see
+piksi_tools.device_simulator, so flashing throughput can be compared between
+settings and between commits without hardware.
+"""
+
+import json
+import random
+import sys
+import time
+
+from sbp.client import Handler, Framer
+
+from bootload import Bootloader
+from device_simulator import DeviceSimulator, STM_FLASH_BASE
+from flash import Flash, FlashImage, ERASED_BYTE
+
+# Start of the STM application, after the restricted bootloader sector.
+STM_APP_BASE = STM_FLASH_BASE + 0x4000
+
+def random_image(base, size, blank_fraction=0.0, seed=0):
+  """
+  Create a FlashImage of random data, optionally ending in erased padding.
+
+  Parameters
+  ----------
+  base : int
+    First address of the image.
+  size : int
+    Number of addresses in the image.
+  blank_fraction : float
+    Fraction of the image, at its end, filled with erased bytes (0xFF).
+  seed : int
+    Seed for the random data.
+
+  Returns
+  -------
+  out : piksi_tools.flash.FlashImage
+  """
+  r = random.Random(seed)
+  n_blank = int(size * blank_fraction)
+  image = FlashImage(base, size)
+  image.puts(base, ''.join([chr(r.randint(0, 255))
+                            for i in range(size - n_blank)]))
+  image.puts(base + size - n_blank, ERASED_BYTE * n_blank)
+  return image
+
+def run_benchmark(flash_type="M25", size=0x10000, max_queued_ops=None,
+                  baud=1000000, op_latency=0.0002, erase_latency=0.01,
+                  rx_buffer_size=1024, blank_fraction=0.0, sbp_version=(0, 0),
+                  seed=0):
+  """
+  Handshake with and write an image to a simulated device.
+
+  Parameters
+  ----------
+  flash_type : string
+    Which flash to write ("M25" or "STM").
+  size : int
+    Size of the image to write.
+  max_queued_ops : int
+    Maximum number of queued flash operations, see piksi_tools.flash.Flash.
+    Tuned automatically if None.
+  baud : int
+    Simulated baud rate.
+  op_latency : float
+    Seconds the simulated device takes per program or read operation.
+  erase_latency : float
+    Seconds the simulated device takes per sector erase.
+  rx_buffer_size : int
+    Size of the simulated device's UART RX buffer.
+  blank_fraction : float
+    Fraction of the image filled with erased bytes, see random_image.
+  sbp_version : (int, int)
+    SBP protocol version reported by the simulated device.
+  seed : int
+    Seed for the image data.
+
+  Returns
+  -------
+  out : dict
+    Parameters and results: handshake and write times, write throughput,
+    number of operations, final window size and device statistics.
+  """
+  base = STM_APP_BASE if flash_type == "STM" else 0
+  image = random_image(base, size, blank_fraction, seed)
+  sim = DeviceSimulator(baud=baud, op_latency=op_latency,
+                        erase_latency=erase_latency,
+                        rx_buffer_size=rx_buffer_size, sbp_version=sbp_version)
+  with sim:
+    with Handler(Framer(sim.read, sim.write)) as link:
+      with Bootloader(link) as bootloader:
+        start_time = time.time()
+        if not bootloader.handshake(10):
+          raise Exception("No bootloader handshake received")
+        handshake_time = time.time() - start_time
+        with Flash(link, flash_type, bootloader.sbp_version,
+                   max_queued_ops=max_queued_ops) as flash:
+          start_time = time.time()
+          flash.write_ihx(image)
+          write_time = time.time() - start_time
+          n_ops = flash.ihx_elapsed_ops
+          window = flash.window
+          max_window = flash.max_window
+          n_errors = flash.n_errors
+  return {
+    'flash_type': flash_type,
+    'size': size,
+    'max_queued_ops': max_queued_ops,
+    'baud': baud,
+    'op_latency': op_latency,
+    'blank_fraction': blank_fraction,
+    'handshake_s': round(handshake_time, 4),
+    'write_s': round(write_time, 4),
+    'kbytes_per_s': round(size / 1024.0 / write_time, 2),
+    'ops': n_ops,
+    'window': window,
+    'max_window': max_window,
+    'error_replies': n_errors,
+    'rx_dropped': sim.host_to_device.n_dropped,
+    'device': sim.stats,
+  }
+
+def get_args():
+  """
+  Get and parse arguments.
+  """
+  import argparse
+  parser = argparse.ArgumentParser(description='Piksi Flash Benchmark')
+  parser.add_argument('-q', '--max-queued-ops', nargs='+',
+                      type=lambda x: None if x == 'auto' else int(x),
+                      default=[1, 2, 4, 8, 16, None],
+                      help='values of max_queued_ops to benchmark, "auto" to '
+                           'tune automatically.')
+  parser.add_argument('-s', '--stm', action='store_true',
+                      help='write to the STM flash instead of the M25 flash.')
+  parser.add_argument('--size', type=lambda x: int(x, 0), default=0x10000,
+                      help='size of the image to write.')
+  parser.add_argument('--blank-fraction', type=float, default=0.0,
+                      help='fraction of the image filled with 0xFF.')
+  parser.add_argument('-b', '--baud', type=int, default=1000000,
+                      help='simulated baud rate.')
+  parser.add_argument('--op-latency', type=float, default=0.0002,
+                      help='simulated seconds per program/read operation.')
+  parser.add_argument('--erase-latency', type=float, default=0.01,
+                      help='simulated seconds per sector erase.')
+  parser.add_argument('--rx-buffer-size', type=int, default=1024,
+                      help='simulated device UART RX buffer size.')
+  parser.add_argument('-r', '--repeat', type=int, default=1,
+                      help='number of runs per setting.')
+  parser.add_argument('--json', action='store_true',
+                      help='print results as JSON.')
+  return parser.parse_args()
+
+def main():
+  """
+  Run the benchmark for each setting and print the results.
+  """
+  args = get_args()
+  results = []
+  for max_queued_ops in args.max_queued_ops:
+    for i in range(args.repeat):
+      result = run_benchmark("STM" if args.stm else "M25", args.size,
+                             max_queued_ops, args.baud, args.op_latency,
+                             args.erase_latency, args.rx_buffer_size,
+                             args.blank_fraction, seed=i)
+      results.append(result)
+      if not args.json:
+        print "max_queued_ops %4s: handshake %.3f s, write %.3f s, " \
+              "%.1f kB/s, window %d (peak %d), %d ops, %d error replies, " \
+              "%d bytes dropped" % \
+              (max_queued_ops or 'auto', result['handshake_s'],
+               result['write_s'], result['kbytes_per_s'], result['window'],
+               result['max_window'], result['ops'], result['error_replies'],
+               result['rx_dropped'])
+        sys.stdout.flush()
+  if args.json:
+    print json.dumps(results, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+  main()
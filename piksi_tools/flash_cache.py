@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+The :mod:`piksi_tools.flash_cache` module keeps compiled firmware images on
+disk: Intel HEX files converted to flat binary images keyed by the SHA-1 of
+the file, so they are only parsed once, and copies of the images last written
+to each device, used as the baseline for delta flashing with
+piksi_tools.flash.Flash.write_ihx.
+
+An update journal is also kept per device and flash while an image is being
+written, recording the sectors erased and the address ranges programmed and
+verified so far, so an interrupted write can be resumed, see UpdateJournal.
+
+Compiled images are stored as a pair of files, a raw binary of the image's
+address region and a JSON header with its start address, size and the
+address segments holding data. Images are read into memory when loaded,
+rather than memory-mapped, so the files can be replaced or removed while an
+image is in use, which Windows doesn't allow for mapped files.
+"""
+
+import hashlib
+import json
+import os
+
+from intelhex import IntelHex
+
+from flash import FlashImage, add_range, remove_range
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.piksi_tools')
+
+# Version of the compiled image format, bumped whenever it changes.
+IMAGE_FORMAT_VERSION = 1
+# Version of the update journal format, bumped whenever it changes.
+JOURNAL_FORMAT_VERSION = 1
+
+def file_sha(filepath):
+  """
+  SHA-1 of the contents of a file.
+
+  Parameters
+  ----------
+  filepath : str
+    Path of the file.
+
+  Returns
+  -------
+  out : str
+    Hex digest of the file's SHA-1.
+  """
+  sha = hashlib.sha1()
+  with open(filepath, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 16), ''):
+      sha.update(block)
+  return sha.hexdigest()
+
+def _write_file(path, contents):
+  """
+  Write a file under a temporary name and rename it into place, so readers
+  never see a partially written file.
+  """
+  tmp_path = '%s.%d.tmp' % (path, os.getpid())
+  with open(tmp_path, 'wb') as f:
+    f.write(contents)
+  if os.path.exists(path):
+    os.remove(path)
+  os.rename(tmp_path, path)
+
+def save_image(image, path):
+  """
+  Write a FlashImage to disk in the compiled image format. Both files are
+  written under temporary names and renamed into place, header last, so a
+  concurrent or interrupted save never leaves a readable partial image.
+
+  Parameters
+  ----------
+  image : piksi_tools.flash.FlashImage
+    Image to save.
+  path : str
+    Path of the image, without extension.
+  """
+  if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  header = {'version': IMAGE_FORMAT_VERSION,
+            'start': image.start,
+            'size': image.size,
+            'segments': image.segments}
+  for ext, contents in [('.bin', image.data), ('.json', json.dumps(header))]:
+    _write_file(path + ext, contents)
+
+def load_image(path):
+  """
+  Load a FlashImage saved with save_image.
+
+  Parameters
+  ----------
+  path : str
+    Path of the image, without extension.
+
+  Returns
+  -------
+  out : piksi_tools.flash.FlashImage
+    Loaded image, or None if there is no valid image at path.
+  """
+  try:
+    with open(path + '.json', 'r') as f:
+      header = json.load(f)
+    if header['version'] != IMAGE_FORMAT_VERSION:
+      return None
+    with open(path + '.bin', 'rb') as f:
+      data = bytearray(f.read())
+    if len(data) != header['size']:
+      return None
+  except (IOError, OSError, ValueError, KeyError):
+    return None
+  return FlashImage(header['start'], header['size'], data,
+                    [tuple(s) for s in header['segments']])
+
+def remove_image(path):
+  """
+  Remove an image saved with save_image, if it exists.
+  """
+  for ext in ['.json', '.bin']:
+    if os.path.exists(path + ext):
+      os.remove(path + ext)
+
+def load_hex_file(filepath, cache_dir=CACHE_DIR):
+  """
+  Load an Intel HEX file as a FlashImage spanning the addresses it uses. The
+  file is parsed and compiled into the cache on first use, later loads of a
+  file with the same contents read the compiled image instead.
+
+  Parameters
+  ----------
+  filepath : str
+    Path to Intel HEX file.
+  cache_dir : str
+    Cache directory. If None, the file is parsed without using the cache.
+
+  Returns
+  -------
+  out : piksi_tools.flash.FlashImage
+    Image of the file's contents.
+  """
+  if cache_dir is not None:
+    path = os.path.join(cache_dir, 'images', file_sha(filepath))
+    image = load_image(path)
+    if image is not None:
+      return image
+  image = FlashImage.from_ihx(IntelHex(filepath))
+  if cache_dir is not None:
+    try:
+      save_image(image, path)
+    except (IOError, OSError):
+      pass # The cache is an optimization, carry on without it.
+  return image
+
+def device_id_str(unique_id):
+  """
+  Format an STM unique ID as used to key per-device cache entries.
+
+  Parameters
+  ----------
+  unique_id : tuple(int)
+    STM unique ID bytes, as returned by STMUniqueID.get_id.
+
+  Returns
+  -------
+  out : str
+    Hex string of the unique ID.
+  """
+  return ''.join(["%02x" % b for b in unique_id])
+
+def device_image_path(device_id, flash_type, cache_dir=CACHE_DIR):
+  """
+  Path, without extension, of the cached image last written to a device's
+  flash.
+
+  Parameters
+  ----------
+  device_id : str
+    Device ID, see device_id_str.
+  flash_type : string
+    Which Piksi flash ("M25" or "STM").
+  cache_dir : str
+    Cache directory.
+  """
+  return os.path.join(cache_dir, 'devices', device_id, flash_type.lower())
+
+def load_device_image(device_id, flash_type, cache_dir=CACHE_DIR):
+  """
+  Load the image last written to a device's flash.
+
+  Returns
+  -------
+  out : piksi_tools.flash.FlashImage
+    Cached image, or None if there is no cached image for the device.
+  """
+  return load_image(device_image_path(device_id, flash_type, cache_dir))
+
+def save_device_image(device_id, flash_type, image, cache_dir=CACHE_DIR):
+  """
+  Record the image written to a device's flash. Should only be called once the
+  image has been written and verified.
+
+  Parameters
+  ----------
+  image : intelhex.IntelHex or piksi_tools.flash.FlashImage
+    Image written to the device.
+  """
+  if isinstance(image, IntelHex):
+    image = FlashImage.from_ihx(image)
+  save_image(image, device_image_path(device_id, flash_type, cache_dir))
+
+def forget_device_image(device_id, flash_type, cache_dir=CACHE_DIR):
+  """
+  Drop the cached image of a device's flash. Should be called before the
+  flash is modified, so an interrupted write doesn't leave a stale baseline.
+  """
+  remove_image(device_image_path(device_id, flash_type, cache_dir))
+
+class UpdateJournal(object):
+  """
+  Persistent record of the progress of writing an image to a device's flash
+  with piksi_tools.flash.Flash.write_ihx: the digest of the image being
+  written, the sectors erased for it and the address ranges programmed and
+  verified so far. A write interrupted by a lost connection or a timeout can
+  then be resumed by a later write of the same image, which only checks a few
+  addresses of the completed work instead of redoing it.
+
+  The journal is saved as a small JSON file and removed once the write is
+  verified.
+  """
+
+  def __init__(self, path):
+    """
+    Parameters
+    ----------
+    path : str
+      Path of the journal file. An existing journal is loaded from it.
+    """
+    self.path = path
+    self.reset()
+    try:
+      with open(path, 'r') as f:
+        state = json.load(f)
+      if state['version'] == JOURNAL_FORMAT_VERSION:
+        self.image_digest = state['image_digest']
+        self.erased_sectors = set(state['erased_sectors'])
+        self.programmed = [tuple(r) for r in state['programmed']]
+        self.verified = [tuple(r) for r in state['verified']]
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+      self.reset()
+
+  def reset(self):
+    """
+    Forget all recorded progress, e.g. after the flash was modified outside of
+    the journaled write.
+    """
+    self.image_digest = None
+    self.erased_sectors = set()
+    self.programmed = []
+    self.verified = []
+
+  def has_progress(self):
+    """
+    Whether any progress is recorded.
+    """
+    return bool(self.erased_sectors or self.programmed)
+
+  def start(self, image_digest):
+    """
+    Begin or resume writing an image, dropping the progress recorded for any
+    other image.
+
+    Parameters
+    ----------
+    image_digest : str
+      Digest of the image, see piksi_tools.flash.FlashImage.digest.
+    """
+    if image_digest != self.image_digest:
+      self.reset()
+      self.image_digest = image_digest
+
+  def add_erased(self, sector):
+    self.erased_sectors.add(sector)
+
+  def add_programmed(self, first, last):
+    add_range(self.programmed, first, last)
+
+  def add_verified(self, first, last):
+    add_range(self.programmed, first, last)
+    add_range(self.verified, first, last)
+
+  def forget(self, sector, first, last):
+    """
+    Drop the progress recorded for a sector spanning addresses first to last.
+    """
+    self.erased_sectors.discard(sector)
+    remove_range(self.programmed, first, last)
+    remove_range(self.verified, first, last)
+
+  def save(self):
+    """
+    Write the journal to disk. Failures are ignored, the journal only saves
+    time on a later write.
+    """
+    state = {'version': JOURNAL_FORMAT_VERSION,
+             'image_digest': self.image_digest,
+             'erased_sectors': sorted(self.erased_sectors),
+             'programmed': self.programmed,
+             'verified': self.verified}
+    try:
+      if not os.path.isdir(os.path.dirname(self.path)):
+        os.makedirs(os.path.dirname(self.path))
+      _write_file(self.path, json.dumps(state))
+    except (IOError, OSError):
+      pass
+
+  def finish(self):
+    """
+    Remove the journal once its image has been written and verified.
+    """
+    self.reset()
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+def load_journal(device_id, flash_type, cache_dir=CACHE_DIR):
+  """
+  Load the update journal of a device's flash.
+
+  Parameters
+  ----------
+  device_id : str
+    Device ID, see device_id_str.
+  flash_type : string
+    Which Piksi flash ("M25" or "STM").
+  cache_dir : str
+    Cache directory.
+
+  Returns
+  -------
+  out : UpdateJournal
+    Journal of the device's flash, empty if no write was interrupted.
+  """
+  return UpdateJournal(device_image_path(device_id, flash_type, cache_dir) +
+                       '.journal')
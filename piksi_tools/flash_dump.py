@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+The :mod:`piksi_tools.flash_dump` module reads out the contents of the STM or
+M25 flash of a Piksi in bootloader mode to a binary or Intel HEX file, keeping
+many read requests in flight, and optionally verifies them against a
+reference image.
+"""
+
+import sys
+import time
+
+import flash
+import flash_cache
+import serial_link
+
+from bootload import Bootloader
+from timeout import TIMEOUT_GET_UNIQUE_ID
+from sbp.client import Handler, Framer
+
+FORMAT_BIN = 'bin'
+FORMAT_IHX = 'ihx'
+FORMATS = [FORMAT_BIN, FORMAT_IHX]
+
+def sectors_addr_range(piksi_flash, first_sector, last_sector):
+  """
+  Address range spanned by a range of sectors of a flash.
+
+  Parameters
+  ----------
+  piksi_flash : piksi_tools.flash.Flash
+    Flash the sectors belong to.
+  first_sector : int
+    First sector of the range.
+  last_sector : int
+    Last sector of the range, inclusive.
+
+  Returns
+  -------
+  out : (int, int)
+    First and last address of the sectors.
+  """
+  return (piksi_flash.sector_addr_range(first_sector)[0],
+          piksi_flash.sector_addr_range(last_sector)[1])
+
+def dump_flash(piksi_flash, first, last, stream=None):
+  """
+  Read a range of addresses of a flash.
+
+  Parameters
+  ----------
+  piksi_flash : piksi_tools.flash.Flash
+    Flash to read.
+  first : int
+    First address to read.
+  last : int
+    Last address to read, inclusive.
+  stream : stream
+    Object implementing write and flush methods to write progress to.
+
+  Returns
+  -------
+  out : piksi_tools.flash.FlashImage
+    Image of the flash holding the data read.
+  """
+  n_ops = len(flash.ihx_chunks([(first, last)]))
+  progress = [None]
+
+  def elapsed_ops_cb(n):
+    percent = 100 * n // n_ops
+    if stream and percent != progress[0]:
+      progress[0] = percent
+      stream.write('\r%s Flash: Reading %3d%%' % (piksi_flash.flash_type,
+                                                   percent))
+      stream.flush()
+  piksi_flash.ihx_elapsed_ops = 0
+  start_time = time.time()
+  image = piksi_flash.read_ranges([(first, last)], elapsed_ops_cb)
+  if stream:
+    stream.write('\n' + piksi_flash.throughput_report(time.time() - start_time,
+                                                      last + 1 - first) + '\n')
+  return image
+
+def dump_range(piksi_flash, address=None, length=None, sectors=None):
+  """
+  Addresses to dump: length addresses from address, a range of sectors, or
+  the whole flash.
+
+  Returns
+  -------
+  out : (int, int)
+    First and last address.
+  """
+  if address is not None:
+    return address, address + length - 1
+  if sectors:
+    return sectors_addr_range(piksi_flash, *sectors)
+  return sectors_addr_range(piksi_flash, 0, piksi_flash.n_sectors - 1)
+
+def load_reference(filepath, start):
+  """
+  Load a reference image to verify a dump against.
+
+  Parameters
+  ----------
+  filepath : str
+    Path of an Intel HEX file, or of a raw binary file.
+  start : int
+    Address of the first byte of a raw binary file.
+
+  Returns
+  -------
+  out : piksi_tools.flash.FlashImage
+  """
+  if filepath.lower().endswith('.hex'):
+    return flash_cache.load_hex_file(filepath)
+  with open(filepath, 'rb') as f:
+    data = f.read()
+  return flash.FlashImage(start, len(data), bytearray(data),
+                          [(start, start + len(data) - 1)] if data else [])
+
+def save_dump(image, first, last, filepath, fmt=None):
+  """
+  Write a range of addresses of a dumped image to a file.
+
+  Parameters
+  ----------
+  image : piksi_tools.flash.FlashImage
+    Dumped image.
+  first : int
+    First address to write.
+  last : int
+    Last address to write, inclusive.
+  filepath : str
+    Path of the file to write.
+  fmt : str
+    Format of the file, one of FORMATS, or None for ihx for .hex files and
+    bin otherwise.
+  """
+  if fmt is None:
+    fmt = FORMAT_IHX if filepath.lower().endswith('.hex') else FORMAT_BIN
+  if fmt == FORMAT_IHX:
+    dump = flash.FlashImage(first, last + 1 - first)
+    dump.puts(first, image.gets(first, last + 1 - first))
+    dump.to_ihx().write_hex_file(filepath)
+  else:
+    with open(filepath, 'wb') as f:
+      f.write(image.gets(first, last + 1 - first))
+
+def verify_dump(image, first, last, reference):
+  """
+  Compare a range of addresses of a dumped image with a reference image,
+  where the reference holds data.
+
+  Parameters
+  ----------
+  image : piksi_tools.flash.FlashImage
+    Dumped image.
+  first : int
+    First address to compare.
+  last : int
+    Last address to compare, inclusive.
+  reference : piksi_tools.flash.FlashImage
+    Reference image, see load_reference.
+
+  Returns
+  -------
+  out : list[(int, int)]
+    (first, last) address ranges that differ.
+  """
+  segments = []
+  for r_first, r_last in reference.segments:
+    if r_last >= first and r_first <= last:
+      segments.append((max(first, r_first), min(last, r_last)))
+  return reference.mismatches(image, segments)
+
+def record_baseline(link, sbp_version, flash_type, image):
+  """
+  Record a dumped image as the baseline for delta updates of the device,
+  keyed by its STM unique ID.
+
+  Returns
+  -------
+  out : str
+    Device ID, or None if the device didn't send its unique ID.
+  """
+  from stm_unique_id import STMUniqueID
+  with STMUniqueID(link) as stm_unique_id:
+    unique_id = stm_unique_id.get_id(sbp_version, TIMEOUT_GET_UNIQUE_ID)
+  if unique_id is None:
+    return None
+  device_id = flash_cache.device_id_str(unique_id)
+  flash_cache.save_device_image(device_id, flash_type, image)
+  return device_id
+
+def get_args():
+  """
+  Get and parse arguments.
+  """
+  import argparse
+  parser = argparse.ArgumentParser(description='Piksi Flash Dump')
+  parser.add_argument("file", nargs='?',
+                      help="the file to write the flash contents to.")
+  parser.add_argument('-m', '--m25',
+                      help='read the M25 (FPGA) flash.',
+                      action="store_true")
+  parser.add_argument('-s', '--stm',
+                      help='read the STM flash.',
+                      action="store_true")
+  parser.add_argument('--sectors', nargs=2, type=int,
+                      metavar=('FIRST', 'LAST'),
+                      help='range of sectors to read, defaults to all.')
+  parser.add_argument('--address', type=lambda x: int(x, 0),
+                      help='first address to read, instead of --sectors.')
+  parser.add_argument('--length', type=lambda x: int(x, 0),
+                      help='number of addresses to read from --address.')
+  parser.add_argument('--format', choices=FORMATS,
+                      help='format of the output file. Defaults to ihx for '
+                           '.hex files and bin otherwise.')
+  parser.add_argument('-r', '--reference',
+                      help='Intel hex or binary file to verify the flash '
+                           'contents against. Binary files start at the '
+                           'first address read.')
+  parser.add_argument('-c', '--cache-baseline',
+                      help='record the flash contents as the baseline for '
+                           'delta updates of this device, see bootload -c.',
+                      action="store_true")
+  parser.add_argument('-p', '--port',
+                      default=[serial_link.SERIAL_PORT], nargs=1,
+                      help='specify the serial port to use.')
+  parser.add_argument("-b", "--baud",
+                      default=[serial_link.SERIAL_BAUD], nargs=1,
+                      help="specify the baud rate to use.")
+  parser.add_argument("-q", "--max-queued-ops",
+                      default=[None], nargs=1, type=int,
+                      help="Maximum number of queued operations. Tuned "
+                           "automatically if not given.")
+  parser.add_argument("-f", "--ftdi",
+                      help="use pylibftdi instead of pyserial.",
+                      action="store_true")
+  parser.add_argument("-t", "--timeout", nargs=1, type=int,
+                      default=[None],
+                      help="Specify Timeout for which to wait for handshake.")
+  args = parser.parse_args()
+  if args.stm == args.m25:
+    parser.error("One of -s or -m options must be chosen")
+  elif (args.address is None) != (args.length is None):
+    parser.error("The --address and --length options must be used together")
+  elif args.address is not None and args.sectors:
+    parser.error("The --sectors and --address options are mutually exclusive")
+  elif not args.file and not args.reference and not args.cache_baseline:
+    parser.error("Nothing to do, give a file, -r or -c")
+  return args
+
+def main():
+  """
+  Get configuration, get driver, and build handler and start it.
+  """
+  args = get_args()
+  flash_type = "STM" if args.stm else "M25"
+  with serial_link.get_driver(args.ftdi, args.port[0], args.baud[0]) as driver:
+    with Handler(Framer(driver.read, driver.write)) as link:
+      with Bootloader(link) as piksi_bootloader:
+        print "Waiting for bootloader handshake message from Piksi ...",
+        sys.stdout.flush()
+        try:
+          handshake_received = piksi_bootloader.handshake(args.timeout[0])
+        except KeyboardInterrupt:
+          return
+        if not (handshake_received and piksi_bootloader.handshake_received):
+          print "No handshake received."
+          sys.exit(1)
+        print "received."
+
+        with flash.Flash(link, flash_type, piksi_bootloader.sbp_version,
+                         max_queued_ops=args.max_queued_ops[0]) as piksi_flash:
+          first, last = dump_range(piksi_flash, args.address, args.length,
+                                   args.sectors)
+          image = dump_flash(piksi_flash, first, last, sys.stdout)
+
+        device_id = None
+        if args.cache_baseline:
+          device_id = record_baseline(link, piksi_bootloader.sbp_version,
+                                      flash_type, image)
+          if device_id is None:
+            print "No STM unique ID received, baseline not recorded."
+          else:
+            print "Recorded baseline of device %s" % device_id
+
+        piksi_bootloader.jump_to_app()
+
+  if args.file:
+    save_dump(image, first, last, args.file, args.format)
+    print "Wrote 0x%08X-0x%08X to %s" % (first, last, args.file)
+
+  if args.reference:
+    mismatches = verify_dump(image, first, last,
+                             load_reference(args.reference, first))
+    if mismatches:
+      print "Flash differs from %s (Addr: %s)" % \
+            (args.reference, ', '.join(['%x-%x' % (m_first, m_last)
+                                        for m_first, m_last in mismatches]))
+      sys.exit(1)
+    print "Flash matches %s" % args.reference
+
+  if args.cache_baseline and device_id is None:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+The :mod:`piksi_tools.fleet_flash` module flashes STM and NAP firmware to many
+Piksis at once, using a pool of processes with one device per process.
+"""
+
+import glob
+import json
+import signal
+import sys
+import time
+import traceback
+
+from multiprocessing import Manager, Pool
+from Queue import Empty
+
+import flash
+import flash_cache
+import serial_link
+
+from bootload import Bootloader
+from stm_unique_id import STMUniqueID
+from timeout import Timeout, TIMEOUT_GET_UNIQUE_ID, TIMEOUT_WRITE_NAP, \
+                    TIMEOUT_WRITE_STM
+from sbp.client import Handler, Framer
+
+DEFAULT_PORT_GLOB = '/dev/serial/by-id/*Piksi*'
+DEFAULT_JOBS = 8
+DEFAULT_RETRIES = 2
+# Seconds an attempt at flashing a device may take, so a lost reply fails the
+# attempt rather than blocking its process forever.
+DEFAULT_FLASH_TIMEOUT = TIMEOUT_WRITE_STM + TIMEOUT_WRITE_NAP
+# Report progress of a device every time it advances by this many percent.
+PROGRESS_STEP = 10
+
+def find_ports(pattern=DEFAULT_PORT_GLOB):
+  """
+  Find the serial ports of attached devices.
+
+  Parameters
+  ----------
+  pattern : str
+    Glob pattern matching the serial port paths.
+
+  Returns
+  -------
+  out : list[str]
+    Sorted list of matching serial port paths.
+  """
+  return sorted(glob.glob(pattern))
+
+def flash_device(port, stm_file=None, nap_file=None,
+                 baud=serial_link.SERIAL_BAUD, use_ftdi=False, erase_stm=False,
+                 max_queued_ops=None, timeout=None, flash_timeout=None,
+                 progress_cb=None, cache_dir=flash_cache.CACHE_DIR):
+  """
+  Flash STM and/or NAP firmware to a single device, in one bootloader session,
+  and jump to the application once done.
+
+  Parameters
+  ----------
+  port : str
+    Serial port of the device.
+  stm_file : str
+    Path to Intel HEX file to write to the STM flash, or None.
+  nap_file : str
+    Path to Intel HEX file to write to the M25 (NAP) flash, or None.
+  baud : int
+    Serial port baud rate.
+  use_ftdi : bool
+    Use pylibftdi instead of pyserial.
+  erase_stm : bool
+    Erase all unrestricted sectors of the STM flash before writing.
+  max_queued_ops : int
+    Maximum number of queued flash operations, see piksi_tools.flash.Flash.
+    Tuned automatically if None.
+  timeout : int
+    Time to wait for the bootloader handshake, None to wait forever.
+  flash_timeout : float
+    Time the whole update may take, None for no limit. Raises
+    piksi_tools.timeout.TimeoutError once reached.
+  progress_cb : function
+    Called with the flash type, number of elapsed operations and total number
+    of operations as flashing progresses.
+  cache_dir : str
+    Cache directory of the compiled images and update journals, see
+    piksi_tools.flash_cache.
+
+  Returns
+  -------
+  out : dict
+    Device ID, bootloader version and per flash file, op count and time.
+  """
+  with Timeout(flash_timeout):
+    return _flash_device(port, stm_file, nap_file, baud, use_ftdi, erase_stm,
+                         max_queued_ops, timeout, progress_cb, cache_dir)
+
+def _flash_device(port, stm_file, nap_file, baud, use_ftdi, erase_stm,
+                  max_queued_ops, timeout, progress_cb, cache_dir):
+  """ Flash a device, see flash_device. """
+  result = {}
+  try:
+    driver = serial_link.get_driver(use_ftdi, port, baud)
+  except SystemExit:
+    raise Exception("Could not open serial port %s" % port)
+  with driver:
+    with Handler(Framer(driver.read, driver.write)) as link:
+      with Bootloader(link) as bootloader:
+        if not bootloader.handshake(timeout):
+          raise Exception("No bootloader handshake received")
+        result['bootloader_version'] = bootloader.version
+        with STMUniqueID(link) as stm_unique_id:
+          unique_id = stm_unique_id.get_id(bootloader.sbp_version,
+                                           TIMEOUT_GET_UNIQUE_ID)
+        if unique_id is None:
+          raise Exception("No STM unique ID received")
+        result['device_id'] = flash_cache.device_id_str(unique_id)
+        for flash_type, filepath in [("STM", stm_file), ("M25", nap_file)]:
+          if filepath is None:
+            continue
+          image = flash_cache.load_hex_file(filepath, cache_dir)
+          with flash.Flash(link, flash_type, bootloader.sbp_version,
+                           max_queued_ops=max_queued_ops) as piksi_flash:
+            start_time = time.time()
+            erased_sectors = None
+            if flash_type == "STM" and erase_stm:
+              erased_sectors = [s for s in range(piksi_flash.n_sectors)
+                                if s not in piksi_flash.restricted_sectors]
+              result['stm_erase_seconds'] = dict(
+                [(s, round(t, 3))
+                 for s, t in piksi_flash.erase_sectors(erased_sectors)])
+            erase = erased_sectors is None
+            # Retries resume from the progress recorded by failed attempts.
+            journal = flash_cache.load_journal(result['device_id'],
+                                               flash_type, cache_dir)
+            if not erase:
+              journal.reset()
+            n_ops = piksi_flash.ihx_n_ops(image, erase=erase,
+                                          erased_sectors=erased_sectors)
+            elapsed_ops_cb = None
+            if progress_cb is not None:
+              elapsed_ops_cb = lambda n: progress_cb(flash_type, n, n_ops)
+            piksi_flash.write_ihx(image, mod_print=0x10,
+                                  elapsed_ops_cb=elapsed_ops_cb, erase=erase,
+                                  erased_sectors=erased_sectors,
+                                  journal=journal)
+            result[flash_type.lower()] = {
+              'file': filepath,
+              'ops': n_ops,
+              'seconds': round(time.time() - start_time, 3),
+              'queued_ops': piksi_flash.window,
+              'peak_queued_ops': piksi_flash.max_window,
+              'error_replies': piksi_flash.n_errors,
+            }
+        bootloader.jump_to_app()
+  return result
+
+def _init_worker():
+  """ Leave handling of Ctrl-C to the parent process. """
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _flash_worker(port, retries, queue, kwargs):
+  """
+  Flash a device in a pool process, retrying on failure.
+
+  Returns
+  -------
+  out : dict
+    Report of the device, see flash_fleet.
+  """
+  def progress_cb(stage, n, total):
+    queue.put((port, stage, n, total))
+  report = {'port': port, 'status': 'failed', 'attempts': []}
+  for attempt in range(retries + 1):
+    if attempt > 0:
+      progress_cb('retry', attempt, retries)
+    start_time = time.time()
+    try:
+      report.update(flash_device(port, progress_cb=progress_cb, **kwargs))
+      error = None
+    except (Exception, SystemExit):
+      error = traceback.format_exc().strip().splitlines()[-1]
+    report['attempts'].append({'seconds': round(time.time() - start_time, 3),
+                               'error': error})
+    if error is None:
+      report['status'] = 'ok'
+      break
+  progress_cb(report['status'], 0, 0)
+  return report
+
+class FleetProgress(object):
+  """
+  Prints the progress of each device of a fleet flash to a stream, one line
+  per event, throttled to every PROGRESS_STEP percent.
+  """
+
+  def __init__(self, stream):
+    self.stream = stream
+    self.last = {}
+
+  def __call__(self, port, stage, n, total):
+    if stage == 'retry':
+      text = "retrying (%d of %d)" % (n, total)
+    elif stage in ['ok', 'failed']:
+      text = "done" if stage == 'ok' else "FAILED"
+    else:
+      percent = 100 * n // total if total else 100
+      if self.last.get(port) == (stage, percent // PROGRESS_STEP):
+        return
+      self.last[port] = (stage, percent // PROGRESS_STEP)
+      text = "%s flash %3d%%" % (stage, percent)
+    self.stream.write("%s: %s\n" % (port, text))
+    self.stream.flush()
+
+def flash_fleet(ports, jobs=DEFAULT_JOBS, retries=DEFAULT_RETRIES,
+                progress_cb=None, **kwargs):
+  """
+  Flash firmware to many devices at once, one process per device.
+
+  Parameters
+  ----------
+  ports : list[str]
+    Serial ports of the devices.
+  jobs : int
+    Maximum number of devices flashed at the same time.
+  retries : int
+    Number of times to retry flashing a device after a failure.
+  progress_cb : function
+    Called in this process with the port, stage (flash type, 'retry', 'ok' or
+    'failed'), number of elapsed operations and total number of operations.
+  kwargs : dict
+    Passed on to flash_device.
+
+  Returns
+  -------
+  out : list[dict]
+    Per device reports, in order of ports: port, status ('ok' or 'failed'),
+    list of attempts with duration and error, and the result of flash_device.
+  """
+  # Compile the images once up front so the workers share the cached copies.
+  cache_dir = kwargs.get('cache_dir', flash_cache.CACHE_DIR)
+  for filepath in [kwargs.get('stm_file'), kwargs.get('nap_file')]:
+    if filepath is not None:
+      flash_cache.load_hex_file(filepath, cache_dir)
+  manager = Manager()
+  queue = manager.Queue()
+  pool = Pool(max(1, min(jobs, len(ports))), _init_worker)
+  try:
+    results = [pool.apply_async(_flash_worker, (port, retries, queue, kwargs))
+               for port in ports]
+    pool.close()
+    done = False
+    while not done:
+      done = all([r.ready() for r in results])
+      try:
+        while True:
+          event = queue.get(timeout=0.1)
+          if progress_cb is not None:
+            progress_cb(*event)
+      except Empty:
+        pass
+    pool.join()
+  except KeyboardInterrupt:
+    pool.terminate()
+    raise
+  return [r.get() for r in results]
+
+def get_args():
+  """
+  Get and parse arguments.
+  """
+  import argparse
+  parser = argparse.ArgumentParser(description='Piksi Fleet Flasher')
+  parser.add_argument("ports", nargs='*',
+                      help="serial ports of the devices to flash. Defaults to "
+                           "all ports matching --glob.")
+  parser.add_argument('-s', '--stm',
+                      help='the Intel hex file to write to the STM flash.')
+  parser.add_argument('-m', '--m25',
+                      help='the Intel hex file to write to the M25 (FPGA) '
+                           'flash.')
+  parser.add_argument('-e', '--erase',
+                      help='erase all unrestricted sectors of the STM flash.',
+                      action="store_true")
+  parser.add_argument('-g', '--glob', default=DEFAULT_PORT_GLOB,
+                      help='pattern to find serial ports with when none are '
+                           'given.')
+  parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS,
+                      help="maximum number of devices to flash at once.")
+  parser.add_argument("-r", "--retries", type=int, default=DEFAULT_RETRIES,
+                      help="number of retries per device after a failure.")
+  parser.add_argument("-b", "--baud", type=int,
+                      default=serial_link.SERIAL_BAUD,
+                      help="specify the baud rate to use.")
+  parser.add_argument("-q", "--max-queued-ops", type=int,
+                      help="Maximum number of queued operations. Tuned "
+                           "automatically if not given.")
+  parser.add_argument("-t", "--timeout", type=int, default=30,
+                      help="time to wait for each bootloader handshake.")
+  parser.add_argument("-T", "--flash-timeout", type=float,
+                      default=DEFAULT_FLASH_TIMEOUT,
+                      help="time an attempt at flashing a device may take "
+                           "before it is retried.")
+  parser.add_argument("-o", "--report",
+                      help="file to write the JSON report to, defaults to "
+                           "stdout.")
+  args = parser.parse_args()
+  if not args.stm and not args.m25:
+    parser.error("At least one of -s or -m options must be chosen")
+  elif args.erase and not args.stm:
+    parser.error("The -e option requires the -s option to also be chosen")
+  return args
+
+def main():
+  """
+  Flash all devices and write the report.
+  """
+  args = get_args()
+  ports = args.ports or find_ports(args.glob)
+  if not ports:
+    print "No devices found."
+    sys.exit(1)
+  print "Flashing %d devices, %d at a time" % (len(ports), args.jobs)
+  start_time = time.time()
+  try:
+    devices = flash_fleet(ports, jobs=args.jobs, retries=args.retries,
+                          progress_cb=FleetProgress(sys.stdout),
+                          stm_file=args.stm, nap_file=args.m25,
+                          baud=args.baud, erase_stm=args.erase,
+                          max_queued_ops=args.max_queued_ops,
+                          timeout=args.timeout,
+                          flash_timeout=args.flash_timeout)
+  except KeyboardInterrupt:
+    return
+  n_failed = len([d for d in devices if d['status'] != 'ok'])
+  report = {
+    'stm_file': args.stm,
+    'nap_file': args.m25,
+    'seconds': round(time.time() - start_time, 3),
+    'n_ok': len(devices) - n_failed,
+    'n_failed': n_failed,
+    'devices': devices,
+  }
+  print "%d of %d devices flashed in %d seconds" % \
+        (report['n_ok'], len(devices), int(report['seconds']))
+  if args.report:
+    with open(args.report, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+  else:
+    print json.dumps(report, indent=2, sort_keys=True)
+  if n_failed:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -11,6 +11,8 @@
 
 from sbp.system import MsgHeartbeat
 
+from piksi_tools.timeout import Event
+
 class Heartbeat(object):
   """
   Handle receiving heartbeat messages from Piksi. Instance is callable and
@@ -19,11 +21,16 @@ class Heartbeat(object):
   """
 
   def __init__(self):
-    self.received = False
+    # Set once a heartbeat is received.
+    self.event = Event()
     # SBP version is unset in older devices
     self.sbp_version = (0, 0)
 
+  @property
+  def received(self):
+    return self.event.is_set()
+
   def __call__(self, sbp_msg, **metadata):
     hb = MsgHeartbeat(sbp_msg)
     self.sbp_version = ((hb.flags >> 16) & 0xFF, (hb.flags >> 8) & 0xFF)
-    self.received = True
+    self.event.set()
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+The :mod:`piksi_tools.json_log_index` module indexes JSON logs of SBP
+messages, one JSON record per line, by time and message type, so readers can
+seek straight to the records they need rather than parsing the whole log.
+
+The index is kept in a sidecar file next to the log, named after it with
+INDEX_SUFFIX. It is built while logging, see
+piksi_tools.log_writer.LogWriter, or after the fact with build_index, which
+only indexes the records added since the index was last updated.
+
+The time of a record is its 'timestamp' field, in seconds. Records are
+expected in time order, as they are logged.
+
+Sidecar file layout, all integers little-endian:
+
+- Header: INDEX_MAGIC and the format version (uint16).
+- Entries, appended as they're completed: the time of the first record in
+  microseconds (uint64), the byte offsets of the first record and of the
+  end of the last record (uint64 each), the number of message types of the
+  records (uint16) and those message types (uint16 each). An entry is
+  started every INDEX_PERIOD seconds or INDEX_BLOCK_SIZE bytes of records.
+"""
+
+import bisect
+import json
+import os
+import struct
+import warnings
+
+from sbp.msg import SBP
+from sbp.table import dispatch
+from sbp.client.loggers.json_logger import JSONLogIterator
+
+from parallel_decode import DEFAULT_JOBS, iter_lines, map_ranges
+
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = 'SBPJSIDX'
+FORMAT_VERSION = 1
+
+# Seconds and bytes of records covered by each index entry at most.
+INDEX_PERIOD = 1.0
+INDEX_BLOCK_SIZE = 0x10000
+
+_HEADER = struct.Struct('<8sH')
+_ENTRY = struct.Struct('<QQQH')
+
+def index_filename(filename):
+  """ Path of the sidecar index file of a log. """
+  return filename + INDEX_SUFFIX
+
+def record_info(line):
+  """
+  Time, in seconds, and message type of a JSON log record.
+
+  Raises
+  ------
+  ValueError
+    If the line isn't a JSON record of a SBP message.
+  """
+  try:
+    record = json.loads(line)
+    return record['timestamp'], record['data']['msg_type']
+  except (KeyError, TypeError):
+    raise ValueError("Not a SBP record: %s" % line)
+
+def _pack_entry(entry):
+  t, start, end, msg_types = entry
+  return _ENTRY.pack(t, start, end, len(msg_types)) + \
+         struct.pack('<%dH' % len(msg_types), *sorted(msg_types))
+
+def load_index(filename):
+  """
+  Load the index of a log from its sidecar file.
+
+  Returns
+  -------
+  out : [(int, int, int, set[int])]
+    Time in microseconds, first and end byte offsets and message types of
+    the records of each entry, or None if the log has no index. An entry
+    partially written when the index was last updated is left out.
+  """
+  try:
+    with open(index_filename(filename), 'rb') as f:
+      data = f.read()
+  except IOError:
+    return None
+  if len(data) < _HEADER.size or \
+      _HEADER.unpack_from(data) != (INDEX_MAGIC, FORMAT_VERSION):
+    return None
+  index = []
+  pos = _HEADER.size
+  while pos + _ENTRY.size <= len(data):
+    t, start, end, n_types = _ENTRY.unpack_from(data, pos)
+    if pos + _ENTRY.size + 2 * n_types > len(data):
+      break
+    msg_types = set(struct.unpack_from('<%dH' % n_types, data,
+                                       pos + _ENTRY.size))
+    index.append((t, start, end, msg_types))
+    pos += _ENTRY.size + 2 * n_types
+  return index
+
+class JSONLogIndexer(object):
+  """
+  Builds the index of a JSON log as records are added to it, appending
+  entries to the sidecar file as they're completed.
+
+  Parameters
+  ----------
+  filename : str
+    Path of the log, or None to only build the index in memory.
+  index : list
+    Entries of the existing index to extend, see load_index, or None to
+    start a new one.
+  """
+
+  def __init__(self, filename, index=None):
+    self.index = list(index or [])
+    self.entry = None
+    self.handle = None
+    if filename is None:
+      return
+    path = index_filename(filename)
+    if index:
+      # Drop whatever follows the loaded entries, e.g. a torn last entry.
+      self.handle = open(path, 'r+b')
+      self.handle.truncate(_HEADER.size +
+                           sum([len(_pack_entry(e)) for e in self.index]))
+      self.handle.seek(0, os.SEEK_END)
+    else:
+      self.handle = open(path, 'wb')
+      self.handle.write(_HEADER.pack(INDEX_MAGIC, FORMAT_VERSION))
+
+  @property
+  def end(self):
+    """ Byte offset of the end of the indexed records. """
+    if self.entry is not None:
+      return self.entry[2]
+    return self.index[-1][2] if self.index else 0
+
+  def add(self, t, msg_type, start, end):
+    """
+    Index a record.
+
+    Parameters
+    ----------
+    t : float
+      Time of the record, in seconds.
+    msg_type : int
+      Message type of the record.
+    start : int
+      Byte offset of the record.
+    end : int
+      Byte offset of the end of the record.
+    """
+    t = int(t * 1e6)
+    entry = self.entry
+    if entry is None or t - entry[0] >= INDEX_PERIOD * 1e6 or \
+        start - entry[1] >= INDEX_BLOCK_SIZE:
+      self._write_entry()
+      entry = self.entry = [t, start, end, set()]
+    entry[2] = end
+    entry[3].add(msg_type)
+
+  def add_entries(self, entries):
+    """
+    Append entries indexing records that follow those indexed so far, e.g.
+    built by another indexer.
+    """
+    self._write_entry()
+    for entry in entries:
+      self.entry = list(entry)
+      self._write_entry()
+
+  def _write_entry(self):
+    if self.entry is not None:
+      self.index.append(tuple(self.entry))
+      if self.handle is not None:
+        self.handle.write(_pack_entry(self.entry))
+      self.entry = None
+
+  def flush(self):
+    if self.handle is not None:
+      self.handle.flush()
+
+  def close(self):
+    """ Write the last entry and close the sidecar file. """
+    self._write_entry()
+    if self.handle is not None:
+      self.handle.close()
+
+def _index_range(filename, start, end):
+  """ Index the records of a range of a log, in memory. """
+  indexer = JSONLogIndexer(None)
+  with open(filename, 'rb') as f:
+    for first, last, line in iter_lines(f, start, end):
+      try:
+        t, msg_type = record_info(line)
+      except ValueError:
+        continue
+      indexer.add(t, msg_type, first, last)
+  indexer.close()
+  return indexer.index
+
+def build_index(filename, save=True, jobs=1):
+  """
+  Build or update the index of a JSON log, scanning the records added since
+  it was last updated, or the whole log if it has no index or was replaced.
+
+  Parameters
+  ----------
+  filename : str
+    Path of the log.
+  save : bool
+    Write the index to the sidecar file, rather than only returning it.
+  jobs : int
+    Number of processes scanning the log, see
+    piksi_tools.parallel_decode.map_ranges. Entries also end at the bounds
+    of the ranges scanned by each process.
+
+  Returns
+  -------
+  out : [(int, int, int, set[int])]
+    Entries of the index, see load_index.
+  """
+  index = load_index(filename)
+  if index and index[-1][2] > os.path.getsize(filename):
+    index = None
+  indexer = JSONLogIndexer(filename if save else None, index)
+  try:
+    for entries in map_ranges(_index_range, filename, jobs=jobs,
+                              start=indexer.end):
+      indexer.add_entries(entries)
+  finally:
+    indexer.close()
+  return indexer.index
+
+class IndexedJSONLogIterator(JSONLogIterator):
+  """
+  Reads JSON logs of SBP messages like
+  sbp.client.loggers.json_logger.JSONLogIterator, and seeks to the records
+  in a time range or of some message types with the sidecar index of the
+  log, which is built or updated the first time it's needed.
+
+  Parameters
+  ----------
+  filename : string
+    Path to file to read SBP messages from.
+  """
+
+  def __init__(self, filename, dispatcher=dispatch):
+    super(IndexedJSONLogIterator, self).__init__(filename, dispatcher)
+    self.filename = filename
+    self._index = None
+
+  @property
+  def index(self):
+    if self._index is None:
+      try:
+        self._index = build_index(self.filename)
+      except IOError:
+        # No write access next to the log.
+        self._index = build_index(self.filename, save=False)
+      self._times = [entry[0] for entry in self._index]
+    return self._index
+
+  def blocks(self, start=None, end=None, msg_types=None):
+    """
+    Byte ranges of the log holding records in a time range and of some
+    message types, found from the index.
+
+    Parameters
+    ----------
+    start : float
+      Earliest time, in seconds, or None.
+    end : float
+      Latest time, in seconds, or None.
+    msg_types : set[int]
+      Message types, or None for all.
+
+    Returns
+    -------
+    out : [(int, int)]
+      First and end (exclusive) byte offsets of each range.
+    """
+    index = self.index
+    first = 0
+    if start is not None:
+      first = max(0, bisect.bisect_left(self._times, int(start * 1e6)) - 1)
+    last = len(index)
+    if end is not None:
+      last = bisect.bisect_right(self._times, int(end * 1e6))
+    ranges = []
+    for t, block_start, block_end, block_types in index[first:last]:
+      if msg_types is not None and not (block_types & msg_types):
+        continue
+      if ranges and ranges[-1][1] == block_start:
+        ranges[-1] = (ranges[-1][0], block_end)
+      else:
+        ranges.append((block_start, block_end))
+    return ranges
+
+  def next(self, start=None, end=None, msg_types=None):
+    """
+    Return the records of the log, optionally only those in a time range
+    and of some message types, seeking past the others with the index.
+
+    Parameters
+    ----------
+    start : float
+      Earliest time, in seconds, or None.
+    end : float
+      Latest time, in seconds, or None.
+    msg_types : iterable of int
+      Message types, or None for all.
+
+    Returns
+    -------
+    out : generator
+      (msg, metadata) tuples.
+    """
+    if start is None and end is None and msg_types is None:
+      for item in super(IndexedJSONLogIterator, self).next():
+        yield item
+      return
+    if msg_types is not None:
+      msg_types = set(msg_types)
+    try:
+      for first, last in self.blocks(start, end, msg_types):
+        self.handle.seek(first)
+        for line in self.handle.read(last - first).splitlines():
+          try:
+            data = json.loads(line)
+            t = data['timestamp']
+            msg_type = data['data']['msg_type']
+          except (ValueError, KeyError, TypeError):
+            warn = "Bad JSON decoding for line %s" % line
+            warnings.warn(warn, RuntimeWarning)
+            continue
+          if start is not None and t < start:
+            continue
+          if end is not None and t > end:
+            return
+          if msg_types is not None and msg_type not in msg_types:
+            continue
+          item = SBP.from_json_dict(data.pop('data'))
+          yield (self.dispatch(item, line), data)
+    finally:
+      self.handle.seek(0, 0)
+
+def get_args():
+  """
+  Get and parse arguments.
+  """
+  import argparse
+  parser = argparse.ArgumentParser(description='JSON SBP log indexer')
+  parser.add_argument("logs", nargs='+',
+                      help="JSON logs to build or update the index of.")
+  parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS,
+                      help="number of processes scanning each log, one per "
+                           "core by default.")
+  return parser.parse_args()
+
+def main():
+  args = get_args()
+  for filename in args.logs:
+    index = build_index(filename, jobs=args.jobs)
+    if not index:
+      print "%s: no records" % filename
+      continue
+    msg_types = set()
+    for entry in index:
+      msg_types |= entry[3]
+    print "%s: %d entries, %d bytes, %d message types, %.0f seconds" % \
+          (filename, len(index), index[-1][2], len(msg_types),
+           (index[-1][0] - index[0][0]) / 1e6)
+
+if __name__ == "__main__":
+  main()
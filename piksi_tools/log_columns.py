@@ -0,0 +1,583 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+The :mod:`piksi_tools.log_columns` module converts logs of SBP messages into
+tables of typed numpy columns, one table per message type, written to HDF5
+or NPZ files for analysis.
+
+The fields of each message type and their types are found from its sbp
+parser. Nested fields are named after their path, e.g. 'header.t.tow' of
+MsgObs. The elements of a variable length field at the end of a message,
+e.g. the observations of MsgObs or the channel states of MsgTrackingState,
+go in a table of their own, e.g. 'MsgObs.obs', with a 'msg_index' column
+holding the row of their message in the message's table. Message tables
+also have 'timestamp' and 'delta' columns, the host time the message was
+logged at, in seconds, and the time since the start of the log, in
+milliseconds. Message types with non numeric fields, e.g. strings, are
+left out.
+
+Payloads are decoded in bulk, CHUNK_ROWS messages at a time, straight into
+preallocated columns that are written out whenever they fill up, so
+converting a log takes about as much memory whatever its size.
+
+In HDF5 files, each table is a group and each column a dataset of the
+group. In NPZ files, each column is an array named '<table>/<column>'.
+Both are read back with load_table.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+
+import parallel_decode
+import serial_link
+
+from json_log_index import IndexedJSONLogIterator
+from sbp.table import _SBP_TABLE
+
+# Number of messages of a type decoded at once, and rows of a table kept in
+# memory before being written out.
+CHUNK_ROWS = 0x10000
+
+HDF5_EXTENSIONS = ['.h5', '.hdf5']
+NPZ_EXTENSION = '.npz'
+
+_STRUCT_TYPES = {'b': 'i1', 'B': 'u1', 'h': 'i2', 'H': 'u2', 'i': 'i4',
+                 'I': 'u4', 'l': 'i4', 'L': 'u4', 'q': 'i8', 'Q': 'u8',
+                 'f': 'f4', 'd': 'f8'}
+
+_MSG_COLUMNS = [('timestamp', '<f8'), ('delta', '<f8')]
+_ELEMENT_COLUMNS = [('msg_index', '<i8')]
+
+def _field_dtype(fmt):
+  """ numpy type of a struct format of a single field, e.g. '<L'. """
+  byte_order = fmt[0] if fmt[0] in '<>' else '<'
+  return byte_order + _STRUCT_TYPES[fmt[-1]]
+
+def _fields(con, prefix=''):
+  """
+  Fixed size fields of a construct Struct, as (name, numpy type[, shape]),
+  and its variable length field at the end, if any, as (name, construct).
+
+  Raises
+  ------
+  ValueError
+    If the Struct has non numeric or variable length fields other than one
+    at the end.
+  """
+  fields = []
+  repeated = None
+  for sc in con.subcons:
+    if repeated is not None:
+      raise ValueError("%s follows a variable length field" % sc.name)
+    kind = type(sc).__name__
+    if kind == 'FormatField':
+      fields.append((prefix + sc.name, _field_dtype(sc.packer.format)))
+    elif kind == 'Reconfig':
+      # Renamed Struct, whose fields are those of this one.
+      if type(sc.subcon).__name__ != 'Struct':
+        raise ValueError("%s isn't numeric" % sc.name)
+      sub_fields, repeated = _fields(sc.subcon, prefix)
+      fields += sub_fields
+    elif kind == 'Struct':
+      sub_fields, repeated = _fields(sc, prefix + sc.name + '.')
+      fields += sub_fields
+    elif kind == 'MetaArray' and type(sc.subcon).__name__ == 'FormatField':
+      try:
+        count = int(sc.countfunc({}))
+      except Exception:
+        raise ValueError("%s has a variable length" % sc.name)
+      fields.append((prefix + sc.name, _field_dtype(sc.subcon.packer.format),
+                     (count,)))
+    elif kind in ['Range', 'GreedyRange']:
+      repeated = (prefix + sc.name, sc.subcon)
+    else:
+      raise ValueError("%s isn't numeric" % sc.name)
+  return fields, repeated
+
+class MessageLayout(object):
+  """
+  Layout of the payload of a message type as numpy types: a fixed size
+  head, optionally followed by any number of fixed size elements.
+
+  Parameters
+  ----------
+  msg_class : type
+    Class of the message type, e.g. sbp.navigation.MsgPosLLH.
+
+  Raises
+  ------
+  ValueError
+    If the message type has fields the layout can't hold.
+  """
+
+  def __init__(self, msg_class):
+    self.name = msg_class.__name__
+    fields, repeated = _fields(msg_class._parser)
+    # numpy has no types without fields.
+    self.head = np.dtype(fields) if fields else None
+    self.element = None
+    self.element_name = None
+    if repeated is not None:
+      element = repeated[1]
+      kind = type(element).__name__
+      if kind == 'FormatField':
+        element_fields, nested = \
+          [(element.name, _field_dtype(element.packer.format))], None
+      elif kind == 'Struct':
+        element_fields, nested = _fields(element)
+      else:
+        raise ValueError("%s isn't numeric" % repeated[0])
+      if nested is not None or not element_fields:
+        raise ValueError("%s has nested variable length fields" % self.name)
+      self.element = np.dtype(element_fields)
+      self.element_name = '%s.%s' % (self.name, repeated[0])
+
+  def decode(self, payloads):
+    """
+    Decode payloads of the message type, leaving out those whose size
+    doesn't match the layout.
+
+    Returns
+    -------
+    out : (numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray)
+      Whether each payload is valid, the heads of the valid ones or None
+      if the layout has no head, their elements or None, and for each
+      element the index of its payload among the valid ones or None.
+    """
+    size = self.head.itemsize if self.head is not None else 0
+    sizes = np.array([len(p) for p in payloads])
+    if self.element is None:
+      valid = sizes == size
+    else:
+      valid = (sizes >= size) & ((sizes - size) % self.element.itemsize == 0)
+    payloads = [p for p, v in zip(payloads, valid) if v]
+    heads = None
+    if self.head is not None:
+      heads = np.frombuffer(''.join([p[:size] for p in payloads]), self.head)
+    if self.element is None:
+      return valid, heads, None, None
+    elements = np.frombuffer(''.join([p[size:] for p in payloads]),
+                             self.element)
+    counts = (sizes[valid] - size) // self.element.itemsize
+    return valid, heads, elements, np.repeat(np.arange(len(payloads)), counts)
+
+_layouts = {}
+
+def message_layout(msg_type):
+  """ MessageLayout of a message type, None if it has none. """
+  if msg_type not in _layouts:
+    layout = None
+    msg_class = _SBP_TABLE.get(msg_type)
+    if msg_class is not None and hasattr(msg_class, '_parser'):
+      try:
+        layout = MessageLayout(msg_class)
+      except ValueError:
+        pass
+    _layouts[msg_type] = layout
+  return _layouts[msg_type]
+
+class ColumnBuffer(object):
+  """
+  Preallocated columns of a table, as a numpy record array grown a chunk of
+  rows at a time.
+
+  Parameters
+  ----------
+  dtype : numpy.dtype
+    Columns of the table.
+  chunk_rows : int
+    Rows to grow the columns by.
+  """
+
+  def __init__(self, dtype, chunk_rows=CHUNK_ROWS):
+    self.chunk_rows = chunk_rows
+    self.data = np.empty(chunk_rows, dtype)
+    self.n = 0
+
+  def __len__(self):
+    return self.n
+
+  def append(self, n, **columns):
+    """ Append n rows, given the values of each column. """
+    if self.n + n > len(self.data):
+      grow = -(-(self.n + n - len(self.data)) // self.chunk_rows)
+      self.data = np.resize(self.data, len(self.data) + grow * self.chunk_rows)
+    rows = self.data[self.n:self.n + n]
+    for name, values in columns.items():
+      rows[name] = values
+    self.n += n
+
+  def take(self):
+    """ Return the rows appended so far and start again from empty. """
+    rows = self.data[:self.n].copy()
+    self.n = 0
+    return rows
+
+class _HDF5Sink(object):
+  """ Appends columns to datasets of an HDF5 file, one group per table. """
+
+  def __init__(self, path):
+    try:
+      import h5py
+    except ImportError:
+      raise ImportError("HDF5 export requires the h5py package")
+    self.f = h5py.File(path, 'w')
+
+  def append(self, table, rows):
+    group = self.f.require_group(table)
+    for name in rows.dtype.names:
+      values = rows[name]
+      if name not in group:
+        group.create_dataset(name, data=values, chunks=True,
+                             maxshape=(None,) + values.shape[1:])
+      else:
+        dataset = group[name]
+        n = dataset.shape[0]
+        dataset.resize(n + len(values), axis=0)
+        dataset[n:] = values
+
+  def close(self):
+    self.f.close()
+
+class _NPZSink(object):
+  """
+  Appends columns to temporary files, gathered into an NPZ file when
+  closed, as numpy can only write whole arrays to NPZ files.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.tmp_dir = tempfile.mkdtemp(prefix='log_columns')
+    # Per array name: temporary file, dtype, element shape and rows.
+    self.arrays = {}
+
+  def append(self, table, rows):
+    for name in rows.dtype.names:
+      key = '%s/%s' % (table, name)
+      values = np.ascontiguousarray(rows[name])
+      if key not in self.arrays:
+        path = os.path.join(self.tmp_dir, str(len(self.arrays)))
+        self.arrays[key] = [open(path, 'wb'), values.dtype,
+                            values.shape[1:], 0]
+      entry = self.arrays[key]
+      entry[0].write(values.tostring())
+      entry[3] += len(values)
+
+  def close(self):
+    try:
+      with zipfile.ZipFile(self.path, 'w', zipfile.ZIP_STORED,
+                           allowZip64=True) as zf:
+        for key, (f, dtype, shape, n) in sorted(self.arrays.items()):
+          f.close()
+          npy_path = f.name + '.npy'
+          with open(npy_path, 'wb') as npy, open(f.name, 'rb') as data:
+            np.lib.format.write_array_header_1_0(
+              npy, {'descr': np.lib.format.dtype_to_descr(dtype),
+                    'fortran_order': False, 'shape': (n,) + shape})
+            shutil.copyfileobj(data, npy)
+          os.remove(f.name)
+          zf.write(npy_path, key + '.npy')
+          os.remove(npy_path)
+    finally:
+      shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+def _sink(path):
+  ext = os.path.splitext(path)[1].lower()
+  if ext in HDF5_EXTENSIONS:
+    return _HDF5Sink(path)
+  elif ext == NPZ_EXTENSION:
+    return _NPZSink(path)
+  raise ValueError("Unknown output format %s, expected one of %s" %
+                   (ext, ', '.join(HDF5_EXTENSIONS + [NPZ_EXTENSION])))
+
+class ColumnExporter(object):
+  """
+  Callable sink of SBP messages, e.g. from a log iterator or a Handler,
+  converting them into tables of numpy columns, see the module
+  documentation.
+
+  Parameters
+  ----------
+  path : str
+    HDF5 (.h5, .hdf5) or NPZ (.npz) file to write the tables to, or None to
+    keep them in memory, in tables.
+  msg_types : iterable of int
+    Message types to convert, None for all.
+  chunk_rows : int
+    Number of messages of a type decoded at once, and rows of a table kept
+    in memory before being written out.
+  """
+
+  def __init__(self, path=None, msg_types=None, chunk_rows=CHUNK_ROWS):
+    self.sink = _sink(path) if path is not None else None
+    self.msg_types = set(msg_types) if msg_types is not None else None
+    self.chunk_rows = chunk_rows
+    # Per message type, pending payloads, timestamps and deltas.
+    self.pending = {}
+    self.buffers = {}
+    # Rows of each table, written or not.
+    self.n_rows = {}
+    self.n_skipped = 0
+    self.n_invalid = 0
+    self.tables = {}
+
+  def __call__(self, msg, **metadata):
+    msg_type = msg.msg_type
+    if self.msg_types is not None and msg_type not in self.msg_types:
+      return
+    pending = self.pending.get(msg_type)
+    if pending is None:
+      if message_layout(msg_type) is None:
+        self.n_skipped += 1
+        return
+      pending = self.pending[msg_type] = ([], [], [])
+    payloads, timestamps, deltas = pending
+    payloads.append(msg.payload)
+    timestamps.append(metadata.get('time', metadata.get('timestamp', 0)))
+    deltas.append(metadata.get('delta', 0))
+    if len(payloads) >= self.chunk_rows:
+      self._decode(msg_type)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _buffer(self, table, dtype):
+    if table not in self.buffers:
+      self.buffers[table] = ColumnBuffer(dtype, self.chunk_rows)
+      self.n_rows[table] = 0
+    return self.buffers[table]
+
+  def _decode(self, msg_type):
+    """ Decode the pending messages of a type into the column buffers. """
+    layout = message_layout(msg_type)
+    payloads, timestamps, deltas = self.pending[msg_type]
+    self.pending[msg_type] = ([], [], [])
+    valid, heads, elements, element_msgs = layout.decode(payloads)
+    n = int(valid.sum())
+    self.n_invalid += len(payloads) - n
+    columns = {}
+    head_columns = []
+    if heads is not None:
+      columns = dict([(name, heads[name]) for name in layout.head.names])
+      head_columns = layout.head.descr
+    buf = self._buffer(layout.name, np.dtype(_MSG_COLUMNS + head_columns))
+    first_row = self.n_rows[layout.name]
+    buf.append(n, timestamp=np.array(timestamps)[valid],
+               delta=np.array(deltas)[valid], **columns)
+    self.n_rows[layout.name] += n
+    self._flush(layout.name)
+    if layout.element is not None:
+      columns = dict([(name, elements[name]) for name in layout.element.names])
+      buf = self._buffer(layout.element_name,
+                         np.dtype(_ELEMENT_COLUMNS + layout.element.descr))
+      buf.append(len(elements), msg_index=element_msgs + first_row, **columns)
+      self.n_rows[layout.element_name] += len(elements)
+      self._flush(layout.element_name)
+
+  def _flush(self, table, force=False):
+    """ Write out the rows of a table if it's full. """
+    buf = self.buffers[table]
+    if self.sink is not None and (force or len(buf) >= self.chunk_rows):
+      if len(buf):
+        self.sink.append(table, buf.take())
+
+  def _decode_pending(self):
+    for msg_type in list(self.pending.keys()):
+      if self.pending[msg_type][0]:
+        self._decode(msg_type)
+
+  def take_rows(self):
+    """
+    Decode the pending messages and return the rows not written out yet.
+
+    Returns
+    -------
+    out : dict
+      numpy record array of the rows of each table, by name.
+    """
+    self._decode_pending()
+    return dict([(table, buf.take()) for table, buf in self.buffers.items()])
+
+  def append_rows(self, rows):
+    """
+    Append rows of tables, e.g. from take_rows of another exporter. The
+    'msg_index' columns of element tables are taken to be relative to the
+    rows of their message tables given with them.
+
+    Parameters
+    ----------
+    rows : dict
+      numpy record array of the rows of each table, by name.
+    """
+    first_rows = dict([(table, self.n_rows.get(table, 0)) for table in rows])
+    for table, table_rows in rows.items():
+      columns = dict([(name, table_rows[name])
+                      for name in table_rows.dtype.names])
+      if 'msg_index' in columns:
+        columns['msg_index'] = columns['msg_index'] + \
+                               first_rows.get(table.split('.')[0], 0)
+      self._buffer(table, table_rows.dtype).append(len(table_rows), **columns)
+      self.n_rows[table] += len(table_rows)
+      self._flush(table)
+
+  def close(self):
+    """ Decode the pending messages and write out all the rows. """
+    self._decode_pending()
+    for table in self.buffers:
+      if self.sink is None:
+        rows = self.buffers[table].take()
+        self.tables[table] = dict([(name, rows[name])
+                                   for name in rows.dtype.names])
+      else:
+        self._flush(table, force=True)
+    if self.sink is not None:
+      self.sink.close()
+      self.sink = None
+
+def _export_range(filename, start, end, msg_types, chunk_rows):
+  """
+  Convert a range of a JSON log, returning the rows of each table and the
+  numbers of skipped and invalid messages.
+  """
+  exporter = ColumnExporter(None, msg_types, chunk_rows)
+  for msg, metadata in parallel_decode.json_records(filename, start, end):
+    exporter(msg, **metadata)
+  return exporter.take_rows(), exporter.n_skipped, exporter.n_invalid
+
+def export_log(filename, path=None, msg_types=None, fmt=None, jobs=1):
+  """
+  Convert a log into tables of numpy columns, see ColumnExporter.
+
+  Parameters
+  ----------
+  filename : str
+    Log to convert, JSON or binary, see
+    piksi_tools.serial_link.get_log_iterator.
+  path : str
+    HDF5 or NPZ file to write the tables to, or None to keep them in memory.
+  msg_types : iterable of int
+    Message types to convert, None for all.
+  fmt : str
+    Format of the log, or None to detect it.
+  jobs : int
+    Number of processes converting uncompressed JSON logs, see
+    piksi_tools.parallel_decode.map_ranges. Other logs are converted in
+    this process.
+
+  Returns
+  -------
+  out : ColumnExporter
+    The exporter, holding the number of rows of each table, and the tables
+    if path is None.
+  """
+  # Payloads are decoded in bulk, leave messages undecoded.
+  log = serial_link.get_log_iterator(filename, fmt, dispatcher=lambda m: m)
+  try:
+    with ColumnExporter(path, msg_types) as exporter:
+      if jobs != 1 and isinstance(log, IndexedJSONLogIterator):
+        args = (exporter.msg_types, exporter.chunk_rows)
+        for rows, n_skipped, n_invalid in \
+            parallel_decode.map_ranges(_export_range, filename, args, jobs):
+          exporter.append_rows(rows)
+          exporter.n_skipped += n_skipped
+          exporter.n_invalid += n_invalid
+      else:
+        for msg, metadata in log.next():
+          exporter(msg, **metadata)
+  finally:
+    log.close()
+  return exporter
+
+def load_table(path, table, columns=None):
+  """
+  Load a table written by ColumnExporter.
+
+  Parameters
+  ----------
+  path : str
+    HDF5 or NPZ file.
+  table : str
+    Name of the table, e.g. 'MsgPosLLH'.
+  columns : iterable of str
+    Columns to load, None for all.
+
+  Returns
+  -------
+  out : dict
+    numpy array of each column, by name.
+  """
+  ext = os.path.splitext(path)[1].lower()
+  if ext in HDF5_EXTENSIONS:
+    import h5py
+    with h5py.File(path, 'r') as f:
+      group = f[table]
+      return dict([(name, group[name][...])
+                   for name in (columns or group.keys())])
+  npz = np.load(path)
+  try:
+    prefix = table + '/'
+    names = [key[len(prefix):] for key in npz.files if key.startswith(prefix)]
+    if not names:
+      raise KeyError(table)
+    return dict([(name, npz[prefix + name])
+                 for name in (columns or names)])
+  finally:
+    npz.close()
+
+def get_args():
+  """
+  Get and parse arguments.
+  """
+  import argparse
+  parser = argparse.ArgumentParser(
+    description='SBP log to HDF5/NPZ columns converter')
+  parser.add_argument("log", help="JSON or binary SBP log to convert.")
+  parser.add_argument("output",
+                      help="HDF5 (.h5, .hdf5) or NPZ (.npz) file to write.")
+  parser.add_argument("-m", "--msg-type", action="append",
+                      help="name of a message type to convert, e.g. "
+                           "MsgPosLLH, all by default. May be repeated.")
+  parser.add_argument("-j", "--jobs", type=int,
+                      default=parallel_decode.DEFAULT_JOBS,
+                      help="number of processes converting JSON logs, one "
+                           "per core by default.")
+  return parser.parse_args()
+
+def main():
+  args = get_args()
+  msg_types = None
+  if args.msg_type:
+    names = dict([(cls.__name__, msg_type)
+                  for msg_type, cls in _SBP_TABLE.items()])
+    unknown = [name for name in args.msg_type if name not in names]
+    if unknown:
+      print "Unknown message types: %s" % ', '.join(unknown)
+      sys.exit(1)
+    msg_types = [names[name] for name in args.msg_type]
+  start_time = time.time()
+  exporter = export_log(args.log, args.output, msg_types, jobs=args.jobs)
+  for table, n in sorted(exporter.n_rows.items()):
+    print "%-32s %10d rows" % (table, n)
+  print "Wrote %s in %.1f seconds, %d messages without a layout skipped" % \
+        (args.output, time.time() - start_time, exporter.n_skipped)
+
+if __name__ == "__main__":
+  main()
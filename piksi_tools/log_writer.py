@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+The :mod:`piksi_tools.log_writer` module writes SBP logs from a dedicated
+thread, so a slow disk never stalls the thread reading messages from a
+device, rotating them by size or age and compressing them on the fly.
+"""
+
+import Queue
+import gzip
+import os
+import threading
+import time
+
+from sbp.client.loggers.json_logger import JSONLogger
+
+from binary_log import BinaryLogger
+from json_log_index import JSONLogIndexer, index_filename
+
+LOG_FORMAT_JSON = 'json'
+LOG_FORMAT_BINARY = 'binary'
+LOG_FORMATS = [LOG_FORMAT_JSON, LOG_FORMAT_BINARY]
+
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_LZMA = 'lzma'
+COMPRESSIONS = [COMPRESSION_GZIP, COMPRESSION_LZMA]
+COMPRESSION_SUFFIXES = {COMPRESSION_GZIP: '.gz', COMPRESSION_LZMA: '.xz'}
+
+# Default number of records queued for the writer thread before new ones
+# are dropped.
+QUEUE_SIZE = 10000
+# Largest number of records written at once.
+BATCH_SIZE = 256
+# Seconds between flushes of the log file.
+FLUSH_PERIOD = 1.0
+
+# Queued to stop the writer thread.
+_STOP = object()
+
+def _lzma():
+  """ The lzma module, from the standard library or backports.lzma. """
+  try:
+    import lzma
+  except ImportError:
+    try:
+      from backports import lzma
+    except ImportError:
+      raise ImportError("lzma compression requires the backports.lzma "
+                        "package on Python 2")
+  return lzma
+
+def open_log_file(path, mode='rb'):
+  """
+  Open a log file, compressed or not depending on its extension.
+
+  Parameters
+  ----------
+  path : str
+    Path of the file. Files ending in '.gz' are gzip compressed and files
+    ending in '.xz' lzma compressed.
+  mode : str
+    Mode to open the file with.
+
+  Returns
+  -------
+  out : file
+  """
+  if path.endswith(COMPRESSION_SUFFIXES[COMPRESSION_GZIP]):
+    return gzip.open(path, mode)
+  elif path.endswith(COMPRESSION_SUFFIXES[COMPRESSION_LZMA]):
+    return _lzma().open(path, mode)
+  return open(path, mode)
+
+def _new_logger(fmt, fileobj):
+  """ Logger of a format writing to an open file. """
+  if fmt == LOG_FORMAT_BINARY:
+    return BinaryLogger(None, fileobj=fileobj)
+  logger = JSONLogger(None)
+  logger.handle = fileobj
+  return logger
+
+def _split_ext(filename):
+  """ Split a log filename into root and extension, e.g. '.log.json'. """
+  for ext in ['.log.json', '.log.sbp']:
+    if filename.endswith(ext):
+      return filename[:-len(ext)], ext
+  return os.path.splitext(filename)
+
+class LogWriter(object):
+  """
+  Callable sink of SBP messages, to be registered as a callback of a
+  sbp.client.handler.Handler, that queues messages to be logged by a
+  dedicated thread.
+
+  Calls return straight away. If the writer thread falls behind by more
+  than queue_size records, new records are dropped and counted in
+  n_queue_full rather than blocking the caller. Records that fail to be
+  written are counted in n_write_failed, and the writer thread carries on
+  with the next one. n_dropped is the sum of both.
+
+  When rotating, the log is split into segments named after filename with a
+  sequence number, e.g. capture-0001.log.json.gz, each started when the
+  previous one reaches rotate_bytes bytes of records (before compression)
+  or rotate_seconds seconds of age. Otherwise the whole log is written to
+  filename, plus the compression suffix.
+
+  Parameters
+  ----------
+  filename : str
+    Path of the log.
+  fmt : str
+    Format of the log, LOG_FORMAT_JSON or LOG_FORMAT_BINARY.
+  rotate_bytes : int
+    Size of each segment, None for no limit.
+  rotate_seconds : float
+    Age of each segment, None for no limit.
+  compression : str
+    One of COMPRESSIONS, or None.
+  max_files : int
+    Number of segments to keep, deleting the oldest ones, None to keep all.
+  queue_size : int
+    Number of records queued at most.
+  index : bool
+    Index JSON logs as they're written, see piksi_tools.json_log_index.
+    Compressed logs can't be indexed.
+  """
+
+  def __init__(self, filename, fmt=LOG_FORMAT_JSON, rotate_bytes=None,
+               rotate_seconds=None, compression=None, max_files=None,
+               queue_size=QUEUE_SIZE, index=False):
+    if index and (fmt != LOG_FORMAT_JSON or compression):
+      raise ValueError("Only uncompressed JSON logs can be indexed")
+    self.filename = filename
+    self.fmt = fmt
+    self.rotate_bytes = rotate_bytes
+    self.rotate_seconds = rotate_seconds
+    self.suffix = COMPRESSION_SUFFIXES[compression] if compression else ''
+    self.max_files = max_files
+    self.index = index
+    self.queue = Queue.Queue(queue_size)
+    # Each counter is only updated by one thread, the caller's or the
+    # writer's, so neither needs a lock.
+    self.n_written = 0
+    self.n_queue_full = 0
+    self.n_write_failed = 0
+    self.paths = []
+    self.closed = False
+    self._logger = None
+    self._indexer = None
+    self._open_segment()
+    self._thread = threading.Thread(target=self._run, name="LogWriter")
+    self._thread.daemon = True
+    self._thread.start()
+
+  def __call__(self, msg, **metadata):
+    if self.closed:
+      return
+    if self.fmt == LOG_FORMAT_BINARY:
+      metadata['time'] = time.time()
+    try:
+      self.queue.put_nowait((msg, metadata))
+    except Queue.Full:
+      self.n_queue_full += 1
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  @property
+  def n_dropped(self):
+    return self.n_queue_full + self.n_write_failed
+
+  def flush(self):
+    """ Wait for the queued records to be written. """
+    self.queue.join()
+
+  def close(self):
+    """ Write the queued records and close the log. """
+    if self.closed:
+      return
+    self.closed = True
+    # Don't block on a full queue if the writer thread has died.
+    while self._thread.is_alive():
+      try:
+        self.queue.put(_STOP, timeout=FLUSH_PERIOD)
+        break
+      except Queue.Full:
+        pass
+    self._thread.join()
+    if self.n_dropped:
+      print "Dropped %d of %d log records" % \
+            (self.n_dropped, self.n_dropped + self.n_written)
+
+  @property
+  def rotating(self):
+    return self.rotate_bytes is not None or self.rotate_seconds is not None
+
+  def _open_segment(self):
+    if self.rotating:
+      root, ext = _split_ext(self.filename)
+      path = '%s-%04d%s%s' % (root, len(self.paths) + 1, ext, self.suffix)
+    else:
+      path = self.filename + self.suffix
+    self._logger = _new_logger(self.fmt, open_log_file(path, 'wb'))
+    if self.index:
+      self._indexer = JSONLogIndexer(path)
+    self._segment_start = time.time()
+    self.paths.append(path)
+    if self.max_files is not None:
+      for old_path in self.paths[:-self.max_files]:
+        for p in [old_path, index_filename(old_path)]:
+          if os.path.exists(p):
+            os.remove(p)
+
+  def _close_segment(self):
+    self._logger.close()
+    if self._indexer is not None:
+      self._indexer.close()
+
+  def _write(self, msg, metadata):
+    if self._indexer is None:
+      self._logger(msg, **metadata)
+      return
+    start = self._logger.handle.tell()
+    self._logger(msg, **metadata)
+    if 'timestamp' in metadata:
+      self._indexer.add(metadata['timestamp'], msg.msg_type, start,
+                        self._logger.handle.tell())
+
+  def _should_rotate(self):
+    if self.rotate_bytes is not None and \
+       self._logger.handle.tell() >= self.rotate_bytes:
+      return True
+    return self.rotate_seconds is not None and \
+           time.time() - self._segment_start >= self.rotate_seconds
+
+  def _write_record(self, msg, metadata):
+    try:
+      self._write(msg, metadata)
+      self.n_written += 1
+      if self._should_rotate():
+        self._close_segment()
+        self._open_segment()
+    except Exception:
+      # A full disk or a record that can't be encoded mustn't stop the
+      # thread, or callers would queue records forever.
+      self.n_write_failed += 1
+
+  def _flush(self):
+    try:
+      self._logger.flush()
+      if self._indexer is not None:
+        self._indexer.flush()
+    except Exception:
+      pass
+
+  def _run(self):
+    last_flush = time.time()
+    while True:
+      batch = []
+      try:
+        batch.append(self.queue.get(timeout=FLUSH_PERIOD))
+        while len(batch) < BATCH_SIZE:
+          batch.append(self.queue.get_nowait())
+      except Queue.Empty:
+        pass
+      for item in batch:
+        if item is _STOP:
+          try:
+            self._close_segment()
+          finally:
+            self.queue.task_done()
+          return
+        self._write_record(*item)
+        self.queue.task_done()
+      if time.time() - last_flush >= FLUSH_PERIOD:
+        self._flush()
+        last_flush = time.time()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+The :mod:`piksi_tools.parallel_decode` module decodes JSON logs of SBP
+messages on several cores at once, using a pool of processes.
+
+A log is split into byte ranges ending at line boundaries, each range is
+processed by a function in a pool process, and the results are returned in
+the order of the ranges, so results merged in that order are in the order
+of the log. Functions should reduce their range to something much smaller
+than its messages, e.g. index entries or numpy columns, as sending results
+back to the calling process is done on a single core.
+"""
+
+import json
+import os
+import signal
+import warnings
+
+from multiprocessing import Pool, cpu_count
+
+from sbp.msg import SBP
+
+DEFAULT_JOBS = cpu_count()
+# Bytes of a log per range processed at once.
+RANGE_SIZE = 0x1000000
+# Bytes of a log read at once when scanning it.
+READ_SIZE = 0x100000
+
+def split_lines(filename, start=0, range_size=None):
+  """
+  Split a file into byte ranges of about range_size bytes, ending at line
+  boundaries.
+
+  Parameters
+  ----------
+  filename : str
+    Path of the file.
+  start : int
+    Byte offset to start from, at a line boundary.
+  range_size : int
+    Bytes per range, None for RANGE_SIZE.
+
+  Returns
+  -------
+  out : [(int, int)]
+    First and end (exclusive) byte offsets of each range. The last range
+    ends at the end of the file, even if its last line is incomplete.
+  """
+  range_size = range_size or RANGE_SIZE
+  size = os.path.getsize(filename)
+  ranges = []
+  with open(filename, 'rb') as f:
+    while start < size:
+      f.seek(min(start + range_size, size))
+      f.readline()
+      end = min(f.tell(), size)
+      ranges.append((start, end))
+      start = end
+  return ranges
+
+def iter_lines(handle, start, end=None):
+  """
+  Generate (offset, end offset, line) for each complete line of a file
+  between two offsets, reading a block at a time.
+  """
+  handle.seek(start)
+  offset = start
+  rest = ''
+  while end is None or offset + len(rest) < end:
+    n = READ_SIZE if end is None else min(READ_SIZE, end - offset - len(rest))
+    data = handle.read(n)
+    if not data:
+      return
+    lines = (rest + data).split('\n')
+    rest = lines.pop()
+    for line in lines:
+      line_end = offset + len(line) + 1
+      yield offset, line_end, line
+      offset = line_end
+
+def json_records(filename, start, end, dispatcher=None):
+  """
+  Generate the records of a range of a JSON log, like
+  sbp.client.loggers.json_logger.JSONLogIterator.
+
+  Parameters
+  ----------
+  filename : str
+    Path of the log.
+  start : int
+    First byte offset of the range.
+  end : int
+    End byte offset of the range.
+  dispatcher : function
+    Decodes the messages, None to leave them undecoded.
+
+  Returns
+  -------
+  out : generator
+    (msg, metadata) tuples.
+  """
+  with open(filename, 'rb') as f:
+    for offset, line_end, line in iter_lines(f, start, end):
+      try:
+        data = json.loads(line)
+        msg = SBP.from_json_dict(data.pop('data'))
+      except (ValueError, KeyError, TypeError):
+        warn = "Bad JSON decoding for line %s" % line
+        warnings.warn(warn, RuntimeWarning)
+        continue
+      if dispatcher is not None:
+        try:
+          msg = dispatcher(msg)
+        except Exception:
+          pass
+      yield msg, data
+
+def _init_worker():
+  """ Leave handling of Ctrl-C to the parent process. """
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _call(args):
+  func, filename, (start, end), func_args = args
+  return func(filename, start, end, *func_args)
+
+def map_ranges(func, filename, args=(), jobs=DEFAULT_JOBS, start=0,
+               range_size=None):
+  """
+  Process a log a range at a time, see split_lines, in a pool of processes.
+
+  Parameters
+  ----------
+  func : function
+    Module level function called as func(filename, start, end, *args) for
+    each range, returning a picklable result.
+  filename : str
+    Path of the log.
+  args : tuple
+    Further arguments of func.
+  jobs : int
+    Number of processes, 1 to process the ranges in this process.
+  start : int
+    Byte offset to start from, at a line boundary.
+  range_size : int
+    Bytes per range, None for RANGE_SIZE.
+
+  Returns
+  -------
+  out : generator
+    Result of each range, in the order of the ranges.
+  """
+  tasks = [(func, filename, r, tuple(args))
+           for r in split_lines(filename, start, range_size)]
+  if jobs <= 1 or len(tasks) <= 1:
+    for task in tasks:
+      yield _call(task)
+    return
+  pool = Pool(min(jobs, len(tasks)), _init_worker)
+  try:
+    for result in pool.imap(_call, tasks):
+      yield result
+    pool.close()
+  except BaseException:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+The :mod:`piksi_tools.replay_driver` module replays recorded logs of SBP
+messages as if they were received from a device, so everything downstream
+of a sbp.client.Framer can be run without hardware.
+"""
+
+import time
+
+from sbp.client.drivers.base_driver import BaseDriver
+
+# Longest time slept at once while pacing, so closing the driver isn't held
+# up by gaps in a log.
+MAX_SLEEP = 0.1
+
+def record_time(metadata):
+  """
+  Time of a log record in seconds, from the metadata of a binary or JSON
+  log record.
+  """
+  if 'time' in metadata:
+    return metadata['time']
+  if 'delta' in metadata:
+    return metadata['delta'] / 1000.0
+  return metadata['timestamp']
+
+class ReplayDriver(BaseDriver):
+  """
+  Driver reading the framed messages of a recorded log, paced by the times
+  they were logged at, to be used with sbp.client.Framer like the serial
+  drivers. Writes are discarded.
+
+  Reads raise IOError once the log is replayed, which ends the iteration of
+  the Framer.
+
+  Parameters
+  ----------
+  log : sbp.client.loggers.base_logger.LogIterator
+    Log to replay, see piksi_tools.serial_link.get_log_iterator.
+  speed : float
+    Speed factor of the replay relative to the original timing, or None or 0
+    to replay as fast as possible.
+  """
+
+  def __init__(self, log, speed=1.0):
+    super(ReplayDriver, self).__init__(log)
+    self.speed = speed
+    self.records = log.next()
+    self.buf = ''
+    self.closed = False
+    self.n_msgs = 0
+    self.n_bytes = 0
+    self.n_written = 0
+    self.start_time = None
+    self.end_time = None
+    self.log_start = None
+    self.log_time = None
+
+  def _pace(self, t):
+    """ Wait until a record logged at time t is due. """
+    if self.log_start is None:
+      self.log_start = t
+    self.log_time = t
+    if not self.speed:
+      return
+    due = self.start_time + (t - self.log_start) / self.speed
+    while not self.closed:
+      delay = due - time.time()
+      if delay <= 0:
+        return
+      time.sleep(min(delay, MAX_SLEEP))
+
+  def read(self, size):
+    """
+    Read the framed bytes of the next messages of the log, waiting for them
+    to be due.
+
+    Parameters
+    ----------
+    size : int
+      Number of bytes to read at most.
+    """
+    if self.start_time is None:
+      self.start_time = time.time()
+    if not self.buf:
+      try:
+        msg, metadata = self.records.next()
+        self._pace(record_time(metadata))
+      except (StopIteration, ValueError):
+        self.closed = True
+      if self.closed:
+        if self.end_time is None:
+          self.end_time = time.time()
+        raise IOError("End of replayed log")
+      self.buf = msg.to_binary()
+      self.n_msgs += 1
+      self.n_bytes += len(self.buf)
+    data, self.buf = self.buf[:size], self.buf[size:]
+    return data
+
+  def write(self, s):
+    self.n_written += len(s)
+    return len(s)
+
+  def flush(self):
+    pass
+
+  def close(self):
+    if self.end_time is None and self.start_time is not None:
+      self.end_time = time.time()
+    self.closed = True
+    self.handle.close()
+
+  @property
+  def stats(self):
+    """
+    Messages and bytes replayed, elapsed time, message rate and the
+    achieved speed factor relative to the original timing.
+    """
+    elapsed = 0.0
+    if self.start_time is not None:
+      elapsed = (self.end_time or time.time()) - self.start_time
+    log_elapsed = 0.0
+    if self.log_start is not None:
+      log_elapsed = self.log_time - self.log_start
+    return {'msgs': self.n_msgs,
+            'bytes': self.n_bytes,
+            'seconds': elapsed,
+            'msg_rate': self.n_msgs / elapsed if elapsed else 0.0,
+            'speed': log_elapsed / elapsed if elapsed else 0.0}
+
+  def rate_report(self):
+    """ Summary of the replay as a string. """
+    return "Replayed %(msgs)d messages (%(bytes)d bytes) in %(seconds).1f " \
+           "seconds: %(msg_rate).0f msgs/s, %(speed).1fx real time" % \
+           self.stats
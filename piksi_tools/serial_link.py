@@ -16,6 +16,8 @@ setting up and running SBP message handling.
 
 import sys
 import os
+import shutil
+import tempfile
 import time
 import uuid
 import warnings
@@ -27,16 +29,25 @@ from sbp.navigation import SBP_MSG_POS_ECEF, SBP_MSG_POS_LLH, SBP_MSG_BASELINE_E
 from sbp.observation import SBP_MSG_OBS, SBP_MSG_EPHEMERIS
 from sbp.user import SBP_MSG_USER_DATA
 from sbp.piksi                          import MsgReset
+from sbp.table                          import dispatch
 from sbp.system                         import SBP_MSG_HEARTBEAT
 from sbp.client.drivers.network_drivers import HTTPDriver
 from sbp.client.drivers.pyserial_driver import PySerialDriver
 from sbp.client.drivers.pyftdi_driver   import PyFTDIDriver
 from sbp.client.loggers.json_logger     import JSONLogger
 from sbp.client.loggers.null_logger     import NullLogger
+from sbp.client.loggers.json_logger     import JSONLogIterator
 from sbp.client                         import Handler, Framer, Forwarder
 
+from binary_log import BinaryLogIterator, FILE_MAGIC
+from json_log_index import IndexedJSONLogIterator
+from replay_driver import ReplayDriver
+from log_writer import LogWriter, open_log_file, COMPRESSIONS, \
+                       COMPRESSION_SUFFIXES, LOG_FORMAT_JSON, \
+                       LOG_FORMAT_BINARY, LOG_FORMATS
 
 LOG_FILENAME = time.strftime("serial-link-%Y%m%d-%H%M%S.log.json")
+BINARY_LOG_FILENAME = time.strftime("serial-link-%Y%m%d-%H%M%S.log.sbp")
 
 SERIAL_PORT  = "/dev/ttyUSB0"
 SERIAL_BAUD  = 1000000
@@ -68,6 +79,12 @@ def base_cl_options():
   parser.add_argument("-l", "--log",
                       action="store_true",
                       help="serialize SBP messages to autogenerated log file.")
+  parser.add_argument("--replay",
+                      help="replay a JSON or binary log file instead of "
+                           "reading a serial port.")
+  parser.add_argument("--replay-speed", type=float, default=1.0,
+                      help="speed factor of the replay relative to the "
+                           "logged timing, 0 for as fast as possible.")
   parser.add_argument("-t", "--timeout",
                       default=None,
                       help="exit after TIMEOUT seconds have elapsed.")
@@ -78,6 +95,25 @@ def base_cl_options():
                       default=LOG_FILENAME,
                       help="file to log output to. If a directory is provided the "
                             "filename is autogenerated.")
+  parser.add_argument("--log-format",
+                      choices=LOG_FORMATS, default=LOG_FORMAT_JSON,
+                      help="format of the log file: one JSON record per line, "
+                           "or the framed messages with a time/type index, "
+                           "see piksi_tools.binary_log.")
+  parser.add_argument("--rotate-size", type=float,
+                      help="start a new log file every ROTATE_SIZE MB of "
+                           "messages, before compression.")
+  parser.add_argument("--rotate-time", type=float,
+                      help="start a new log file every ROTATE_TIME seconds.")
+  parser.add_argument("--compress", choices=COMPRESSIONS,
+                      help="compress the log file(s) as they are written.")
+  parser.add_argument("--max-log-files", type=int,
+                      help="number of rotated log files to keep, deleting "
+                           "the oldest ones.")
+  parser.add_argument("--index", action="store_true",
+                      help="index JSON log files by time and message type as "
+                           "they are written, see "
+                           "piksi_tools.json_log_index.")
   parser.add_argument("-a", "--append-log-filename",
                       default=None,
                       help="file to append log output to.")
@@ -105,7 +141,8 @@ def get_args():
   parser = base_cl_options()
   return parser.parse_args()
 
-def get_driver(use_ftdi=False, port=SERIAL_PORT, baud=SERIAL_BAUD):
+def get_driver(use_ftdi=False, port=SERIAL_PORT, baud=SERIAL_BAUD,
+               replay=None, replay_speed=1.0):
   """
   Get a driver based on configuration options
 
@@ -117,7 +154,16 @@ def get_driver(use_ftdi=False, port=SERIAL_PORT, baud=SERIAL_BAUD):
     Serial port to read.
   baud : int
     Serial port baud rate to set.
+  replay : string
+    Log file to replay instead of reading a serial port, see
+    piksi_tools.replay_driver.
+  replay_speed : float
+    Speed factor of the replay, 0 to replay as fast as possible.
   """
+  if replay:
+    # Replayed messages are only framed again, so leave them undecoded.
+    log = get_log_iterator(replay, dispatcher=lambda msg: msg)
+    return ReplayDriver(log, replay_speed)
   try:
     if use_ftdi:
       return PyFTDIDriver(baud)
@@ -128,21 +174,86 @@ def get_driver(use_ftdi=False, port=SERIAL_PORT, baud=SERIAL_BAUD):
   except SystemExit:
     sys.exit(1)
 
-def get_logger(use_log=False, filename=LOG_FILENAME):
+def get_logger(use_log=False, filename=LOG_FILENAME, fmt=LOG_FORMAT_JSON,
+               rotate_size=None, rotate_time=None, compression=None,
+               max_files=None, index=False):
   """
   Get a logger based on configuration options.
 
+  The logger is to be registered as a callback of a Handler: messages are
+  written by a thread of its own, see piksi_tools.log_writer.LogWriter.
+
   Parameters
   ----------
   use_log : bool
     Whether to log or not.
   filename : string
     File to log to.
+  fmt : string
+    Format of the log, one of LOG_FORMATS.
+  rotate_size : float
+    Size of each log file in MB, None for no limit.
+  rotate_time : float
+    Age of each log file in seconds, None for no limit.
+  compression : string
+    One of COMPRESSIONS, or None.
+  max_files : int
+    Number of rotated log files to keep, None to keep all.
+  index : bool
+    Index the log as it is written, uncompressed JSON logs only.
   """
   if not use_log:
     return NullLogger()
-  print "Logging at %s" % filename
-  return JSONLogger(filename)
+  rotate_bytes = int(rotate_size * 1e6) if rotate_size else None
+  logger = LogWriter(filename, fmt, rotate_bytes, rotate_time, compression,
+                     max_files, index=index)
+  print "Logging at %s" % logger.paths[0]
+  return logger
+
+def get_log_iterator(filename, fmt=None, dispatcher=dispatch):
+  """
+  Get an iterator over the messages of a log file.
+
+  Parameters
+  ----------
+  filename : string
+    File to read.
+  fmt : string
+    Format of the log, one of LOG_FORMATS, or None to detect it.
+  dispatcher : function
+    Decodes the SBP messages read from the log.
+
+  Returns
+  -------
+  out : sbp.client.loggers.base_logger.LogIterator
+    Iterator whose next() method returns a generator of (msg, metadata).
+    Binary and uncompressed JSON logs can be read by time range and message
+    type, see next() of piksi_tools.binary_log.BinaryLogIterator and
+    piksi_tools.json_log_index.IndexedJSONLogIterator.
+  """
+  handle = open_log_file(filename)
+  if fmt is None:
+    is_binary = handle.read(len(FILE_MAGIC)) == FILE_MAGIC
+    fmt = LOG_FORMAT_BINARY if is_binary else LOG_FORMAT_JSON
+    handle.seek(0)
+  compressed = any([filename.endswith(suffix)
+                    for suffix in COMPRESSION_SUFFIXES.values()])
+  if fmt == LOG_FORMAT_BINARY:
+    if compressed:
+      # The index is read by seeking, decompress the log to a temporary file.
+      f = tempfile.TemporaryFile()
+      shutil.copyfileobj(handle, f)
+      f.seek(0)
+      handle.close()
+      handle = f
+    return BinaryLogIterator(filename, dispatcher, fileobj=handle)
+  if not compressed:
+    handle.close()
+    return IndexedJSONLogIterator(filename, dispatcher)
+  log_iterator = JSONLogIterator(filename, dispatcher)
+  log_iterator.handle.close()
+  log_iterator.handle = handle
+  return log_iterator
 
 def get_append_logger(filename, tags):
   """
@@ -254,6 +365,9 @@ def run(args, link):
         print "Timer expired!"
         break
       if not link.is_alive():
+        if getattr(args, 'replay', None):
+          # The whole log was replayed.
+          break
         sys.stderr.write("ERROR: Thread died!")
         sys.exit(1)
   except KeyboardInterrupt:
@@ -283,8 +397,13 @@ def main(args):
   timeout = args.timeout
   log_filename = args.log_filename
   append_log_filename = args.append_log_filename
+  default_filename = LOG_FILENAME
+  if args.log_format == LOG_FORMAT_BINARY:
+    default_filename = BINARY_LOG_FILENAME
+    if log_filename == LOG_FILENAME:
+      log_filename = default_filename
   if log_filename is not None and os.path.isdir(log_filename):
-    log_filename = os.path.join(log_filename, LOG_FILENAME)
+    log_filename = os.path.join(log_filename, default_filename)
   if append_log_filename is not None and os.path.isdir(append_log_filename):
     append_log_filename = os.path.join(append_log_filename, LOG_FILENAME)
   tags = args.tags
@@ -294,15 +413,18 @@ def main(args):
   base = args.base
   use_broker = args.broker
   # Driver with context
-  with get_driver(args.ftdi, port, baud) as driver:
+  with get_driver(args.ftdi, port, baud, args.replay,
+                  args.replay_speed) as driver:
     # Handler with context
     with Handler(Framer(driver.read, driver.write, args.verbose)) as link:
       # Logger with context
-      with get_logger(args.log, log_filename) as logger:
+      with get_logger(args.log, log_filename, args.log_format,
+                      args.rotate_size, args.rotate_time, args.compress,
+                      args.max_log_files, args.index) as logger:
         with get_append_logger(append_log_filename, tags) as append_logger:
           link.add_callback(printer, SBP_MSG_PRINT_DEP)
           link.add_callback(log_printer, SBP_MSG_LOG)
-          Forwarder(link, logger).start()
+          link.add_callback(logger)
           Forwarder(link, append_logger).start()
           if use_broker and base and serial_id:
             device_id = get_uuid(channel, serial_id)
@@ -312,6 +434,8 @@ def main(args):
                 run(args, link)
           else:
             run(args, link)
+    if args.replay:
+      print driver.rate_report()
 
 if __name__ == "__main__":
   main(get_args())
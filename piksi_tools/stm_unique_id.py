@@ -9,12 +9,12 @@
 # EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
 # WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
 
-import time
 import struct
 import sys
 import serial_link
 
 from piksi_tools.heartbeat import *
+from piksi_tools.timeout import Event
 from sbp.flash             import *
 from sbp.system            import *
 from sbp.client            import *
@@ -33,7 +33,8 @@ class STMUniqueID(object):
     sbp_version : tuple (int, int)
       SBP version to use for STM Unique ID messages.
     """
-    self.unique_id_returned = False
+    # Set once the unique ID is received.
+    self.unique_id_event = Event()
     self.unique_id = None
     self.link = link
     self.heartbeat = Heartbeat()
@@ -47,27 +48,48 @@ class STMUniqueID(object):
     self.link.remove_callback(self.heartbeat, SBP_MSG_HEARTBEAT)
     self.link.remove_callback(self.receive_stm_unique_id_callback, SBP_MSG_STM_UNIQUE_ID_RESP)
 
+  @property
+  def unique_id_returned(self):
+    return self.unique_id_event.is_set()
+
   def receive_stm_unique_id_callback(self, sbp_msg, **metadata):
     """
     Registered as a callback for the Heartbeat message
     with sbp.client.handler.Handler.
     """
-    self.unique_id_returned = True
     self.unique_id = struct.unpack('<12B',sbp_msg.payload)
+    self.unique_id_event.set()
+
+  def get_id(self, sbp_version=None, timeout=None):
+    """
+    Retrieve the STM Unique ID. Blocks until it has received the ID.
+
+    Parameters
+    ==========
+    sbp_version : tuple (int, int)
+      SBP version to use for STM Unique ID messages, e.g. from a bootloader
+      handshake. If None, wait for a heartbeat to get it from the application.
+    timeout : float
+      Seconds to wait for each of the heartbeat and the ID, None to wait
+      forever.
 
-  def get_id(self):
-    """ Retrieve the STM Unique ID. Blocks until it has received the ID. """
-    while not self.heartbeat.received:
-      time.sleep(0.1)
-    self.unique_id_returned = False
+    Returns
+    =======
+    out : tuple(int)
+      STM unique ID bytes, or None if the timeout was reached.
+    """
+    if sbp_version is None:
+      if not self.heartbeat.event.wait(timeout):
+        return None
+      sbp_version = self.heartbeat.sbp_version
+    self.unique_id_event.clear()
     self.unique_id = None
     # < 0.45 of the bootloader, reuse single stm message.
-    if self.heartbeat.sbp_version < (0, 45):
-      self.link(MsgStmUniqueIdResp())
+    if sbp_version < (0, 45):
+      self.link(SBP(SBP_MSG_STM_UNIQUE_ID_RESP, payload=''))
     else:
       self.link(MsgStmUniqueIdReq())
-    while not self.unique_id_returned:
-      time.sleep(0.1)
+    self.unique_id_event.wait(timeout)
     return self.unique_id
 
 def get_args():
@@ -9,7 +9,8 @@
 # EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
 # WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
 
-import signal
+import threading
+import time
 
 # Seconds to use for various timeouts.
 TIMEOUT_FW_DOWNLOAD       = 30
@@ -29,19 +30,48 @@ TIMEOUT_CREATE_LINK       = 5
 TIMEOUT_GET_UNIQUE_ID     = 5
 TIMEOUT_WRITE_M25_STATUS  = 5
 
+# Longest sleep, in seconds, between checks of the Events being waited on.
+WAIT_POLL_PERIOD = 0.0005
+
 
 class TimeoutError(Exception):
   pass
 
-def timeout_handler(signum, frame):
-  raise TimeoutError
+class CancelledError(TimeoutError):
+  """ Raised by the waits of an operation aborted with Timeout.abort. """
+  pass
+
+# Per thread stack of the active Timeouts, see active_timeouts.
+_local = threading.local()
+
+def active_timeouts():
+  """
+  Timeouts started by the current thread and not yet cancelled, innermost
+  last.
+  """
+  if not hasattr(_local, 'timeouts'):
+    _local.timeouts = []
+  return _local.timeouts
+
+def check_timeouts():
+  """
+  Raise if any Timeout of the current thread has expired or been aborted.
+  Called by every blocking wait on a device, so the waits of each thread
+  follow that thread's Timeouts.
+  """
+  for timeout in active_timeouts():
+    timeout.check()
 
 class Timeout(object):
   """
   Configurable timeout to raise an Exception after a certain number of
   seconds.
 
-  Note: Will not work on Windows: uses SIGALRM.
+  The timeout applies to the thread that starts it, and is raised as a
+  TimeoutError by the first blocking wait on a device (an Event, a Flash
+  operation, a FileIO request) made once it has expired. Timeouts don't use
+  signals, so any number of them can be active at once, nested or in
+  different threads, e.g. one per device driven by a process.
   """
 
   def __init__(self, seconds):
@@ -49,10 +79,12 @@ class Timeout(object):
     Parameters
     ==========
     seconds : int
-      Number of seconds before Exception is raised.
+      Number of seconds before Exception is raised. None to only raise once
+      aborted.
     """
-    signal.signal(signal.SIGALRM, timeout_handler)
     self.seconds = seconds
+    self.deadline = None
+    self.aborted = False
 
   def __enter__(self):
     self.start()
@@ -62,9 +94,119 @@ class Timeout(object):
     self.cancel()
 
   def start(self):
-    signal.alarm(self.seconds)
+    """ Start the timeout for waits made by the current thread. """
+    if self.seconds is not None:
+      self.deadline = time.time() + self.seconds
+    self.aborted = False
+    active_timeouts().append(self)
 
   def cancel(self):
     """ Cancel scheduled Exception. """
-    signal.alarm(0)
+    timeouts = active_timeouts()
+    if self in timeouts:
+      timeouts.remove(self)
+
+  def abort(self):
+    """
+    Make the waits under this timeout raise a CancelledError straight away.
+    Can be called from any thread, e.g. to stop the update of one device.
+    """
+    self.aborted = True
+
+  def remaining(self):
+    """ Seconds left before the timeout expires, None if it never does. """
+    if self.deadline is None:
+      return None
+    return max(0.0, self.deadline - time.time())
+
+  def check(self):
+    """ Raise if the timeout has expired or been aborted. """
+    if self.aborted:
+      raise CancelledError("Operation aborted")
+    if self.deadline is not None and time.time() >= self.deadline:
+      raise TimeoutError("Timed out after %s seconds" % self.seconds)
+
+class Event(object):
+  """
+  Flag set by an SBP callback when an awaited message arrives, and waited on
+  by the thread that expects it.
+
+  Python 2 implements waits with a timeout on a threading.Event by sleeping
+  with a backoff of up to 50 ms, and waits without one can't be interrupted
+  with Ctrl-C, so waits here check the flag every WAIT_POLL_PERIOD instead.
+  """
+
+  def __init__(self):
+    self._set = False
 
+  def set(self):
+    self._set = True
+
+  def clear(self):
+    self._set = False
+
+  def is_set(self):
+    return self._set
+
+  def wait(self, timeout=None):
+    """
+    Wait for the flag to be set.
+
+    Parameters
+    ==========
+    timeout : float
+      Seconds to wait for, None to wait forever.
+
+    Returns
+    =======
+    out : bool
+      Whether the flag was set before the timeout.
+    """
+    return wait_any([self], timeout) is not None
+
+def wait_any(events, timeout=None):
+  """
+  Wait for the first of a number of Events to be set. Raises if a Timeout
+  of the current thread expires first, see check_timeouts.
+
+  Parameters
+  ==========
+  events : list[Event]
+    Events to wait for.
+  timeout : float
+    Seconds to wait for, None to wait forever.
+
+  Returns
+  =======
+  out : Event
+    First set Event, or None if none was set before the timeout.
+  """
+  deadline = time.time() + timeout if timeout is not None else None
+  while True:
+    for event in events:
+      if event.is_set():
+        return event
+    if deadline is not None and time.time() >= deadline:
+      return None
+    check_timeouts()
+    time.sleep(WAIT_POLL_PERIOD)
+
+def backoff(period, factor=1.0, max_period=None):
+  """
+  Generate the periods between retries of a request, e.g. device resets,
+  each factor times longer than the previous one.
+
+  Parameters
+  ==========
+  period : float
+    First period, in seconds.
+  factor : float
+    Ratio of each period to the previous one.
+  max_period : float
+    Longest period, None for no limit.
+  """
+  while True:
+    yield period
+    period *= factor
+    if max_period is not None:
+      period = min(period, max_period)
@@ -10,16 +10,25 @@
 # WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
 
 import sys
-import time
 
 from piksi_tools.bootload import Bootloader
 from piksi_tools.flash import Flash
 from piksi_tools.timeout import *
 from piksi_tools.heartbeat import Heartbeat
 from sbp.system import SBP_MSG_HEARTBEAT
-from sbp.piksi import SBP_MSG_RESET
+from sbp.piksi import MsgReset
 
-def set_app_mode(handler, verbose=False):
+def wait_for_state(piksi_bootloader, heartbeat):
+  """
+  Wait until a heartbeat or bootloader handshake is received, so the state
+  Piksi is in is known. Raises a piksi_tools.timeout.TimeoutError if neither
+  arrives within TIMEOUT_BOOT.
+  """
+  if wait_any([heartbeat.event, piksi_bootloader.handshake_event],
+              TIMEOUT_BOOT) is None:
+    raise TimeoutError
+
+def set_app_mode(handler, verbose=False, **handshake_kwargs):
   """
   Set Piksi into the application firmware, regardless of whether it is
   currently in the application firmware or the bootloader. Will raise a
@@ -31,6 +40,8 @@ def set_app_mode(handler, verbose=False):
     handler to send/receive messages from/to Piksi.
   verbose : bool
     Print more verbose output.
+  handshake_kwargs : dict
+    Reset retry settings passed on to Bootloader.handshake.
 
   """
 
@@ -44,9 +55,7 @@ def set_app_mode(handler, verbose=False):
     handler.add_callback(heartbeat, SBP_MSG_HEARTBEAT)
 
     if verbose: print "Waiting for bootloader handshake or heartbeat from device"
-    with Timeout(TIMEOUT_BOOT) as timeout:
-      while not heartbeat.received and not piksi_bootloader.handshake_received:
-        time.sleep(0.1)
+    wait_for_state(piksi_bootloader, heartbeat)
 
     handler.remove_callback(heartbeat, SBP_MSG_HEARTBEAT)
 
@@ -56,9 +65,9 @@ def set_app_mode(handler, verbose=False):
       return
 
     # Piksi is in the bootloader, tell Piksi to jump into the application.
-    with Timeout(TIMEOUT_BOOT) as timeout:
-      if verbose: print "Waiting for bootloader handshake from device"
-      piksi_bootloader.handshake()
+    if verbose: print "Waiting for bootloader handshake from device"
+    if not piksi_bootloader.handshake(TIMEOUT_BOOT, **handshake_kwargs):
+      raise TimeoutError
     piksi_bootloader.jump_to_app()
     if verbose: print "Received handshake"
     if verbose: print "Telling device to jump to application"
@@ -68,14 +77,13 @@ def set_app_mode(handler, verbose=False):
     handler.add_callback(heartbeat, SBP_MSG_HEARTBEAT)
 
     if verbose: print "Waiting for heartbeat"
-    with Timeout(TIMEOUT_BOOT) as timeout:
-      while not heartbeat.received:
-        time.sleep(0.1)
+    if not heartbeat.event.wait(TIMEOUT_BOOT):
+      raise TimeoutError
     if verbose: print "Received heartbeat"
 
     handler.remove_callback(heartbeat, SBP_MSG_HEARTBEAT)
 
-def setup_piksi(handler, stm_fw, nap_fw, verbose=False):
+def setup_piksi(handler, stm_fw, nap_fw, verbose=False, **handshake_kwargs):
   """
   Set Piksi into a known state (STM / NAP firmware). Erases entire STM flash
   (except for bootloader sector). Requires Piksi have a valid STM firmware
@@ -92,6 +100,8 @@ def setup_piksi(handler, stm_fw, nap_fw, verbose=False):
     firmware to program Piksi NAP with.
   verbose : bool
     Print more verbose output.
+  handshake_kwargs : dict
+    Reset retry settings passed on to Bootloader.handshake.
 
   """
 
@@ -103,20 +113,18 @@ def setup_piksi(handler, stm_fw, nap_fw, verbose=False):
     handler.add_callback(heartbeat, SBP_MSG_HEARTBEAT)
 
     # Throw an exception if a heartbeat or handshake
-    # is not received for 5 seconds.
-    with Timeout(TIMEOUT_BOOT) as timeout:
-      if verbose: print "Waiting for Heartbeat or Bootloader Handshake"
-      while not heartbeat.received and not piksi_bootloader.handshake_received:
-        time.sleep(0.1)
+    # is not received for TIMEOUT_BOOT seconds.
+    if verbose: print "Waiting for Heartbeat or Bootloader Handshake"
+    wait_for_state(piksi_bootloader, heartbeat)
     # If Piksi is in the application, reset it into the bootloader.
     if heartbeat.received:
       if verbose: print "Received Heartbeat, resetting Piksi"
-      handler.send(SBP_MSG_RESET, "")
+      handler(MsgReset())
 
     handler.remove_callback(heartbeat, SBP_MSG_HEARTBEAT)
 
-    with Timeout(TIMEOUT_BOOT) as timeout:
-      piksi_bootloader.handshake()
+    if not piksi_bootloader.handshake(TIMEOUT_BOOT, **handshake_kwargs):
+      raise TimeoutError
     bootloader_version = piksi_bootloader.version
     if verbose: print "Received bootloader handshake"
 
@@ -125,8 +133,7 @@ def setup_piksi(handler, stm_fw, nap_fw, verbose=False):
       # Erase entire STM flash (except bootloader).
       if verbose: print "Erasing STM"
       with Timeout(TIMEOUT_ERASE_STM) as timeout:
-        for s in range(1,12):
-          piksi_flash.erase_sector(s)
+        piksi_flash.erase_sectors(range(1,12))
       # Write STM firmware.
       with Timeout(TIMEOUT_PROGRAM_STM) as timeout:
         if verbose:
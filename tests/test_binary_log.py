@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+from sbp.navigation import MsgPosLLH, SBP_MSG_POS_LLH
+from sbp.system import MsgHeartbeat
+
+import piksi_tools.binary_log as bl
+import piksi_tools.serial_link as sl
+
+
+def write_log(path, n):
+  msgs = []
+  with bl.BinaryLogger(path) as logger:
+    for i in range(n):
+      if i % 10 == 0:
+        msg = MsgHeartbeat(flags=i)
+      else:
+        msg = MsgPosLLH(tow=i, lat=1.5, lon=-2.5, height=i, h_accuracy=0,
+                        v_accuracy=0, n_sats=5, flags=0)
+      msgs.append(msg)
+      logger(msg)
+    return msgs, logger.index
+
+def test_binary_log(tmpdir, monkeypatch):
+  monkeypatch.setattr(bl, 'INDEX_BLOCK_SIZE', 256)
+  path = str(tmpdir.join('log.sbp'))
+  msgs, index = write_log(path, 100)
+  log = sl.get_log_iterator(path)
+  assert len(log.index) > 1
+  assert [e[:2] for e in log.index] == [tuple(e[:2]) for e in index]
+  records = list(log.next())
+  assert [m.to_binary() for m, meta in records] == \
+         [m.to_binary() for m in msgs]
+  assert records[51][0].tow == 51
+  t = records[51][1]['time']
+  assert [m.tow for m, meta in log.next(start=t, msg_types=[SBP_MSG_POS_LLH])
+          if meta['time'] == t][0] == 51
+  assert len(list(log.next(msg_types=[SBP_MSG_POS_LLH]))) == 90
+  log.close()
+  # Logs that weren't closed are indexed on opening, without the partially
+  # written last record.
+  with open(path, 'rb') as f:
+    data = f.read(index[-1][1] + 5)
+  with open(path, 'wb') as f:
+    f.write(data)
+  n = 0
+  offset = bl._HEADER.size
+  while offset < index[-1][1]:
+    offset += 8 + len(msgs[n].to_binary())
+    n += 1
+  log = bl.BinaryLogIterator(path)
+  assert [m.to_binary() for m, meta in log.next()] == \
+         [m.to_binary() for m in msgs[:n]]
@@ -144,6 +144,7 @@ class TestBootloader(unittest.TestCase):
       with Timeout(TIMEOUT_READ_SETTINGS) as timeout:
         sv._settings_read_button_fired()
         while not self.settings_received:
+          check_timeouts()
           time.sleep(0.1)
 
     return sv.settings
@@ -170,8 +171,8 @@ class TestBootloader(unittest.TestCase):
         heartbeat = Heartbeat()
         handler.add_callback(heartbeat, SBP_MSG_HEARTBEAT)
         if self.verbose: print "Waiting to receive heartbeat"
-        while not heartbeat.received:
-          time.sleep(0.1)
+        with Timeout(TIMEOUT_BOOT) as timeout:
+          heartbeat.event.wait()
         if self.verbose: print "Received hearbeat"
         handler.remove_callback(heartbeat, SBP_MSG_HEARTBEAT)
 
@@ -353,8 +354,7 @@ class TestBootloader(unittest.TestCase):
           handler.add_callback(heartbeat, SBP_MSG_HEARTBEAT)
 
           if self.verbose: print "Waiting to receive heartbeat"
-          while not heartbeat.received:
-            time.sleep(0.1)
+          heartbeat.event.wait()
           if self.verbose: print "Received hearbeat"
 
           handler.remove_callback(heartbeat, SBP_MSG_HEARTBEAT)
@@ -382,8 +382,7 @@ class TestBootloader(unittest.TestCase):
         with Bootloader(handler) as piksi_bootloader:
           with Timeout(TIMEOUT_BOOT) as timeout:
             if self.verbose: print "Waiting for bootloader handshake from device"
-            while not piksi_bootloader.handshake_received:
-              time.sleep(0.1)
+            piksi_bootloader.handshake_event.wait()
         if self.verbose: print "Received handshake"
         if self.verbose: print "Sending handshake with incorrect sender ID"
         handler.send(SBP_MSG_BOOTLOADER_HANDSHAKE_REQ, '\x00', sender=0x41)
@@ -395,8 +394,7 @@ class TestBootloader(unittest.TestCase):
           handler.add_callback(heartbeat, SBP_MSG_HEARTBEAT)
 
           if self.verbose: print "Waiting to receive heartbeat"
-          while not heartbeat.received:
-            time.sleep(0.1)
+          heartbeat.event.wait()
           if self.verbose: print "Received hearbeat"
 
           handler.remove_callback(heartbeat, SBP_MSG_HEARTBEAT)
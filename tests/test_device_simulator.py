@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+from sbp.client import Handler, Framer
+
+from piksi_tools.bootload import Bootloader
+from piksi_tools.device_simulator import DeviceSimulator
+from piksi_tools.flash import Flash
+from piksi_tools.flash_dump import dump_flash, dump_range, load_reference, \
+                                   save_dump, sectors_addr_range, verify_dump
+from piksi_tools.flash_benchmark import random_image, run_benchmark, \
+                                        STM_APP_BASE
+import pytest
+
+
+def flash_session(sim, flash_type, max_queued_ops=4):
+  link = Handler(Framer(sim.read, sim.write))
+  link.start()
+  bootloader = Bootloader(link)
+  assert bootloader.handshake(5)
+  return link, Flash(link, flash_type, bootloader.sbp_version,
+                     max_queued_ops=max_queued_ops)
+
+def test_write_ihx():
+  image = random_image(STM_APP_BASE, 0x1001, blank_fraction=0.5)
+  with DeviceSimulator(baud=1000000) as sim:
+    link, flash = flash_session(sim, "STM")
+    flash.write_ihx(random_image(STM_APP_BASE, 0x1001, seed=1))
+    flash.lock_sector(1)
+    with pytest.raises(Exception):
+      flash.write_ihx(image)
+    flash.unlock_sector(1)
+    flash.write_ihx(image)
+    link.stop()
+  assert sim.stm[0x4000:0x5001] == image.data
+  assert sim.stats['errors'] > 0
+
+def test_write_ihx_delta():
+  image = random_image(0, 0x30000)
+  changed = random_image(0, 0x30000)
+  changed.data[0x18000:0x18010] = '\x00' * 0x10
+  n_chunks = 0x10000 // 128
+  with DeviceSimulator(baud=1000000) as sim:
+    link, flash = flash_session(sim, "M25")
+    # Without a baseline the flash is read back, and differs everywhere.
+    flash.write_ihx(image, delta=True)
+    assert sim.m25[:0x30000] == image.data
+    assert sim.stats['erase'] == 3
+    assert sim.stats['program'] == 3 * n_chunks
+    assert sim.stats['read'] == 2 * 3 * n_chunks
+    assert flash.ihx_elapsed_ops == flash.ihx_n_ops(image, delta=True)
+    # With a baseline only the changed sector is rewritten.
+    stats = dict(sim.stats)
+    flash.write_ihx(changed, delta=True, baseline=image)
+    link.stop()
+  assert sim.m25[:0x30000] == changed.data
+  assert sim.stats['erase'] - stats['erase'] == 1
+  assert sim.stats['program'] - stats['program'] == n_chunks
+  assert sim.stats['read'] - stats['read'] == n_chunks
+  assert flash.ihx_elapsed_ops == flash.ihx_n_ops(changed, delta=True)
+
+def test_write_ihx_adapts_window():
+  from piksi_tools.timeout import TimeoutError
+  with DeviceSimulator(baud=1000000, op_latency=0.0005) as sim:
+    link, flash = flash_session(sim, "M25", max_queued_ops=4)
+    assert flash.window == 1
+    flash.write_ihx(random_image(0, 0x8000))
+    assert flash.max_window == 4
+    assert flash.base_rtt['program'] > 0
+    # Every error reply halves the window.
+    flash.window = flash.max_window
+    sim.error_rate = 1.0
+    for window in [2, 1, 1]:
+      flash.program(0x10000, '\xff' * 128)
+      flash.wait_n_queued_ops(0)
+      assert flash.window == window
+    assert flash.n_errors == 3
+    # A lost reply fails the wait rather than blocking it forever.
+    sim.error_rate = 0.0
+    sim.drop_rate = 1.0
+    flash.reply_timeout = 0.2
+    flash.program(0x10000, '\xff' * 128)
+    with pytest.raises(TimeoutError):
+      flash.wait_n_queued_ops(0)
+    with pytest.raises(TimeoutError):
+      flash.read(0x10000, 128, block=True)
+    link.stop()
+
+def test_erase_sectors():
+  with DeviceSimulator(baud=1000000, erase_latency=0.01) as sim:
+    sim.stm[0x4000:0x10000] = '\x00' * 0xc000
+    link, flash = flash_session(sim, "STM")
+    timings = flash.erase_sectors([1, 2, 3])
+    assert sim.stm[0x4000:0x10000] == '\xff' * 0xc000
+    assert [s for s, t in timings] == [1, 2, 3]
+    # Times are between replies, so jitter moves time between sectors.
+    assert sum([t for s, t in timings]) >= 0.03
+    assert all([t >= 0.005 for s, t in timings])
+    flash.lock_sector(2)
+    with pytest.raises(Exception) as e:
+      flash.erase_sectors([1, 2, 3])
+    assert str(e.value).endswith('sectors 2')
+    with pytest.raises(Warning):
+      flash.erase_sectors([0, 1])
+    link.stop()
+
+def test_write_ihx_reports_mismatches():
+  image = random_image(0, 0x800)
+  with DeviceSimulator(corrupt_rate=1.0, seed=1) as sim:
+    link, flash = flash_session(sim, "M25")
+    with pytest.raises(Exception) as e:
+      flash.write_ihx(image)
+    link.stop()
+  assert str(e.value).count('-') == 0x800 // 128
+
+def test_dump_flash(tmpdir):
+  with DeviceSimulator(baud=1000000) as sim:
+    sim.m25[0x10000:0x20000] = random_image(0x10000, 0x10000).data
+    link, flash = flash_session(sim, "M25")
+    first, last = sectors_addr_range(flash, 1, 1)
+    assert dump_range(flash, sectors=(1, 1)) == (first, last)
+    assert dump_range(flash, 0x10000, 0x10000) == (first, last)
+    image = dump_flash(flash, first, last)
+    link.stop()
+  assert image.segments == [(0x10000, 0x1ffff)]
+  assert image.gets(first, 0x10000) == sim.m25[0x10000:0x20000]
+  path = str(tmpdir.join('dump.bin'))
+  save_dump(image, first + 0x100, last, path, 'bin')
+  reference = load_reference(path, first + 0x100)
+  assert reference.mismatches(image) == []
+  assert verify_dump(image, first, last, reference) == []
+  image.puts(0x10200, '\x00')
+  assert verify_dump(image, first, last, reference) == [(0x10200, 0x10200)]
+
+def test_run_benchmark():
+  result = run_benchmark(size=0x1000, max_queued_ops=4, op_latency=0)
+  assert result['ops'] == 1 + 2 * 0x1000 // 128
+  assert result['device']['program'] == 0x1000 // 128
+
+def test_write_ihx_resumes_journal(tmpdir):
+  import piksi_tools.flash_cache as fc
+  image = random_image(0, 0x30000)
+  class Interrupt(Exception):
+    pass
+  def interrupt(n):
+    if n > 1400:
+      raise Interrupt()
+  with DeviceSimulator(baud=1000000) as sim:
+    link, flash = flash_session(sim, "M25")
+    journal = fc.load_journal('dev', "M25", str(tmpdir))
+    with pytest.raises(Interrupt):
+      flash.write_ihx(image, elapsed_ops_cb=interrupt, journal=journal)
+    flash.wait_n_queued_ops(0)
+    journal = fc.load_journal('dev', "M25", str(tmpdir))
+    assert journal.erased_sectors == set([0, 1, 2])
+    assert journal.verified[-1][1] == 0x2ffff
+    # Work recorded in a sector failing the spot check is redone.
+    sim.m25[journal.verified[0][0]] = '\x00'
+    n_programs = sim.stats['program']
+    flash.write_ihx(image, journal=journal)
+    link.stop()
+  assert sim.m25[:0x30000] == image.data
+  assert sim.stats['program'] - n_programs == 0x20000 // 128
+  assert fc.load_journal('dev', "M25", str(tmpdir)).image_digest is None
+
+def test_timeout_interrupts_flash_waits():
+  import threading
+  from piksi_tools.timeout import Timeout, TimeoutError, CancelledError
+  with DeviceSimulator(baud=1000000, erase_latency=0.2) as sim:
+    link, flash = flash_session(sim, "M25")
+    with pytest.raises(TimeoutError):
+      with Timeout(0.1):
+        flash.erase_sectors([1, 2, 3])
+    flash.wait_n_queued_ops(0)
+    timeout = Timeout(None)
+    threading.Timer(0.1, timeout.abort).start()
+    with pytest.raises(CancelledError):
+      with timeout:
+        flash.erase_sectors([1, 2, 3])
+    flash.wait_n_queued_ops(0)
+    link.stop()
+
+def test_update_view_single_session(monkeypatch):
+  pytest.importorskip('traits.api')
+  pytest.importorskip('pyface.api')
+  from StringIO import StringIO
+  import piksi_tools.console.update_view as uv
+  class Dialog(object):
+    def __init__(self, max, pulsed=False):
+      pass
+    def progress(self, count):
+      pass
+    def open(self):
+      pass
+    def close(self):
+      pass
+  monkeypatch.setattr(uv, 'PulsableProgressDialog', Dialog)
+  monkeypatch.setattr(uv.GUI, 'invoke_later',
+                      staticmethod(lambda *args: None))
+  monkeypatch.setattr(uv.UpdateView, 'get_latest_version_info',
+                      lambda self: None)
+  stm_image = random_image(STM_APP_BASE, 0x1000, seed=1)
+  nap_image = random_image(0, 0x1000, seed=2)
+  with DeviceSimulator(baud=1000000) as sim:
+    link = Handler(Framer(sim.read, sim.write))
+    link.start()
+    view = uv.UpdateView(link, prompt=False)
+    view.stream = StringIO()
+    view.load_journal = lambda flash_type: None
+    view.stm_fw.ihx, view.nap_fw.ihx = stm_image, nap_image
+    view.manage_firmware_updates("ALL")
+    link.stop()
+  # Both flashes were written in a single bootloader session.
+  assert sim.stats['handshakes'] == 1
+  assert sim.stm[0x4000:0x5000] == stm_image.data
+  assert sim.m25[0:0x1000] == nap_image.data
+  assert view.pk_boot is None
+  assert "Firmware update finished." in view.stream.getvalue()
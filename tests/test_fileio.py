@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+from sbp.client import Handler, Framer
+
+from piksi_tools.device_simulator import DeviceSimulator
+from piksi_tools.fileio import FileIO, READ_CHUNK_SIZE
+from piksi_tools.flash_benchmark import random_image
+
+
+def test_read():
+  data = random_image(0, 10 * READ_CHUNK_SIZE + 7).data
+  with DeviceSimulator(baud=1000000, drop_rate=0.05, seed=1) as sim:
+    sim.files['a'] = data
+    sim.files['b'] = data[:2 * READ_CHUNK_SIZE]
+    link = Handler(Framer(sim.read, sim.write))
+    link.start()
+    f = FileIO(link, window=4)
+    assert f.read('a') == data
+    assert f.read('b') == data[:2 * READ_CHUNK_SIZE]
+    assert f.read('missing') == ''
+    link.stop()
+  assert sim.stats['dropped'] > 0
+
+def test_write():
+  data = random_image(0, 3000).data
+  with DeviceSimulator(baud=1000000, drop_rate=0.05, seed=2) as sim:
+    sim.files['config'] = bytearray('x' * 5000)
+    link = Handler(Framer(sim.read, sim.write))
+    link.start()
+    f = FileIO(link, window=4)
+    f.write('config', data)
+    f.write('config', 'abc', offset=10)
+    link.stop()
+  assert sim.files['config'] == data[:10] + 'abc' + data[13:]
+  assert f.stats['bytes'] == 3
+  assert 'kB/s' in f.throughput_report()
+
+def test_read_into():
+  from StringIO import StringIO
+  from piksi_tools.fileio import HexDumpWriter, hexdump
+  data = random_image(0, 4 * READ_CHUNK_SIZE + 3).data
+  with DeviceSimulator(baud=1000000) as sim:
+    sim.files['log'] = data
+    link = Handler(Framer(sim.read, sim.write))
+    link.start()
+    f = FileIO(link, window=2)
+    progress = []
+    out = StringIO()
+    assert f.read_into('log', out, progress.append) == len(data)
+    dump = StringIO()
+    writer = HexDumpWriter(dump)
+    f.read_into('log', writer)
+    writer.flush()
+    link.stop()
+  assert out.getvalue() == data
+  assert progress == [READ_CHUNK_SIZE * n for n in range(1, 5)] + [len(data)]
+  assert dump.getvalue() == hexdump(str(data))
+
+def test_sync(tmpdir):
+  import os
+  from piksi_tools.fileio_sync import sync
+  local = str(tmpdir.join('mirror'))
+  with DeviceSimulator(baud=1000000) as sim:
+    sim.files['config'] = bytearray('a' * 300)
+    sim.files['logs/1.log'] = bytearray('b' * 1000)
+    link = Handler(Framer(sim.read, sim.write))
+    link.start()
+    f = FileIO(link)
+    summary = sync(f, local)
+    assert summary.pulled == ['config', 'logs/1.log']
+    assert (summary.bytes_received, summary.bytes_sent) == (1300, 0)
+    assert open(os.path.join(local, 'logs', '1.log')).read() == 'b' * 1000
+    assert sync(f, local).n_unchanged == 2
+    sim.files['config'] += 'c'
+    with open(os.path.join(local, 'logs', '1.log'), 'w') as log:
+      log.write('d' * 10)
+    with open(os.path.join(local, 'new'), 'w') as new:
+      new.write('e')
+    summary = sync(f, local, direction='both')
+    assert (summary.pulled, summary.pushed) == (['config'],
+                                                ['logs/1.log', 'new'])
+    assert (summary.bytes_received, summary.bytes_sent) == (301, 11)
+    # Files compared by contents are fetched once, even when pulled.
+    sim.files['config'] += 'f'
+    summary = sync(f, local, checksum=True)
+    link.stop()
+  assert summary.pulled == ['config']
+  assert summary.bytes_received == 302 + 10 + 1
+  assert open(os.path.join(local, 'config')).read() == 'a' * 300 + 'cf'
+  assert sim.files['logs/1.log'] == 'd' * 10
+
+def test_walk():
+  from piksi_tools.fileio import tree_files
+  with DeviceSimulator(baud=1000000) as sim:
+    for i in range(40):
+      sim.files['logs/%d/log_with_a_long_name_%02d' % (i % 3, i)] = \
+        bytearray('x' * (i * 97))
+    sim.files['config'] = bytearray('c' * 3000)
+    link = Handler(Framer(sim.read, sim.write))
+    link.start()
+    f = FileIO(link)
+    tree = f.walk(sizes=True)
+    n_requests = sim.stats['read_dir'] + sim.stats['file_read']
+    assert f.walk(sizes=True) == tree
+    assert sim.stats['read_dir'] + sim.stats['file_read'] == n_requests
+    assert sorted(f.readdir('logs')) == ['0/', '1/', '2/']
+    link.stop()
+  assert tree_files(tree) == sorted([(p, len(d)) for p, d in sim.files.items()])
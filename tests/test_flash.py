@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+from intelhex import IntelHex
+import piksi_tools.flash as f
+
+
+def padded_ihx():
+  ihx = IntelHex()
+  ihx.puts(0x0, '\x01' * 0x81)
+  ihx.puts(0x81, '\xff' * 0xff)
+  return ihx
+
+def test_ihx_chunks():
+  ihx = padded_ihx()
+  assert f.ihx_ranges(ihx) == [(0x0, 0x17f)]
+  assert f.ihx_chunks(f.ihx_ranges(ihx)) == [(0x0, 0x80), (0x80, 0x80),
+                                             (0x100, 0x80)]
+
+def test_blank_chunks():
+  ihx = padded_ihx()
+  chunks = f.ihx_chunks(f.ihx_ranges(ihx))
+  assert f.blank_chunks(ihx, chunks, [0], f.m25_addr_sector_map) == set([0x100])
+  assert f.blank_chunks(ihx, chunks, [], f.m25_addr_sector_map) == set()
+
+def test_ihx_n_ops():
+  ihx = padded_ihx()
+  n_ops = lambda **kw: f.ihx_n_ops(ihx, f.m25_addr_sector_map, **kw)
+  assert n_ops(blank_policy=f.BLANK_PROGRAM) == 1 + 3 * 2
+  assert n_ops(blank_policy=f.BLANK_READ) == 1 + 2 * 2 + 1
+  assert n_ops(blank_policy=f.BLANK_SKIP) == 1 + 2 * 2
+  assert n_ops(erase=False) == 3 * 2
+  assert n_ops(erase=False, erased_sectors=[0]) == 2 * 2 + 1
+  assert n_ops(delta=True) == 1 + 2 * 2 + 1 + 3
+
+def test_flash_image_mismatches():
+  programmed = f.FlashImage.from_ihx(padded_ihx(), 0x0, 0x10000)
+  assert programmed.segments == [(0x0, 0x17f)]
+  read = f.FlashImage(0x0, 0x10000)
+  read.puts(0x100, '\xff' * 0x80)
+  read.puts(0x0, '\x01' * 0x80)
+  assert read.segments == [(0x0, 0x7f), (0x100, 0x17f)]
+  assert programmed.mismatches(read) == [(0x80, 0xff)]
+  read.puts(0x80, '\x01' + '\xff' * 0x7f)
+  assert read.segments == [(0x0, 0x17f)]
+  assert programmed.mismatches(read) == []
+  read.puts(0x10, '\x00')
+  read.puts(0x150, '\x00\x00')
+  assert programmed.mismatches(read) == [(0x10, 0x10), (0x150, 0x151)]
+  assert programmed.mismatches(read, [(0x100, 0x14f)]) == []
+
+def test_flash_cache_load_hex_file(tmpdir):
+  import piksi_tools.flash_cache as fc
+  hex_path = str(tmpdir.join('fw.hex'))
+  padded_ihx().write_hex_file(hex_path)
+  cache_dir = str(tmpdir.join('cache'))
+  for compiled in [False, True]:
+    assert tmpdir.join('cache', 'images').check() == compiled
+    image = fc.load_hex_file(hex_path, cache_dir)
+    assert (image.start, image.size) == (0x0, 0x180)
+    assert image.segments == [(0x0, 0x17f)]
+    assert image.gets(0x80, 2) == '\x01\xff'
+  assert f.ihx_n_ops(image, f.m25_addr_sector_map) == \
+         f.ihx_n_ops(padded_ihx(), f.m25_addr_sector_map)
+
+def test_flash_cache_device_image(tmpdir):
+  import piksi_tools.flash_cache as fc
+  cache_dir = str(tmpdir)
+  fc.save_device_image('dev', "M25", padded_ihx(), cache_dir)
+  # As in a delta update: load the baseline, drop it while the flash is
+  # written and save the written image again.
+  image = fc.load_device_image('dev', "M25", cache_dir)
+  fc.forget_device_image('dev', "M25", cache_dir)
+  assert fc.load_device_image('dev', "M25", cache_dir) is None
+  assert image.gets(0x80, 2) == '\x01\xff'
+  fc.save_device_image('dev', "M25", image, cache_dir)
+  fc.save_device_image('dev', "M25", image, cache_dir)
+  saved = fc.load_device_image('dev', "M25", cache_dir)
+  assert saved.segments == image.segments
+  assert saved.data == image.data
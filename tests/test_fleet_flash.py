@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+from intelhex import IntelHex
+
+from piksi_tools.device_simulator import DeviceSimulator
+from piksi_tools.flash_benchmark import random_image
+import piksi_tools.fleet_flash as ff
+
+
+def write_hex_file(path, image):
+  ihx = IntelHex()
+  ihx.puts(image.start, image.data)
+  ihx.write_hex_file(path)
+
+class LosingQueue(object):
+  """
+  Progress queue of a flash worker making the device lose every message once
+  the first attempt has made some progress, until the attempt is retried.
+  """
+
+  def __init__(self, sim):
+    self.sim = sim
+    self.events = []
+
+  def put(self, event):
+    self.events.append(event)
+    port, stage, n, total = event
+    if stage == 'retry':
+      self.sim.drop_rate = 0.0
+    elif stage == 'M25' and n > 0 and len(self.events) < 3:
+      self.sim.drop_rate = 1.0
+
+def test_flash_fleet(tmpdir):
+  image = random_image(0, 0x2000)
+  hex_path = str(tmpdir.join('nap.hex'))
+  write_hex_file(hex_path, image)
+  with DeviceSimulator(baud=1000000) as sim:
+    port = sim.serve_pty()
+    events = []
+    devices = ff.flash_fleet([port], jobs=1, retries=0,
+                             progress_cb=lambda *e: events.append(e),
+                             nap_file=hex_path, baud=1000000, timeout=5,
+                             flash_timeout=10, cache_dir=str(tmpdir))
+  assert devices[0]['status'] == 'ok'
+  assert devices[0]['m25']['ops'] == 1 + 2 * 0x2000 // 128
+  assert events[-1] == (port, 'ok', 0, 0)
+  assert sim.m25[:0x2000] == image.data
+
+def test_flash_worker_retries_after_timeout(tmpdir):
+  image = random_image(0, 0x2000)
+  hex_path = str(tmpdir.join('nap.hex'))
+  write_hex_file(hex_path, image)
+  with DeviceSimulator(baud=1000000) as sim:
+    port = sim.serve_pty()
+    queue = LosingQueue(sim)
+    report = ff._flash_worker(port, 1, queue,
+                              {'nap_file': hex_path, 'baud': 1000000,
+                               'timeout': 5, 'flash_timeout': 2,
+                               'cache_dir': str(tmpdir)})
+  assert sim.stats['dropped'] > 0
+  assert report['status'] == 'ok'
+  assert [a['error'] is None for a in report['attempts']] == [False, True]
+  assert report['attempts'][0]['error'].startswith('TimeoutError')
+  assert sim.m25[:0x2000] == image.data
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+import os
+
+from sbp.client.loggers.json_logger import JSONLogger
+from sbp.navigation import MsgPosLLH, SBP_MSG_POS_LLH
+from sbp.system import MsgHeartbeat
+
+import piksi_tools.json_log_index as jli
+import piksi_tools.serial_link as sl
+from piksi_tools.log_writer import LogWriter
+
+
+def records(first, n):
+  for i in range(first, first + n):
+    if i % 10 == 0:
+      msg = MsgHeartbeat(flags=i)
+    else:
+      msg = MsgPosLLH(tow=i, lat=1.5, lon=-2.5, height=i, h_accuracy=0,
+                      v_accuracy=0, n_sats=5, flags=0)
+    yield msg, {'timestamp': 1000 + i // 5, 'delta': i}
+
+def test_json_log_index(tmpdir, monkeypatch):
+  monkeypatch.setattr(jli, 'INDEX_BLOCK_SIZE', 1024)
+  path = str(tmpdir.join('log.json'))
+  with JSONLogger(path) as logger:
+    for msg, meta in records(0, 100):
+      logger(msg, **meta)
+  log = sl.get_log_iterator(path)
+  assert len(list(log.next())) == 100
+  assert [m.tow for m, meta in log.next(start=1010, end=1011,
+                                        msg_types=[SBP_MSG_POS_LLH])] == \
+         [51, 52, 53, 54, 55, 56, 57, 58, 59]
+  assert os.path.exists(jli.index_filename(path))
+  assert log.blocks(start=1010, end=1011)[0][0] > 0
+  assert len(list(log.next())) == 100
+  log.close()
+  # Only the appended records are scanned on update.
+  index = jli.load_index(path)
+  with open(path, 'a') as f:
+    logger = JSONLogger(None)
+    logger.handle = f
+    for msg, meta in records(100, 50):
+      logger(msg, **meta)
+  updated = jli.build_index(path)
+  assert updated[:len(index)] == index
+  log = sl.get_log_iterator(path)
+  assert [meta['delta'] for m, meta in log.next(start=1028)] == \
+         range(140, 150)
+  # Indexing while logging gives the same index.
+  live_path = str(tmpdir.join('live.log.json'))
+  with LogWriter(live_path, index=True) as writer:
+    for msg, meta in records(0, 150):
+      writer(msg, **meta)
+  with open(path, 'rb') as f, open(live_path, 'rb') as g:
+    assert f.read() == g.read()
+  assert jli.load_index(live_path) == jli.build_index(path)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+import struct
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from sbp.client.loggers.json_logger import JSONLogger
+from sbp.logging import MsgLog
+from sbp.msg import SBP
+from sbp.navigation import MsgPosLLH
+from sbp.observation import SBP_MSG_OBS
+from sbp.table import dispatch
+from sbp.tracking import SBP_MSG_TRACKING_STATE
+
+import piksi_tools.binary_log as bl
+import piksi_tools.log_columns as lc
+
+
+def obs_msg(i):
+  payload = struct.pack('<IHB', i, 1900, 0x10 | i % 3)
+  for j in range(i % 3):
+    payload += struct.pack('<IiBBHHBB', 1000 * i + j, -j, j, 40 + j, i, j, 0,
+                           0)
+  return SBP(SBP_MSG_OBS, 0x42, len(payload), payload, 0)
+
+def tracking_msg(i):
+  payload = ''.join([struct.pack('<BHBBf', 1, i + j, 0, 0, 30.5 + j)
+                     for j in range(4)])
+  return SBP(SBP_MSG_TRACKING_STATE, 0x42, len(payload), payload, 0)
+
+def write_log(path, n):
+  msgs = []
+  with bl.BinaryLogger(path) as logger:
+    for i in range(n):
+      for msg in [MsgPosLLH(tow=i, lat=1.5 * i, lon=-2.5, height=i,
+                            h_accuracy=0, v_accuracy=0, n_sats=5, flags=0),
+                  obs_msg(i), tracking_msg(i), MsgLog(level=1, text='x')]:
+        logger(msg, time=1000 + 0.1 * i)
+        msgs.append(msg)
+  return msgs
+
+def test_log_columns(tmpdir):
+  path = str(tmpdir.join('log.sbp'))
+  msgs = write_log(path, 300)
+  for ext in ['.npz', '.h5']:
+    output = str(tmpdir.join('columns' + ext))
+    if ext == '.h5':
+      pytest.importorskip('h5py')
+    exporter = lc.ColumnExporter(output, chunk_rows=64)
+    log = bl.BinaryLogIterator(path, dispatcher=lambda m: m)
+    for msg, metadata in log.next():
+      exporter(msg, **metadata)
+    exporter.close()
+    assert exporter.n_skipped == 300
+    pos = lc.load_table(output, 'MsgPosLLH')
+    assert list(pos['tow']) == range(300)
+    assert pos['lat'].dtype == np.float64
+    assert np.allclose(pos['lat'], 1.5 * np.arange(300))
+    assert np.allclose(pos['timestamp'], 1000 + 0.1 * np.arange(300))
+    obs = lc.load_table(output, 'MsgObs')
+    elements = lc.load_table(output, 'MsgObs.obs')
+    assert list(obs['header.t.tow']) == range(300)
+    assert len(elements['P']) == sum([i % 3 for i in range(300)])
+    for i in [1, 2, 200]:
+      decoded = dispatch(msgs[4 * i + 1])
+      rows = np.nonzero(elements['msg_index'] == i)[0]
+      assert list(elements['P'][rows]) == [o.P for o in decoded.obs]
+      assert list(elements['L.i'][rows]) == [o.L.i for o in decoded.obs]
+      assert list(elements['sid.sat'][rows]) == \
+             [o.sid.sat for o in decoded.obs]
+    states = lc.load_table(output, 'MsgTrackingState.states')
+    assert list(states['msg_index'][:8]) == [0, 0, 0, 0, 1, 1, 1, 1]
+    assert list(states['cn0'][:4]) == [30.5, 31.5, 32.5, 33.5]
+  # JSON logs, kept in memory.
+  json_path = str(tmpdir.join('log.json'))
+  with JSONLogger(json_path) as logger:
+    for i, msg in enumerate(msgs[:40]):
+      logger(msg, timestamp=1000 + i // 4, delta=100 * (i // 4))
+  tables = lc.export_log(json_path).tables
+  assert list(tables['MsgPosLLH']['tow']) == range(10)
+  assert list(tables['MsgPosLLH']['delta']) == range(0, 1000, 100)
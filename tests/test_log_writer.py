@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+import os
+import threading
+
+from sbp.client.loggers.json_logger import JSONLogger
+from sbp.navigation import MsgPosLLH
+
+import piksi_tools.serial_link as sl
+from piksi_tools.log_writer import LogWriter
+
+
+def pos_msgs(n):
+  return [MsgPosLLH(tow=i, lat=1.5, lon=-2.5, height=i, h_accuracy=0,
+                    v_accuracy=0, n_sats=5, flags=0) for i in range(n)]
+
+def read_tows(paths):
+  tows = []
+  for path in paths:
+    log = sl.get_log_iterator(path)
+    tows += [msg.tow for msg, meta in log.next()]
+    log.close()
+  return tows
+
+def test_log_writer_rotates(tmpdir):
+  msgs = pos_msgs(300)
+  for fmt in sl.LOG_FORMATS:
+    path = str(tmpdir.join('capture-%s.log' % fmt))
+    with LogWriter(path, fmt, rotate_bytes=4096, compression='gzip',
+                   max_files=3) as logger:
+      for msg in msgs:
+        logger(msg, timestamp=0, delta=0)
+    assert len(logger.paths) > 3
+    assert all([p.endswith('.gz') for p in logger.paths])
+    assert [os.path.exists(p) for p in logger.paths] == \
+           [False] * (len(logger.paths) - 3) + [True] * 3
+    tows = read_tows(logger.paths[-3:])
+    assert tows == range(300 - len(tows), 300)
+    assert logger.n_dropped == 0
+
+def test_log_writer_drops_when_full(tmpdir, monkeypatch):
+  writing, resume = threading.Event(), threading.Event()
+  write = JSONLogger.__call__
+  def slow_write(self, msg, **metadata):
+    # Hold up the writer thread so the queue fills.
+    writing.set()
+    resume.wait()
+    write(self, msg, **metadata)
+  monkeypatch.setattr(JSONLogger, '__call__', slow_write)
+  path = str(tmpdir.join('capture.log.json'))
+  logger = LogWriter(path, queue_size=10)
+  msgs = pos_msgs(30)
+  logger(msgs[0])
+  writing.wait()
+  for msg in msgs[1:]:
+    logger(msg)
+  resume.set()
+  logger.close()
+  assert (logger.n_written, logger.n_dropped) == (11, 19)
+  assert (logger.n_queue_full, logger.n_write_failed) == (19, 0)
+  assert read_tows([path]) == range(11)
+
+def test_log_writer_skips_failed_writes(tmpdir, monkeypatch):
+  write = JSONLogger.__call__
+  def failing_write(self, msg, **metadata):
+    if msg.tow % 3 == 0:
+      raise ValueError("Can't encode")
+    write(self, msg, **metadata)
+  monkeypatch.setattr(JSONLogger, '__call__', failing_write)
+  path = str(tmpdir.join('capture.log.json'))
+  with LogWriter(path, queue_size=10) as logger:
+    for msg in pos_msgs(30):
+      logger.flush()
+      logger(msg)
+  assert (logger.n_written, logger.n_write_failed) == (20, 10)
+  assert logger.n_dropped == 10
+  assert read_tows([path]) == [i for i in range(30) if i % 3]
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+import pytest
+
+from sbp.client.loggers.json_logger import JSONLogger
+from sbp.logging import MsgLog
+from sbp.navigation import MsgPosLLH, SBP_MSG_POS_LLH
+from sbp.table import dispatch
+
+import piksi_tools.json_log_index as jli
+import piksi_tools.parallel_decode as pd
+
+
+def write_log(path, n):
+  with JSONLogger(path) as logger:
+    for i in range(n):
+      logger(MsgPosLLH(tow=i, lat=1.5 * i, lon=-2.5, height=i, h_accuracy=0,
+                       v_accuracy=0, n_sats=5, flags=0),
+             timestamp=1000 + 0.1 * i, delta=100 * i)
+      if i % 10 == 0:
+        logger(MsgLog(level=1, text='x'), timestamp=1000 + 0.1 * i,
+               delta=100 * i)
+  # An incomplete last record, e.g. while still logging.
+  with open(path, 'ab') as f:
+    f.write('{"timestamp": 1')
+
+def test_parallel_decode(tmpdir):
+  path = str(tmpdir.join('log.json'))
+  write_log(path, 500)
+  ranges = pd.split_lines(path, range_size=4096)
+  assert len(ranges) > 10
+  assert ranges[0][0] == 0
+  assert ranges[-1][1] == tmpdir.join('log.json').size()
+  records = list(pd.json_records(path, 0, ranges[-1][1], dispatch))
+  assert [msg.tow for msg, metadata in records
+          if isinstance(msg, MsgPosLLH)] == range(500)
+  # Results come back in the order of the ranges.
+  lengths = list(pd.map_ranges(_count_lines, path, jobs=3, range_size=4096))
+  assert lengths == [_count_lines(path, start, end) for start, end in ranges]
+  assert sum(lengths) == 550
+
+def _count_lines(filename, start, end):
+  with open(filename, 'rb') as f:
+    return len(list(pd.iter_lines(f, start, end)))
+
+def test_parallel_index(tmpdir, monkeypatch):
+  path = str(tmpdir.join('log.json'))
+  write_log(path, 500)
+  monkeypatch.setattr(pd, 'RANGE_SIZE', 4096)
+  index = jli.build_index(path, jobs=2)
+  assert len(index) > 10
+  assert jli.load_index(path) == index
+  # The incomplete last record isn't indexed.
+  assert index[-1][2] == tmpdir.join('log.json').size() - 15
+  log = jli.IndexedJSONLogIterator(path)
+  tows = [msg.tow for msg, metadata in log.next(1010, 1020, [SBP_MSG_POS_LLH])]
+  assert tows == range(100, 201)
+
+def test_parallel_export(tmpdir, monkeypatch):
+  np = pytest.importorskip('numpy')
+  import piksi_tools.log_columns as lc
+  from test_log_columns import obs_msg, tracking_msg
+  path = str(tmpdir.join('log.json'))
+  # Messages with element tables, whose msg_index is offset when merged.
+  with JSONLogger(path) as logger:
+    for i in range(300):
+      for msg in [obs_msg(i), tracking_msg(i), MsgLog(level=1, text='x')]:
+        logger(msg, timestamp=1000 + 0.1 * i, delta=100 * i)
+  expected = lc.export_log(path).tables
+  monkeypatch.setattr(pd, 'RANGE_SIZE', 4096)
+  tables = lc.export_log(path, jobs=2).tables
+  assert sorted(tables.keys()) == sorted(expected.keys())
+  assert 'MsgObs.obs' in tables and 'MsgTrackingState.states' in tables
+  for name in expected:
+    for column in expected[name]:
+      assert np.array_equal(tables[name][column], expected[name][column])
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# Copyright (C) 2016 Swift Navigation Inc.
+# Contact: Colin Beighley <colin@swift-nav.com>
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+import time
+
+from sbp.client import Handler, Framer
+from sbp.client.loggers.json_logger import JSONLogger
+from sbp.navigation import MsgPosLLH
+
+import piksi_tools.binary_log as bl
+import piksi_tools.serial_link as sl
+
+
+def replay(path, speed):
+  received = []
+  with sl.get_driver(replay=path, replay_speed=speed) as driver:
+    link = Handler(Framer(driver.read, driver.write))
+    link.add_callback(lambda msg, **metadata: received.append(msg))
+    link.start()
+    while link.is_alive():
+      time.sleep(0.01)
+  return received, driver.stats
+
+def test_replay_driver(tmpdir):
+  msgs = [MsgPosLLH(tow=i, lat=1.5, lon=-2.5, height=i, h_accuracy=0,
+                    v_accuracy=0, n_sats=5, flags=0) for i in range(50)]
+  json_path = str(tmpdir.join('log.json'))
+  binary_path = str(tmpdir.join('log.sbp'))
+  with JSONLogger(json_path) as json_logger:
+    with bl.BinaryLogger(binary_path) as binary_logger:
+      for i, msg in enumerate(msgs):
+        # 50 messages over 2 seconds.
+        json_logger(msg, delta=40 * i, timestamp=1000 + i // 25)
+        binary_logger(msg, time=1000 + 0.04 * i)
+  for path in [json_path, binary_path]:
+    received, stats = replay(path, 10)
+    assert [m.tow for m in received] == range(50)
+    assert stats['msgs'] == 50
+    assert 0.15 < stats['seconds'] < 1.0
+    assert 5 < stats['speed'] < 11
+    received, stats = replay(path, 0)
+    assert len(received) == 50
+    assert stats['seconds'] < 0.15